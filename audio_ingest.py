@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Audio ingest from redis. A dedicated thread drains the audio channel into a bounded ring buffer, the decoder
+reads fixed size chunks from it, no matter how the publishers packetize their audio.
+The audio can either come from a pub/sub channel (RedisAudioIngest) or from a redis stream with a consumer group
+(RedisStreamAudioIngest), that keeps the audio until it is acknowledged.
+"""
+
+import collections
+import threading
+
+import numpy as np
+import redis
+
+
+# Bounded, thread safe ring buffer of int16 samples. If the buffer is full, the oldest samples are overwritten,
+# so that the latency stays bounded if the decoder falls behind. All sizes are in frames (one sample per channel).
+class AudioRingBuffer():
+
+    def __init__(self, capacity, channels=1, jitter_frames=0):
+        self.capacity = capacity
+        self.channels = channels
+        self.jitter_frames = jitter_frames
+        self.buffer = np.zeros((capacity, channels), dtype=np.int16)
+        self.start = 0
+        self.size = 0
+        self.condition = threading.Condition()
+        self.closed = False
+
+        # After start and after every underrun we wait until jitter_frames are buffered before we deliver again
+        self.prebuffering = jitter_frames > 0
+
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.underruns = 0
+
+    def depth(self):
+        return self.size
+
+    def write(self, samples):
+        frames = np.reshape(samples, (-1, self.channels))
+
+        with self.condition:
+            if len(frames) > self.capacity:
+                self.frames_dropped += len(frames) - self.capacity
+                frames = frames[-self.capacity:]
+
+            num = len(frames)
+            overflow = self.size + num - self.capacity
+            if overflow > 0:
+                self.start = (self.start + overflow) % self.capacity
+                self.size -= overflow
+                self.frames_dropped += overflow
+
+            end = (self.start + self.size) % self.capacity
+            first = min(num, self.capacity - end)
+            self.buffer[end:end + first] = frames[:first]
+            self.buffer[:num - first] = frames[first:]
+            self.size += num
+            self.frames_written += len(samples) // self.channels
+
+            if self.prebuffering and self.size >= self.jitter_frames:
+                self.prebuffering = False
+            if not self.prebuffering:
+                self.condition.notify_all()
+
+    # Read exactly num_frames frames (interleaved, as 1-dim array). Blocks until enough frames are available;
+    # returns None if the timeout expires or the buffer was closed. If out is given, the frames are copied into it.
+    def read(self, num_frames, timeout=None, out=None):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.closed or (not self.prebuffering and self.size >= num_frames), timeout):
+                if self.jitter_frames > 0 and not self.prebuffering and self.frames_written > 0:
+                    self.underruns += 1
+                    self.prebuffering = True
+                return None
+            if self.size < num_frames:
+                return None
+            return self._pop(num_frames, out)
+
+    # Non blocking read, returns None if less than num_frames are buffered (the jitter buffer is not used here)
+    def read_available(self, num_frames, out=None):
+        with self.condition:
+            if self.size < num_frames:
+                return None
+            return self._pop(num_frames, out)
+
+    def _pop(self, num_frames, out):
+        if out is None:
+            out = np.empty(num_frames * self.channels, dtype=np.int16)
+        out_frames = np.reshape(out, (-1, self.channels))
+
+        first = min(num_frames, self.capacity - self.start)
+        out_frames[:first] = self.buffer[self.start:self.start + first]
+        out_frames[first:num_frames] = self.buffer[:num_frames - first]
+        self.start = (self.start + num_frames) % self.capacity
+        self.size -= num_frames
+        return out
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Drains a redis pub/sub audio channel in its own thread, so that the decoding loop is never blocked by the network.
+# The decoder reads chunks of chunk_size frames with read_chunk().
+class RedisAudioIngest(threading.Thread):
+
+    def __init__(self, red, audio_data_channel, chunk_size, channels=1, samp_freq=16000, jitter_ms=100, max_buffer_ms=10000):
+        super().__init__(daemon=True)
+        self.red = red
+        self.audio_data_channel = audio_data_channel
+        self.chunk_size = chunk_size
+        self.ring_buffer = AudioRingBuffer(capacity=max(int(samp_freq * max_buffer_ms / 1000), 2 * chunk_size), channels=channels,
+                                           jitter_frames=int(samp_freq * jitter_ms / 1000))
+        self.running = True
+        self.subscribed = threading.Event()
+        self.packets_received = 0
+
+    def run(self):
+        pubsub = self.red.pubsub()
+        pubsub.subscribe(self.audio_data_channel)
+        while self.running:
+            # We use a timeout, so that the thread can be stopped
+            msg = pubsub.get_message(timeout=0.5)
+            if msg is None:
+                continue
+            if msg['type'] == 'subscribe':
+                print("Successfully connected to redis audio stream!")
+                self.subscribed.set()
+            elif msg['type'] == 'message':
+                self.packets_received += 1
+                self.ring_buffer.write(np.frombuffer(msg['data'], dtype=np.int16))
+        pubsub.close()
+
+    def read_chunk(self, timeout=None, out=None):
+        return self.ring_buffer.read(self.chunk_size, timeout=timeout, out=out)
+
+    def stats(self):
+        return {'packets_received': self.packets_received, 'frames_written': self.ring_buffer.frames_written,
+                'frames_dropped': self.ring_buffer.frames_dropped, 'underruns': self.ring_buffer.underruns,
+                'depth': self.ring_buffer.depth()}
+
+    def stop(self):
+        self.running = False
+        self.ring_buffer.close()
+
+
+# Create a consumer group for a stream (and the stream itself), if it does not exist yet.
+# start_id '0' delivers all entries already in the stream to the group, '$' only new ones.
+def ensure_consumer_group(red, stream, group, start_id='$'):
+    try:
+        red.xgroup_create(stream, group, id=start_id, mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        # BUSYGROUP: the group already exists, we resume from its last delivered ID
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+# Reads audio from a redis stream (XREADGROUP) instead of pub/sub. Audio that is published while the decoder is busy or
+# reconnecting is kept in the stream, and a restarted decoder with the same consumer name first re-reads its entries
+# that were delivered but not acknowledged. An entry is only acknowledged when the decoder has read all of its audio.
+# The stream entries are expected to have the raw int16 audio in the field 'audio'. The producer bounds the length of the
+# stream (XADD with MAXLEN ~), so that the decoder does not have to trim it.
+class RedisStreamAudioIngest(RedisAudioIngest):
+
+    def __init__(self, red, audio_stream, chunk_size, channels=1, samp_freq=16000, jitter_ms=100, max_buffer_ms=10000,
+                 group='asr_decoders', consumer='decoder'):
+        super().__init__(red, audio_stream, chunk_size, channels=channels, samp_freq=samp_freq, jitter_ms=jitter_ms,
+                         max_buffer_ms=max_buffer_ms)
+        self.group = group
+        self.consumer = consumer
+
+        # (entry id, number of frames written up to and including this entry), acked once the decoder has read that far
+        self.unacked = collections.deque()
+        self.frames_read = 0
+        self.ack_lock = threading.Lock()
+
+    def run(self):
+        stream = self.audio_data_channel
+        ensure_consumer_group(self.red, stream, self.group)
+        print("Successfully connected to redis audio stream", stream, "as", self.group + '/' + self.consumer)
+        self.subscribed.set()
+
+        # Start with the entries that were delivered to us before a restart but never acknowledged (reading from '0' and
+        # then after the last pending entry we got), then switch to new entries ('>') once there are no more pending ones
+        last_id = '0'
+        while self.running:
+            response = self.red.xreadgroup(self.group, self.consumer, {stream: last_id}, count=100, block=500)
+            entries = response[0][1] if response else []
+            if last_id != '>' and not entries:
+                last_id = '>'
+                continue
+
+            for entry_id, fields in entries:
+                # Pending entries can be empty if they were trimmed from the stream in the meantime
+                if not fields:
+                    self.red.xack(stream, self.group, entry_id)
+                    continue
+                self.packets_received += 1
+                self.ring_buffer.write(np.frombuffer(fields[b'audio'], dtype=np.int16))
+                with self.ack_lock:
+                    self.unacked.append((entry_id, self.ring_buffer.frames_written))
+
+            if last_id != '>':
+                last_id = entries[-1][0]
+
+            self.ack_consumed()
+
+    # Acknowledge all entries that were completely read by the decoder (or dropped by the ring buffer)
+    def ack_consumed(self):
+        consumed = self.frames_read + self.ring_buffer.frames_dropped
+        ids = []
+        with self.ack_lock:
+            while self.unacked and self.unacked[0][1] <= consumed:
+                ids.append(self.unacked.popleft()[0])
+        if ids:
+            self.red.xack(self.audio_data_channel, self.group, *ids)
+
+    def read_chunk(self, timeout=None, out=None):
+        block = super().read_chunk(timeout=timeout, out=out)
+        if block is not None:
+            self.frames_read += self.chunk_size
+        return block
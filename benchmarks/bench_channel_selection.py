@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmark of the speaker channel selection: the previous per channel Python loop vs. the vectorized ChannelSelector.
+Run from the repository root: python3 benchmarks/bench_channel_selection.py
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from channel_selection import ChannelSelector
+
+
+# The channel selection as it was done before, with a Python loop over the channels
+def select_loop(block, channels, mic_vol_cutoff=0.5):
+    block = np.reshape(block, (-1, channels))
+    volume_norms = []
+    for i in range(channels):
+        volume_norms.append(np.linalg.norm(block[:, i] / 65536.0) * 10.0)
+    volume_norms = [0.0 if elem < mic_vol_cutoff else elem for elem in volume_norms]
+    max_channel = volume_norms.index(max(volume_norms))
+    return block[:, max_channel], max_channel
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the speaker channel selection')
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', help='Frames per chunk', type=int, default=1024)
+    parser.add_argument('-n', '--number', dest='number', help='Number of chunks per measurement', type=int, default=2000)
+    parser.add_argument('-c', '--channels', dest='channels', help='Channel counts to benchmark', type=int, nargs='+', default=[2, 4, 8, 16])
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print('%8s %16s %16s %8s' % ('channels', 'loop (us/chunk)', 'vector (us/chunk)', 'speedup'))
+    for channels in args.channels:
+        block = (rng.standard_normal(args.chunk_size * channels) * 3000).astype(np.int16)
+        selector = ChannelSelector(channels)
+
+        # Both implementations must select the same channel
+        assert select_loop(block, channels)[1] == selector.select(block)[1]
+
+        loop_secs = min(timeit.repeat(lambda: select_loop(block, channels), number=args.number, repeat=3))
+        vector_secs = min(timeit.repeat(lambda: selector.select(block), number=args.number, repeat=3))
+        print('%8d %16.2f %16.2f %7.1fx' % (channels, loop_secs / args.number * 1e6, vector_secs / args.number * 1e6, loop_secs / vector_secs))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the confidence modes (--confidence-mode, see confidences.py) on the final lattices of a wav scp: time per
+utterance and the error of the confidences compared to MBR on the full lattice. Every wav file is decoded as one utterance
+(no endpointing), so that long recordings give long lattices. Run from the repository root:
+python3 benchmarks/bench_confidences.py -y models/kaldi_tuda_de_nnet3_chain2.yaml -i scp:wav.scp
+"""
+
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from confidences import ConfidenceEstimator, confidence_modes
+from lazy_imports import lazy_import
+from nnet3_model import initNnetFeatPipeline, load_model
+from kaldi.online2 import OnlineIvectorExtractorAdaptationState
+
+
+# Decode every wav of the scp as one utterance, returns a list of (key, output with text and lattice)
+def decode_scp(asr, feat_info, decodable_opts, scp, chunk_size):
+    SequentialWaveReader = lazy_import('kaldi.util.table').SequentialWaveReader
+    adaptation_state = OnlineIvectorExtractorAdaptationState.from_info(feat_info.ivector_extractor_info)
+    outputs = []
+    for key, wav in SequentialWaveReader(scp):
+        feat_pipeline, sil_weighting = initNnetFeatPipeline(adaptation_state, asr, decodable_opts, feat_info)
+        data = wav.data()[0]
+        for i in range(0, len(data), chunk_size):
+            feat_pipeline.accept_waveform(wav.samp_freq, data[i:i + chunk_size])
+            if i + chunk_size >= len(data):
+                feat_pipeline.input_finished()
+            asr.advance_decoding()
+        asr.finalize_decoding()
+        out = asr.get_output()
+        print(key, 'lattice states:', out["lattice"].num_states(), 'words:', len(out["text"].split()))
+        outputs.append((key, out))
+    return outputs
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the confidence modes against MBR on the full lattice')
+    parser.add_argument('-y', '--yaml-config', dest='yaml_config', help='Path to the yaml model config', type=str, default='models/kaldi_tuda_de_nnet3_chain2.yaml')
+    parser.add_argument('-o', '--online-config', dest='online_config', help='Path to the Kaldi online config', type=str,
+                        default='models/kaldi_tuda_de_nnet3_chain2.online.conf')
+    parser.add_argument('-i', '--input', dest='input', help='Input scp', type=str, default='scp:wav.scp')
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', help='Samples per decoding chunk', type=int, default=1024)
+    parser.add_argument('-m', '--modes', dest='modes', help='Confidence modes to benchmark', nargs='+', choices=confidence_modes, default=confidence_modes)
+    parser.add_argument('--confidence-beam', dest='confidence_beam', help='Lattice beam of the pruned and capped modes', type=float, nargs='+', default=[6.0])
+    parser.add_argument('--confidence-max-states', dest='confidence_max_states', help='Maximum lattice size of the capped mode', type=int, default=5000)
+    parser.add_argument('-r', '--repeat', dest='repeat', help='Number of measurements per mode and utterance (the fastest counts)', type=int, default=3)
+    args = parser.parse_args()
+
+    asr, feat_info, decodable_opts, session_opts = load_model(args.yaml_config, args.online_config)
+    outputs = decode_scp(asr, feat_info, decodable_opts, args.input, args.chunk_size)
+
+    # The reference: MBR on the full lattice
+    reference = [ConfidenceEstimator('full').estimate({'text': out["text"], 'lattice': out["lattice"].copy()}) for key, out in outputs]
+
+    print('%-8s %6s %10s %10s %14s %14s %10s' % ('mode', 'beam', 'mean (ms)', 'max (ms)', 'mean abs err', 'max abs err', 'fallbacks'))
+    for mode in args.modes:
+        for beam in (args.confidence_beam if mode in ['pruned', 'capped'] else [None]):
+            times, errors, fallbacks = [], [], 0
+            for (key, out), ref in zip(outputs, reference):
+                best_secs = None
+                for _ in range(args.repeat):
+                    # every measurement gets its own copy, pruning modifies the lattice
+                    estimator = ConfidenceEstimator(mode, beam=beam if beam is not None else 6.0, max_states=args.confidence_max_states)
+                    confd = estimator.estimate({'text': out["text"], 'lattice': out["lattice"].copy()})
+                    best_secs = estimator.total_secs if best_secs is None else min(best_secs, estimator.total_secs)
+                fallbacks += estimator.fallbacks
+                times.append(best_secs)
+                # words whose confidence is missing in one of the lists are counted with the largest possible error
+                num_words = max(len(ref), len(confd))
+                ref_padded = np.pad(np.asarray(ref, dtype=np.float64), (0, num_words - len(ref)), constant_values=-1.0)
+                confd_padded = np.pad(np.asarray(confd, dtype=np.float64), (0, num_words - len(confd)), constant_values=2.0)
+                errors.extend(np.minimum(np.abs(ref_padded - confd_padded), 1.0))
+
+            print('%-8s %6s %10.2f %10.2f %14.4f %14.4f %10d' % (mode, '%.1f' % beam if beam is not None else '-', np.mean(times) * 1000.0,
+                                                                 np.max(times) * 1000.0, np.mean(errors) if errors else 0.0,
+                                                                 np.max(errors) if errors else 0.0, fallbacks))
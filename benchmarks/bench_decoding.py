@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reproducible benchmark of the decoding settings on a wav scp: sweeps --chunk_size, --frames_per_chunk, --beam_size,
+threaded vs. unthreaded decoding (-t) and the resample algorithms (-a) over two decode paths:
+    scp    decode_chunked_partial_endpointing on the scp, as fast as possible (throughput)
+    redis  the realtime decoding loop (nnet3_model.py -e) with the audio of the scp published to redis in real time
+           (latency), needs a running redis server
+Every setting is run in a fresh process, so that the peak RSS is the one of the setting (including the model). For every
+setting the real-time factor, the audio-to-partial and endpoint-to-final latency percentiles (redis path, see metrics.py)
+and the peak RSS are written as json. With --baseline, the results are compared to a previous run and settings that got
+worse by more than --tolerance are reported as regressions (exit status 1). Run from the repository root:
+python3 benchmarks/bench_decoding.py -y models/kaldi_tuda_de_nnet3_chain2.yaml -i scp:wav.scp -cs 1024 2048 -bs 5 10 --results results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resampler import make_resampler, resample_algorithms
+
+decode_paths = ['scp', 'redis']
+
+# The metrics of a setting that are compared to the baseline, lower is better for all of them. A metric only counts as a
+# regression if it also got worse by more than its floor, so that the noise of small values does not show up as a regression.
+compared_metrics = {'rtf': 0.01, 'partial_latency_p50': 0.005, 'partial_latency_p90': 0.005, 'partial_latency_p99': 0.005,
+                    'final_latency_p50': 0.005, 'final_latency_p90': 0.005, 'final_latency_p99': 0.005, 'peak_rss_mb': 10.0}
+
+percentiles = [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]
+
+result_prefix = 'BENCH_RESULT '
+
+
+# All settings of the sweep. The threads and resample settings only apply to the redis path.
+def sweep(args):
+    settings = []
+    for path in args.paths:
+        for chunk_size, frames_per_chunk, beam_size in itertools.product(args.chunk_size, args.frames_per_chunk, args.beam_size):
+            setting = {'path': path, 'chunk_size': chunk_size, 'frames_per_chunk': frames_per_chunk, 'beam_size': beam_size}
+            if path == 'scp':
+                settings.append(setting)
+                continue
+            for threads, resample in itertools.product(args.threads, args.resample_algorithm):
+                settings.append(dict(setting, threads=bool(threads), resample=resample))
+    return settings
+
+
+# Stable name of a setting, used to match the results to the baseline
+def setting_name(setting):
+    return ' '.join('%s=%s' % (name, setting[name]) for name in sorted(setting))
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024.0 * 1024.0) if platform.system() == 'Darwin' else maxrss / 1024.0
+
+
+# The audio of the scp as int16 arrays (first channel), resampled to samp_freq if necessary
+def read_scp_audio(scp, samp_freq):
+    from lazy_imports import lazy_import
+    SequentialWaveReader = lazy_import('kaldi.util.table').SequentialWaveReader
+    audio = []
+    for key, wav in SequentialWaveReader(scp):
+        data = np.clip(np.rint(wav.data().numpy()[0]), -32768, 32767).astype(np.int16)
+        if int(wav.samp_freq) != samp_freq:
+            data = np.array(make_resampler('polyphase', int(wav.samp_freq), samp_freq).process(data))
+        audio.append(data)
+    return audio
+
+
+# Decode the scp with decode_chunked_partial_endpointing, as fast as possible
+def run_scp_setting(args, setting, asr, feat_info, decodable_opts):
+    from nnet3_model import decode_chunked_partial_endpointing
+    audio_secs = sum(len(data) for data in read_scp_audio(args.input, args.decode_samplerate)) / args.decode_samplerate
+
+    results = []
+    start = time.perf_counter()
+    decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, args.input, chunk_size=setting['chunk_size'],
+                                       results=results, confidence_opts={'mode': args.confidence_mode})
+    wall_secs = time.perf_counter() - start
+    return {'audio_secs': audio_secs, 'wall_secs': wall_secs, 'rtf': wall_secs / audio_secs, 'utterances': len(results)}
+
+
+# Publish the audio to the audio channel of the decoder in real time (times speed), in packets of packet_size samples.
+# The packets are paced by their deadlines, so that the time needed for publishing does not add up. Once the decoder has
+# decoded all full chunks of the audio (or after a timeout), it is shut down.
+def feed_audio(red, audio, samp_freq, packet_size, speed, audio_data_channel, decode_control_channel, decoded_secs, drain_timeout=10.0):
+    from metrics import metrics
+    # wait until the decoder listens on the audio channel
+    while red.pubsub_numsub(audio_data_channel)[0][1] == 0:
+        time.sleep(0.01)
+
+    signal = np.concatenate(audio)
+    start = time.monotonic()
+    for i in range(0, len(signal), packet_size):
+        deadline = start + i / samp_freq / speed
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        red.publish(audio_data_channel, signal[i:i + packet_size].tobytes())
+
+    timeout = time.monotonic() + drain_timeout
+    while metrics.audio_secs < decoded_secs and time.monotonic() < timeout:
+        time.sleep(0.05)
+    red.publish(decode_control_channel, 'shutdown')
+
+
+# Decode the audio of the scp with the realtime decoding loop, fed from redis
+def run_redis_setting(args, setting, asr, feat_info, decodable_opts, red=None, audio=None):
+    from metrics import metrics
+    from nnet3_model import ASRRedisClient, decode_chunked_partial_endpointing_mic
+    if red is None:
+        import redis
+        red = redis.StrictRedis(host=args.redis_server)
+
+    # With resampling, the audio is published at --record-samplerate. The chunk size is scaled with the samplerate, so that
+    # the decoded chunks have the same duration with and without resampling.
+    resample = setting['resample'] != 'none'
+    record_samplerate = args.record_samplerate if resample else args.decode_samplerate
+    chunk_size = setting['chunk_size'] * record_samplerate // args.decode_samplerate
+    if audio is None:
+        audio = read_scp_audio(args.input, record_samplerate)
+    num_samples = sum(len(data) for data in audio)
+    # the last incomplete chunk stays in the buffers of the audio ingest
+    decoded_secs = (num_samples - num_samples % chunk_size) / record_samplerate
+
+    # Channel names of this process, so that the benchmark does not interfere with running decoders
+    suffix = '_bench_%d' % os.getpid()
+    asr_client = ASRRedisClient(red, server=args.redis_server, channel='asr' + suffix)
+    feeder = threading.Thread(target=feed_audio, args=(red, audio, record_samplerate, args.packet_size, args.speed, 'asr_audio' + suffix,
+                                                       'asr_control' + suffix, decoded_secs))
+    feeder.start()
+    start = time.perf_counter()
+    decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts, None, 0, samp_freq=args.decode_samplerate,
+                                           record_samplerate=record_samplerate, chunk_size=chunk_size, asr_client=asr_client,
+                                           resample_algorithm=setting['resample'] if resample else 'polyphase', use_threads=setting['threads'],
+                                           use_local_mic=False, decode_control_channel='asr_control' + suffix, audio_data_channel='asr_audio' + suffix,
+                                           confidence_opts={'mode': args.confidence_mode})
+    wall_secs = time.perf_counter() - start
+    feeder.join()
+    asr_client.close()
+
+    result = {'audio_secs': metrics.audio_secs, 'wall_secs': wall_secs, 'rtf': metrics.busy_secs / max(metrics.audio_secs, 1e-9),
+              'utterances': metrics.endpoint_to_final.count, 'partials': metrics.audio_to_partial.count}
+    for histogram, name in [(metrics.audio_to_partial, 'partial_latency'), (metrics.endpoint_to_final, 'final_latency')]:
+        for (label, q), value in zip(percentiles, histogram.quantiles([q for label, q in percentiles])):
+            result[name + '_' + label] = value
+    return result
+
+
+# Runs one setting in this process (the child process of the sweep)
+def run_setting(args, setting):
+    from nnet3_model import load_model
+    asr, feat_info, decodable_opts, session_opts = load_model(args.yaml_config, args.online_config, beam_size=setting['beam_size'],
+                                                              frames_per_chunk=setting['frames_per_chunk'], bundle_dir=args.bundle)
+    if setting['path'] == 'scp':
+        result = run_scp_setting(args, setting, asr, feat_info, decodable_opts)
+    else:
+        result = run_redis_setting(args, setting, asr, feat_info, decodable_opts)
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+# Runs every setting repeat times in a fresh process, the median of each metric counts
+def run_sweep(args, settings):
+    results = []
+    for setting in settings:
+        print('Running', setting_name(setting), flush=True)
+        runs = []
+        for _ in range(args.repeat):
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-setting', json.dumps(setting)] + sys.argv[1:],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+            lines = [line for line in proc.stdout.splitlines() if line.startswith(result_prefix)]
+            if proc.returncode != 0 or not lines:
+                print('Setting failed with exit status %d, last output:' % proc.returncode)
+                print('\n'.join(proc.stdout.splitlines()[-20:]))
+                break
+            runs.append(json.loads(lines[-1][len(result_prefix):]))
+        if not runs:
+            continue
+
+        result = dict(setting, setting=setting_name(setting), runs=len(runs))
+        for metric in runs[0]:
+            values = [run[metric] for run in runs if run[metric] is not None]
+            result[metric] = float(np.median(values)) if values else None
+        print(json.dumps(result), flush=True)
+        results.append(result)
+    return results
+
+
+# Settings whose metrics got worse than in the baseline by more than the tolerance (and the floor of the metric)
+def find_regressions(results, baseline, tolerance):
+    baseline_results = {result['setting']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = baseline_results.get(result['setting'])
+        if base is None:
+            continue
+        for metric, floor in compared_metrics.items():
+            value, base_value = result.get(metric), base.get(metric)
+            if value is None or base_value is None:
+                continue
+            if value > base_value * (1.0 + tolerance) and value - base_value > floor:
+                regressions.append({'setting': result['setting'], 'metric': metric, 'baseline': base_value, 'value': value})
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reproducible benchmark of the decoding settings on a wav scp')
+    parser.add_argument('-y', '--yaml-config', dest='yaml_config', help='Path to the yaml model config', type=str, default='models/kaldi_tuda_de_nnet3_chain2.yaml')
+    parser.add_argument('-o', '--online-config', dest='online_config', help='Path to the Kaldi online config', type=str,
+                        default='models/kaldi_tuda_de_nnet3_chain2.online.conf')
+    parser.add_argument('--bundle', dest='bundle', help='Load the model from this precompiled bundle (see nnet3_model.py --prepare-bundle)', type=str, default=None)
+    parser.add_argument('-i', '--input', dest='input', help='Input scp', type=str, default='scp:wav.scp')
+    parser.add_argument('-p', '--paths', dest='paths', help='Decode paths to benchmark', nargs='+', choices=decode_paths, default=decode_paths)
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', help='Samples per decoding chunk (at the decode samplerate)', type=int, nargs='+', default=[1024])
+    parser.add_argument('-fpc', '--frames_per_chunk', dest='frames_per_chunk', help='Frames per chunk of the nnet3 computation', type=int, nargs='+', default=[50])
+    parser.add_argument('-bs', '--beam_size', dest='beam_size', help='Beam size of the decoder', type=int, nargs='+', default=[10])
+    parser.add_argument('-t', '--threads', dest='threads', help='Unthreaded (0) and/or threaded (1) decoding, redis path only', type=int, nargs='+',
+                        choices=[0, 1], default=[0, 1])
+    parser.add_argument('-a', '--resample-algorithm', dest='resample_algorithm', help='Resample algorithms (none = no resampling), redis path only',
+                        nargs='+', choices=['none'] + resample_algorithms, default=['none'])
+    parser.add_argument('-r', '--record-samplerate', dest='record_samplerate', help='Samplerate of the published audio if it is resampled',
+                        type=int, default=48000)
+    parser.add_argument('-ds', '--decode-samplerate', dest='decode_samplerate', help='Samplerate of the model', type=int, default=16000)
+    parser.add_argument('--confidence-mode', dest='confidence_mode', help='Confidence mode of the final utterances (see confidences.py)', type=str, default='full')
+    parser.add_argument('--speed', dest='speed', help='Publish the audio this many times faster than real time (redis path)', type=float, default=1.0)
+    parser.add_argument('--packet-size', dest='packet_size', help='Samples per published audio packet (redis path)', type=int, default=4096)
+    parser.add_argument('--redis-server', dest='redis_server', help='Redis server for the redis path', type=str, default='localhost')
+    parser.add_argument('-n', '--repeat', dest='repeat', help='Number of runs per setting (the median counts)', type=int, default=1)
+    parser.add_argument('--results', dest='results', help='Write the results to this json file', type=str, default='bench_decoding.json')
+    parser.add_argument('-b', '--baseline', dest='baseline', help='Compare the results to this json file of a previous run', type=str, default=None)
+    parser.add_argument('--tolerance', dest='tolerance', help='Relative increase of a metric that counts as a regression', type=float, default=0.1)
+    parser.add_argument('--run-setting', dest='run_setting', help=argparse.SUPPRESS, type=str, default=None)
+    args = parser.parse_args()
+
+    if args.run_setting is not None:
+        print(result_prefix + json.dumps(run_setting(args, json.loads(args.run_setting))), flush=True)
+        sys.exit(0)
+
+    results = run_sweep(args, sweep(args))
+    with open(args.results, 'w') as results_file:
+        json.dump({'input': args.input, 'yaml_config': args.yaml_config, 'host': platform.node(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'results': results}, results_file, indent=2)
+    print('Wrote', len(results), 'results to', args.results)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION %(setting)s: %(metric)s %(baseline).4f -> %(value).4f' % regression)
+        print(len(regressions), 'regressions compared to', args.baseline)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the memory per idle event stream connection (/stream) of the Flask event server (event_server.py, one thread
+per connection) and the asyncio event server (event_server_async.py). Every server is started as a subprocess, then -n
+idle connections are opened and the resident memory and the number of threads of the server (including its child
+processes, e.g. the Flask reloader) are compared to the server with a single connection. Needs a running redis server
+and Linux (/proc). Run from the repository root:
+python3 benchmarks/bench_idle_connections.py -n 100 1000 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+server_commands = {'flask': ['event_server.py'], 'async': ['event_server_async.py']}
+
+
+def child_pids(pid):
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as stat_file:
+                # the command name in parentheses may contain spaces, the parent pid is the second field after it
+                ppid = int(stat_file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            children.append(int(entry))
+    return children
+
+
+# Resident memory (kB) and number of threads of a process and all its descendants
+def process_tree_usage(pid):
+    rss_kb, threads = 0, 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open('/proc/%d/status' % current) as status_file:
+                for line in status_file:
+                    if line.startswith('VmRSS:'):
+                        rss_kb += int(line.split()[1])
+                    elif line.startswith('Threads:'):
+                        threads += int(line.split()[1])
+        except OSError:
+            continue
+        pending.extend(child_pids(current))
+    return rss_kb, threads
+
+
+def wait_for_port(host, port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1.0).close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+# Opens an event stream connection and waits for the greeting of the server, returns the writer to close it later
+async def open_stream(host, port, semaphore, timeout=30.0):
+    async with semaphore:
+        reader, writer = await asyncio.open_connection(host, port)
+        writer.write(b'GET /stream HTTP/1.1\r\nHost: %s\r\nAccept: text/event-stream\r\n\r\n' % host.encode('ascii'))
+        await writer.drain()
+        await asyncio.wait_for(reader.readuntil(b'hello'), timeout)
+        return reader, writer
+
+
+async def measure_connections(host, port, pid, num_connections, settle_secs, max_concurrent_connects):
+    semaphore = asyncio.Semaphore(max_concurrent_connects)
+    start = time.monotonic()
+    connections = await asyncio.gather(*[open_stream(host, port, semaphore) for _ in range(num_connections)], return_exceptions=True)
+    connect_secs = time.monotonic() - start
+    failed = sum(1 for connection in connections if isinstance(connection, BaseException))
+    if failed > 0:
+        print('%d connections failed, e.g.:' % failed, next(connection for connection in connections if isinstance(connection, BaseException)))
+
+    await asyncio.sleep(settle_secs)
+    rss_kb, threads = process_tree_usage(pid)
+
+    for connection in connections:
+        if not isinstance(connection, BaseException):
+            connection[1].close()
+    await asyncio.sleep(settle_secs)
+    return {'connections': num_connections - failed, 'failed': failed, 'rss_kb': rss_kb, 'threads': threads, 'connect_secs': round(connect_secs, 3)}
+
+
+def bench_server(server, args):
+    command = [sys.executable] + server_commands[server]
+    if server == 'async':
+        command += ['-p', str(args.port), '-rs', args.redis_server]
+    process = subprocess.Popen(command, cwd=repo_root, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        if not wait_for_port(args.host, args.port):
+            print('Server', server, 'did not start')
+            return results
+        # the reference is the server with one connection, which also starts the redis subscriber
+        baseline = asyncio.run(measure_connections(args.host, args.port, process.pid, 1, args.settle, args.max_concurrent_connects))
+        for num_connections in args.connections:
+            result = asyncio.run(measure_connections(args.host, args.port, process.pid, num_connections, args.settle, args.max_concurrent_connects))
+            added = max(result['connections'] - baseline['connections'], 1)
+            result.update({'server': server, 'kb_per_connection': round((result['rss_kb'] - baseline['rss_kb']) / added, 2),
+                           'baseline_rss_kb': baseline['rss_kb']})
+            print('%-6s %12d %8d %12.1f %16.2f %8d %12.2f' % (server, result['connections'], result['failed'], result['rss_kb'] / 1024.0,
+                                                           result['kb_per_connection'], result['threads'], result['connect_secs']), flush=True)
+            results.append(result)
+    finally:
+        process.terminate()
+        process.wait()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory per idle event stream connection of the Flask and the asyncio event server')
+    parser.add_argument('-s', '--servers', dest='servers', help='Event servers to benchmark', nargs='+', choices=list(server_commands),
+                        default=list(server_commands))
+    parser.add_argument('-n', '--connections', dest='connections', help='Numbers of idle connections to measure', type=int, nargs='+', default=[100, 1000])
+    parser.add_argument('--host', dest='host', help='Host of the event server', type=str, default='127.0.0.1')
+    parser.add_argument('-p', '--port', dest='port', help='Port of the event server (the Flask event server always uses 5000)', type=int, default=5000)
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the server (for redis-server)', type=str, default='localhost')
+    parser.add_argument('--settle', dest='settle', help='Seconds to wait before measuring', type=float, default=2.0)
+    parser.add_argument('--max-concurrent-connects', dest='max_concurrent_connects', help='Connections that are opened at the same time', type=int, default=100)
+    parser.add_argument('--results', dest='results', help='Write the results to this json file', type=str, default=None)
+    args = parser.parse_args()
+
+    # every connection needs a file descriptor, here and in the server
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    if hard < max(args.connections) + 100:
+        print('WARNING: the open file limit (%d) is too low for %d connections, raise it with ulimit -n' % (hard, max(args.connections)))
+
+    print('%-6s %12s %8s %12s %16s %8s %12s' % ('server', 'connections', 'failed', 'rss (MB)', 'kB/connection', 'threads', 'connect (s)'))
+    results = []
+    for server in args.servers:
+        results += bench_server(server, args)
+
+    if args.results is not None:
+        with open(args.results, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the streaming resamplers (-a): the polyphase resampler vs. the libsamplerate converters (if the samplerate
+package is installed). For every algorithm, the time per block, the realtime factor (processing time / audio time)
+and the SNR of a resampled 1 kHz sine are reported. Run from the repository root: python3 benchmarks/bench_resampler.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from resampler import make_resampler, resample_algorithms
+
+
+def bench(algorithm, in_rate, out_rate, chunk_size, secs):
+    try:
+        resampler = make_resampler(algorithm, in_rate, out_rate)
+    except ImportError:
+        return None
+
+    num_samples = int(in_rate * secs)
+    signal = (np.sin(2 * np.pi * 1000.0 * np.arange(num_samples) / in_rate) * 10000).astype(np.int16)
+    blocks = [signal[i:i + chunk_size] for i in range(0, num_samples - chunk_size + 1, chunk_size)]
+
+    outputs = []
+    start = time.perf_counter()
+    for block in blocks:
+        outputs.append(np.array(resampler.process(block)))
+    elapsed = time.perf_counter() - start
+
+    # SNR against the best fitting 1 kHz sine (any amplitude and phase, so that the delay of the resampler does not matter),
+    # the first second is skipped
+    out = np.concatenate(outputs).astype(np.float64)[out_rate:]
+    phase = 2 * np.pi * 1000.0 * np.arange(len(out)) / out_rate
+    basis = np.stack([np.sin(phase), np.cos(phase)], axis=1)
+    fit = basis @ np.linalg.lstsq(basis, out, rcond=None)[0]
+    snr = 10.0 * np.log10(np.mean(fit ** 2) / np.mean((out - fit) ** 2))
+
+    return elapsed / len(blocks) * 1e6, elapsed / secs, snr
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the streaming resamplers')
+    parser.add_argument('-cs', '--chunk_size', dest='chunk_size', help='Samples per block at the recording samplerate', type=int, default=1024)
+    parser.add_argument('-s', '--secs', dest='secs', help='Seconds of audio per measurement', type=float, default=10.0)
+    parser.add_argument('-d', '--decode-samplerate', dest='decode_samplerate', help='Decoding samplerate', type=int, default=16000)
+    parser.add_argument('-r', '--record-samplerates', dest='record_samplerates', help='Recording samplerates to benchmark',
+                        type=int, nargs='+', default=[48000, 44100])
+    args = parser.parse_args()
+
+    print('%8s %16s %14s %14s %10s' % ('rate', 'algorithm', 'us/block', 'realtime', 'SNR (dB)'))
+    for in_rate in args.record_samplerates:
+        for algorithm in resample_algorithms:
+            result = bench(algorithm, in_rate, args.decode_samplerate, args.chunk_size, args.secs)
+            if result is None:
+                print('%8d %16s %14s' % (in_rate, algorithm, 'not installed'))
+                continue
+            us_per_block, realtime, snr = result
+            print('%8d %16s %14.1f %14.5f %10.1f' % (in_rate, algorithm, us_per_block, realtime, snr))
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Selection of the active speaker channel in multichannel recordings (one microphone per speaker).
+The energies of all channels are computed in one vectorized pass over the interleaved int16 block, after a conversion
+to float32 into a reused scratch buffer (no allocations per chunk, and much faster than summing in int64/float64).
+Optionally the channel volumes are smoothed over time and a new channel has to be louder than the current one by
+a margin (hysteresis), so that the selection does not flicker between two speakers.
+"""
+
+import numpy as np
+
+
+# Keeps the state of the selection (current channel, smoothed volumes) of one multichannel stream.
+# smoothing is the weight of the previous volumes (exponential moving average, 0 = no smoothing), hysteresis_db
+# is how much louder (in dB) another channel must be than the current one to be selected. volume_scale scales the volumes,
+# sqrt(decode samplerate / record samplerate) if the selection is done before resampling, so that mic_vol_cutoff
+# keeps its meaning (the L2 norm grows with the number of samples in the chunk).
+class ChannelSelector():
+
+    def __init__(self, channels, mic_vol_cutoff=0.5, smoothing=0.0, hysteresis_db=0.0, volume_scale=1.0):
+        self.channels = channels
+        self.mic_vol_cutoff = mic_vol_cutoff
+        self.volume_scale = volume_scale * 10.0 / 65536.0
+        self.smoothing = smoothing
+        self.hysteresis = 10.0 ** (hysteresis_db / 20.0)
+
+        self.volumes = np.zeros(channels)
+        self.scratch = None
+        self.channel = 0
+        self.switches = 0
+
+    # Volume of every channel: the L2 norm of the chunk (as in the original per channel loop, scaled by 10/65536).
+    # This is a simplyfied concept of loudness and has nothing to do with the physical loudness.
+    def channel_volumes(self, block):
+        frames = np.reshape(block, (-1, self.channels))
+        if self.scratch is None or self.scratch.shape != frames.shape:
+            self.scratch = np.empty(frames.shape, dtype=np.float32)
+        np.copyto(self.scratch, frames)
+        energies = np.einsum('ij,ij->j', self.scratch, self.scratch)
+        return np.sqrt(energies, dtype=np.float64) * self.volume_scale
+
+    # Returns the block of the selected channel (a view, not a copy), the channel index and
+    # if any channel is louder than mic_vol_cutoff. During silence, the current channel is kept.
+    def select(self, block):
+        volumes = self.channel_volumes(block)
+        if self.smoothing > 0.0:
+            self.volumes = self.smoothing * self.volumes + (1.0 - self.smoothing) * volumes
+        else:
+            self.volumes = volumes
+
+        loudest = int(np.argmax(self.volumes))
+        has_volume = self.volumes[loudest] >= self.mic_vol_cutoff
+
+        if has_volume and loudest != self.channel and self.volumes[loudest] > self.volumes[self.channel] * self.hysteresis:
+            self.channel = loudest
+            self.switches += 1
+
+        return np.reshape(block, (-1, self.channels))[:, self.channel], self.channel, bool(has_volume)
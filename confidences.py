@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Word confidences of final utterances with a bounded cost (--confidence-mode). MBR on the full lattice is exact, but its
+cost grows with the size of the lattice, i.e. with the length of the utterance. The other modes trade accuracy of the
+confidences for a predictable finalize time:
+    full    MBR on the full lattice (default, as before)
+    pruned  prune the lattice to --confidence-beam before MBR
+    capped  MBR on the full lattice, unless it has more than --confidence-max-states states: then it is pruned with a
+            tighter and tighter beam until it is small enough (or confidences of 1.0 are used if it is still too large)
+    none    no MBR, all words get a confidence of 1.0
+Compare the modes on a wav.scp with benchmarks/bench_confidences.py.
+"""
+
+import time
+
+from kaldi.lat.functions import prune_compact_lattice
+from kaldi.lat.sausages import MinimumBayesRisk
+
+confidence_modes = ['full', 'pruned', 'capped', 'none']
+
+
+# Computes the confidences of the final utterances of one session (or decoding loop) and keeps timing statistics.
+# The lattice of the output (a CompactLattice) is pruned in place.
+class ConfidenceEstimator():
+
+    def __init__(self, mode='full', beam=6.0, max_states=5000, min_beam=0.5):
+        if mode not in confidence_modes:
+            raise ValueError('Unknown confidence mode: %s (available: %s)' % (mode, ', '.join(confidence_modes)))
+        self.mode = mode
+        self.beam = beam
+        self.max_states = max_states
+        self.min_beam = min_beam
+
+        self.utterances = 0
+        self.total_secs = 0.0
+        self.max_secs = 0.0
+        self.pruned = 0
+        self.fallbacks = 0
+
+    # Word confidences for out, the output of the recognizer (out["text"] is the best path, out["lattice"] the lattice)
+    def estimate(self, out):
+        start = time.perf_counter()
+        lattice = out["lattice"]
+
+        if self.mode == 'pruned':
+            prune_compact_lattice(self.beam, lattice)
+            self.pruned += 1
+        elif self.mode == 'capped':
+            lattice = self.cap_lattice(lattice)
+
+        if lattice is None or self.mode == 'none':
+            confd = [1.0] * len(out["text"].split())
+        else:
+            confd = MinimumBayesRisk(lattice).get_one_best_confidences()
+
+        secs = time.perf_counter() - start
+        self.utterances += 1
+        self.total_secs += secs
+        self.max_secs = max(self.max_secs, secs)
+        return confd
+
+    # Prune the lattice with a tighter beam each time, until it has at most max_states states. None if that is not possible.
+    def cap_lattice(self, lattice):
+        if lattice.num_states() <= self.max_states:
+            return lattice
+
+        self.pruned += 1
+        beam = self.beam
+        while beam >= self.min_beam:
+            prune_compact_lattice(beam, lattice)
+            if lattice.num_states() <= self.max_states:
+                return lattice
+            beam /= 2.0
+
+        self.fallbacks += 1
+        return None
+
+    def stats(self):
+        return {'mode': self.mode, 'utterances': self.utterances, 'total_secs': round(self.total_secs, 3),
+                'mean_ms': round(self.total_secs * 1000.0 / max(self.utterances, 1), 2), 'max_ms': round(self.max_secs * 1000.0, 2),
+                'pruned': self.pruned, 'fallbacks': self.fallbacks}
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A pipeline of processing stages, every stage runs in its own thread and is connected to the next one by a bounded queue.
+If a stage can not keep up, its queue fills up and the previous stage blocks (backpressure), nothing is dropped.
+Used by the realtime decoding loop with -t: capture -> resampling/channel selection -> feature extraction and decoding.
+OrderedWorker runs jobs one after another in a background thread, e.g. the publishing of results (--async-finalize).
+"""
+
+import queue
+import threading
+import time
+import traceback
+
+# Marks the end of the input, it is passed on from stage to stage
+end_of_stream = object()
+
+
+# One stage of the pipeline. process(item) is called for every item of the input queue, its result is passed on
+# to the next stage (None results are not passed on).
+class PipelineStage(threading.Thread):
+
+    def __init__(self, name, process, next_stage=None, max_queue_size=8):
+        super().__init__(daemon=True, name=name)
+        self.stage_name = name
+        self.process = process
+        self.next_stage = next_stage
+        self.queue = queue.Queue(maxsize=max_queue_size)
+
+        self.items_processed = 0
+        self.busy_secs = 0.0
+        self.max_depth = 0
+        self.blocked_puts = 0
+        self.error = None
+
+    def depth(self):
+        return self.queue.qsize()
+
+    # Blocks if the queue is full, until this stage has caught up
+    def put(self, item):
+        if self.queue.full():
+            self.blocked_puts += 1
+        self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is end_of_stream:
+                break
+
+            # After an error we keep consuming (and discard) the input, so that the previous stages do not block forever
+            if self.error is not None:
+                continue
+
+            start = time.perf_counter()
+            try:
+                result = self.process(item)
+            except Exception as e:
+                print('Error in pipeline stage', self.stage_name + ':', e)
+                traceback.print_exc()
+                self.error = e
+                continue
+            self.busy_secs += time.perf_counter() - start
+            self.items_processed += 1
+
+            if result is not None and self.next_stage is not None:
+                self.next_stage.put(result)
+
+        if self.next_stage is not None:
+            self.next_stage.put(end_of_stream)
+
+    def stats(self):
+        return {'depth': self.depth(), 'max_depth': self.max_depth, 'blocked_puts': self.blocked_puts,
+                'items': self.items_processed, 'busy_secs': round(self.busy_secs, 3)}
+
+
+# Chain of stages, given as a list of (name, process) in processing order. Items are put into the first stage.
+class DecodePipeline():
+
+    def __init__(self, stages, max_queue_size=8):
+        self.stages = []
+        next_stage = None
+        for name, process in reversed(stages):
+            next_stage = PipelineStage(name, process, next_stage=next_stage, max_queue_size=max_queue_size)
+            self.stages.insert(0, next_stage)
+
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item):
+        self.stages[0].put(item)
+
+    def failed(self):
+        return any(stage.error is not None for stage in self.stages)
+
+    def depths(self):
+        return {stage.stage_name: stage.depth() for stage in self.stages}
+
+    def stats(self):
+        return {stage.stage_name: stage.stats() for stage in self.stages}
+
+    # Process all items that are still queued and stop the stage threads
+    def close(self):
+        self.put(end_of_stream)
+        for stage in self.stages:
+            stage.join()
+
+
+# Runs callables in the order they were submitted, in its own thread. Unlike a pipeline stage, an error in one job is printed
+# and the worker continues with the next one. submit() blocks if max_queue_size jobs are waiting (backpressure).
+class OrderedWorker(threading.Thread):
+
+    def __init__(self, name='worker', max_queue_size=256):
+        super().__init__(daemon=True, name=name)
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.jobs_done = 0
+        self.jobs_failed = 0
+        self.max_depth = 0
+        self.start()
+
+    def in_worker(self):
+        return threading.current_thread() is self
+
+    def submit(self, fn, *args):
+        self.queue.put((fn, args))
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is end_of_stream:
+                    break
+                fn, args = job
+                fn(*args)
+                self.jobs_done += 1
+            except Exception as e:
+                print('Error in', self.name + ':', e)
+                traceback.print_exc()
+                self.jobs_failed += 1
+            finally:
+                self.queue.task_done()
+
+    # Wait until all jobs submitted so far are done
+    def flush(self):
+        if self.is_alive():
+            self.queue.join()
+
+    def close(self):
+        if self.is_alive():
+            self.queue.put(end_of_stream)
+            self.join()
+
+    def stats(self):
+        return {'depth': self.queue.qsize(), 'max_depth': self.max_depth, 'jobs': self.jobs_done, 'failed': self.jobs_failed}
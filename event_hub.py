@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Fan-out of a redis channel to many event stream clients (browsers) of the event server. A ChannelHub subscribes to the
+channel once, with one redis connection and one thread, converts every message once into an event stream frame and puts
+the frame into a bounded queue per client. A client that does not read its frames fast enough (e.g. a slow network)
+either loses its oldest frames (slow_client_policy 'drop-oldest') or is disconnected ('disconnect'), so that it can not
+hold up the other clients or grow without bound. Browsers reconnect automatically (EventSource).
+
+The AsyncChannelHub does the same inside an asyncio event loop (event_server_async.py): the subscriber is a task instead of
+a thread and the clients wait on their queues without a thread each. Its frames are the json messages, without the event
+stream framing, so that they can be sent over websockets as well.
+"""
+
+import asyncio
+import collections
+import threading
+import time
+
+from message_codec import to_json
+
+slow_client_policies = ['drop-oldest', 'disconnect']
+
+
+# The queue of frames of one client. put is called by the hub thread and never blocks, get by the thread serving the client.
+class ClientQueue():
+
+    def __init__(self, max_size=256, slow_client_policy='drop-oldest'):
+        self.frames = collections.deque()
+        self.max_size = max_size
+        self.slow_client_policy = slow_client_policy
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    # Returns False if the client was disconnected because it is too slow (or is already closed)
+    def put(self, frame):
+        with self.condition:
+            if self.closed:
+                return False
+            if len(self.frames) >= self.max_size:
+                if self.slow_client_policy == 'disconnect':
+                    self.closed = True
+                    self.condition.notify()
+                    return False
+                self.frames.popleft()
+                self.dropped += 1
+            self.frames.append(frame)
+            self.condition.notify()
+            return True
+
+    # The next frame, None after timeout seconds without a frame or if the queue is closed (and empty)
+    def get(self, timeout=None):
+        with self.condition:
+            if not self.frames and not self.closed:
+                self.condition.wait(timeout)
+            if self.frames:
+                return self.frames.popleft()
+            return None
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+
+# The queue of frames of one client of the AsyncChannelHub, put and get are called in the event loop
+class AsyncClientQueue():
+
+    def __init__(self, max_size=256, slow_client_policy='drop-oldest'):
+        self.frames = collections.deque()
+        self.max_size = max_size
+        self.slow_client_policy = slow_client_policy
+        self.ready = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+
+    def put(self, frame):
+        if self.closed:
+            return False
+        if len(self.frames) >= self.max_size:
+            if self.slow_client_policy == 'disconnect':
+                self.close()
+                return False
+            self.frames.popleft()
+            self.dropped += 1
+        self.frames.append(frame)
+        self.ready.set()
+        return True
+
+    async def get(self, timeout=None):
+        if not self.frames and not self.closed:
+            try:
+                await asyncio.wait_for(self.ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.ready.clear()
+        if self.frames:
+            if len(self.frames) > 1:
+                self.ready.set()
+            return self.frames.popleft()
+        return None
+
+    def close(self):
+        self.closed = True
+        self.ready.set()
+
+
+# One shared subscriber of a redis channel for all clients. The thread is started with the first client.
+class ChannelHub():
+
+    def __init__(self, red, channel, max_queue_size=256, slow_client_policy='drop-oldest', reconnect_delay=1.0):
+        if slow_client_policy not in slow_client_policies:
+            raise ValueError('Unknown slow client policy: %s (available: %s)' % (slow_client_policy, ', '.join(slow_client_policies)))
+        self.red = red
+        self.channel = channel
+        self.max_queue_size = max_queue_size
+        self.slow_client_policy = slow_client_policy
+        self.reconnect_delay = reconnect_delay
+
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.started = False
+
+        self.connections_total = 0
+        self.peak_clients = 0
+        self.messages = 0
+        self.frames_delivered = 0
+        self.frames_dropped = 0
+        self.slow_disconnects = 0
+
+    # A new client, its frames are read with get() on the returned queue. Call disconnect when the client is gone.
+    def connect(self, client=None):
+        client = client if client is not None else self.new_client()
+        with self.lock:
+            self.clients.add(client)
+            self.connections_total += 1
+            self.peak_clients = max(self.peak_clients, len(self.clients))
+            if not self.started:
+                self.started = True
+                self.start()
+        return client
+
+    def new_client(self):
+        return ClientQueue(self.max_queue_size, self.slow_client_policy)
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True, name='hub ' + self.channel).start()
+
+    def disconnect(self, client):
+        with self.lock:
+            self.clients.discard(client)
+        client.close()
+
+    # Event stream frame of a message of the channel. The decoders may publish msgpack, the browser always gets json.
+    def frame(self, data):
+        return b'data: %s\n\n' % to_json(data)
+
+    def publish(self, data):
+        frame = self.frame(data)
+        with self.lock:
+            clients = list(self.clients)
+            self.messages += 1
+        delivered = 0
+        for client in clients:
+            dropped, closed = client.dropped, client.closed
+            if client.put(frame):
+                delivered += 1
+                self.frames_dropped += client.dropped - dropped
+            else:
+                # a client that closed itself in the meantime is not a slow client
+                self.disconnect(client)
+                if not closed:
+                    self.slow_disconnects += 1
+        self.frames_delivered += delivered
+
+    # Subscribes to the channel and fans out its messages until the process exits, reconnects if redis goes away.
+    # The connection of a failed subscription is closed before reconnecting.
+    def run(self):
+        while True:
+            pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(self.channel)
+                print('Hub subscribed to channel:', self.channel)
+                for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.publish(message['data'])
+            except Exception as e:
+                print('Hub of channel', self.channel, 'lost its redis connection:', e)
+            finally:
+                pubsub.close()
+            time.sleep(self.reconnect_delay)
+
+    def stats(self):
+        with self.lock:
+            clients = len(self.clients)
+            queued = sum(len(client.frames) for client in self.clients)
+        return {'channel': self.channel, 'clients': clients, 'peak_clients': self.peak_clients, 'connections_total': self.connections_total,
+                'messages': self.messages, 'frames_delivered': self.frames_delivered, 'frames_dropped': self.frames_dropped,
+                'slow_disconnects': self.slow_disconnects, 'queued_frames': queued}
+
+
+# ChannelHub for an asyncio event loop, red is a redis.asyncio client. The subscriber task is started with the first client,
+# which has to connect from within the event loop.
+class AsyncChannelHub(ChannelHub):
+
+    def __init__(self, red, channel, max_queue_size=256, slow_client_policy='drop-oldest', reconnect_delay=1.0):
+        super().__init__(red, channel, max_queue_size=max_queue_size, slow_client_policy=slow_client_policy, reconnect_delay=reconnect_delay)
+        self.task = None
+
+    def new_client(self):
+        return AsyncClientQueue(self.max_queue_size, self.slow_client_policy)
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.listen())
+
+    # The json message, the event stream framing is added per client
+    def frame(self, data):
+        return to_json(data)
+
+    async def listen(self):
+        while True:
+            pubsub = self.red.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(self.channel)
+                print('Hub subscribed to channel:', self.channel)
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        self.publish(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print('Hub of channel', self.channel, 'lost its redis connection:', e)
+            finally:
+                await pubsub.aclose()
+            await asyncio.sleep(self.reconnect_delay)
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        for client in list(self.clients):
+            self.disconnect(client)
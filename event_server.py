@@ -13,6 +13,9 @@ import bs4
 import codecs
 import datetime
 
+from event_hub import ChannelHub
+from metrics import metrics_key, render_prometheus
+
 from werkzeug.serving import WSGIRequestHandler
 
 base_path = os.getcwd() + '/example/'
@@ -32,17 +35,32 @@ red = redis.StrictRedis()
 long_poll_timeout = 0.5
 long_poll_timeout_burst = 0.08
 
+# All event stream clients share one subscriber of the server channel (see event_hub.py). Every client has a queue of at most
+# client_queue_size messages, a client that falls further behind loses its oldest messages (or is disconnected, with the
+# 'disconnect' policy). A comment is sent after keepalive_interval seconds without messages, so that closed connections are noticed.
+client_queue_size = 256
+slow_client_policy = 'drop-oldest'
+keepalive_interval = 15.0
+
+hub = ChannelHub(red, server_channel, max_queue_size=client_queue_size, slow_client_policy=slow_client_policy)
+
 #Send event to the event stream
 def event_stream():
     print("New connection to event_stream!")
-    pubsub = red.pubsub()
-    pubsub.subscribe(server_channel)
-    yield b'hello'
-    for message in pubsub.listen():
-        if not message['type'] == 'subscribe':
-            #print('New message:', message)
-            #print(type(message['data']))
-            yield b'data: %s\n\n' % message['data']
+    client = hub.connect()
+    try:
+        yield b'hello'
+        while True:
+            frame = client.get(timeout=keepalive_interval)
+            if frame is not None:
+                yield frame
+            elif client.closed:
+                print("Closing event_stream of a slow client")
+                return
+            else:
+                yield b': keepalive\n\n'
+    finally:
+        hub.disconnect(client)
 
 @app.route('/reset')
 def reset():
@@ -80,6 +98,16 @@ def reset_timer():
     print("reset time called")
     return 'OK'
 
+#Latency and real-time factor metrics of all decoders in the Prometheus text format, the decoders write them to redis (see metrics.py)
+@app.route('/metrics')
+def metrics():
+    return flask.Response(render_prometheus(red.hgetall(metrics_key)), mimetype='text/plain; version=0.0.4')
+
+#Number of connected event stream clients, delivered and dropped messages
+@app.route('/stream_stats')
+def stream_stats():
+    return flask.jsonify(hub.stats())
+
 #Event stream end point for the browser, connection is left open. Must be used with threaded Flask.
 @app.route('/stream')
 def stream():
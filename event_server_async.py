@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asyncio (ASGI) version of the event server (event_server.py) for many concurrent viewers. It serves the same routes, but
+an open event stream is a coroutine waiting on its queue instead of a thread, so thousands of idle connections only cost
+a few kilobytes each. The messages of the asr channel are fanned out by one AsyncChannelHub (see event_hub.py), over
+server-sent events on /stream or a websocket on /ws. Text messages from a websocket client (start, stop, status, ...)
+are forwarded to the control channel, like the corresponding routes.
+
+This is a plain ASGI application without a web framework, run it with an ASGI server (pip3 install uvicorn):
+python3 event_server_async.py
+or: uvicorn event_server_async:app --host 0.0.0.0 --port 5000
+"""
+
+import argparse
+import asyncio
+import json
+import mimetypes
+import os
+
+from event_hub import AsyncChannelHub, slow_client_policies
+from lazy_imports import lazy_import
+from metrics import metrics_key, render_prometheus
+
+base_path = os.getcwd() + '/example/'
+
+# Routes that publish a command to the control channel, the command is the name of the route
+control_commands = ['reset', 'stop', 'start', 'shutdown', 'status', 'reset_timer']
+
+# Static files, route prefix -> directory (relative to base_path)
+static_dirs = {'/css/': 'css', '/js/': 'js', '/pics/': 'pics', '/fonts/': 'fonts'}
+
+
+class AsyncEventServer():
+
+    def __init__(self, redis_server='localhost', server_channel='asr', decode_control_channel='asr_control', client_queue_size=256,
+                 slow_client_policy='drop-oldest', keepalive_interval=15.0, red=None):
+        self.redis_server = redis_server
+        self.server_channel = server_channel
+        self.decode_control_channel = decode_control_channel
+        self.client_queue_size = client_queue_size
+        self.slow_client_policy = slow_client_policy
+        self.keepalive_interval = keepalive_interval
+        # the redis client and the hub are created in the event loop, with the first request (or on lifespan startup)
+        self.red = red
+        self.hub = None
+
+    def start(self):
+        if self.red is None:
+            self.red = lazy_import('redis.asyncio').StrictRedis(host=self.redis_server)
+        if self.hub is None:
+            self.hub = AsyncChannelHub(self.red, self.server_channel, max_queue_size=self.client_queue_size,
+                                       slow_client_policy=self.slow_client_policy)
+
+    async def stop(self):
+        if self.hub is not None:
+            self.hub.stop()
+        if self.red is not None:
+            await self.red.close()
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        self.start()
+        if scope['type'] == 'websocket':
+            if scope['path'] == '/ws':
+                await self.websocket(receive, send)
+            else:
+                await send({'type': 'websocket.close', 'code': 1000})
+            return
+        await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.stop()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        path = scope['path']
+        if path == '/stream':
+            await self.event_stream(receive, send)
+        elif path.lstrip('/') in control_commands:
+            command = path.lstrip('/')
+            await self.red.publish(self.decode_control_channel, command)
+            print(command, "called")
+            await respond(send, 200, b'OK')
+        elif path == '/metrics':
+            await respond(send, 200, render_prometheus(await self.red.hgetall(metrics_key)).encode('utf-8'), b'text/plain; version=0.0.4')
+        elif path == '/stream_stats':
+            await respond(send, 200, json.dumps(self.hub.stats()).encode('utf-8'), b'application/json')
+        elif path == '/':
+            await send_static_file(send, base_path, 'index.html')
+        else:
+            for prefix, directory in static_dirs.items():
+                if path.startswith(prefix):
+                    await send_static_file(send, base_path + directory, path[len(prefix):])
+                    return
+            await respond(send, 404, b'Not Found')
+
+    # Server-sent events of the asr channel, until the client disconnects (or is disconnected as a slow client)
+    async def event_stream(self, receive, send):
+        client = self.hub.connect()
+        disconnect_watcher = asyncio.ensure_future(wait_for_disconnect(receive, 'http.disconnect', client))
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache')]})
+            await send({'type': 'http.response.body', 'body': b'hello', 'more_body': True})
+            while True:
+                frame = await client.get(timeout=self.keepalive_interval)
+                if frame is not None:
+                    await send({'type': 'http.response.body', 'body': b'data: ' + frame + b'\n\n', 'more_body': True})
+                elif client.closed:
+                    break
+                else:
+                    await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        except OSError:
+            # the connection is gone
+            pass
+        finally:
+            disconnect_watcher.cancel()
+            self.hub.disconnect(client)
+
+    # The messages of the asr channel as websocket text messages. Control commands from the client are forwarded.
+    async def websocket(self, receive, send):
+        message = await receive()
+        if message['type'] != 'websocket.connect':
+            return
+        await send({'type': 'websocket.accept'})
+        client = self.hub.connect()
+        receiver = asyncio.ensure_future(self.websocket_commands(receive, client))
+        try:
+            while True:
+                frame = await client.get(timeout=self.keepalive_interval)
+                if frame is not None:
+                    await send({'type': 'websocket.send', 'text': frame.decode('utf-8')})
+                elif client.closed:
+                    break
+            if not receiver.done():
+                await send({'type': 'websocket.close', 'code': 1000})
+        except OSError:
+            pass
+        finally:
+            receiver.cancel()
+            self.hub.disconnect(client)
+
+    async def websocket_commands(self, receive, client):
+        while True:
+            message = await receive()
+            if message['type'] == 'websocket.disconnect':
+                client.close()
+                return
+            command = message.get('text', '').strip()
+            if command in control_commands:
+                await self.red.publish(self.decode_control_channel, command)
+                print(command, "called (websocket)")
+
+
+# Closes the client queue when the client disconnects, so that its stream ends
+async def wait_for_disconnect(receive, disconnect_type, client):
+    while True:
+        message = await receive()
+        if message['type'] == disconnect_type:
+            client.close()
+            return
+
+
+async def respond(send, status, body, content_type=b'text/plain'):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type), (b'content-length', str(len(body)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# Static files, only for development (as with event_server.py, these should ideally be served by a real web server)
+async def send_static_file(send, directory, path):
+    directory = os.path.realpath(directory)
+    file_path = os.path.realpath(os.path.join(directory, path))
+    if not file_path.startswith(directory + os.sep) or not os.path.isfile(file_path):
+        await respond(send, 404, b'Not Found')
+        return
+    with open(file_path, 'rb') as static_file:
+        body = static_file.read()
+    content_type = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+    await respond(send, 200, body, content_type.encode('ascii'))
+
+
+app = AsyncEventServer()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Asyncio event server, serves the asr channel to many browsers (server-sent events and websockets)')
+    parser.add_argument('--host', dest='host', help='Interface to listen on', type=str, default='0.0.0.0')
+    parser.add_argument('-p', '--port', dest='port', help='Port to listen on', type=int, default=5000)
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the server (for redis-server)', type=str, default='localhost')
+    parser.add_argument('-red', '--redis-channel', dest='redis_channel', help='Name of the channel (for redis-server)', type=str, default='asr')
+    parser.add_argument('--redis-control', dest='redis_control_channel', help='Name of the control channel (for redis-server)', type=str, default='asr_control')
+    parser.add_argument('--client-queue-size', dest='client_queue_size', help='Maximum number of queued messages per client', type=int, default=256)
+    parser.add_argument('--slow-client-policy', dest='slow_client_policy', help='What happens to clients that fall further behind: lose their oldest'
+                                                                               ' messages or get disconnected', choices=slow_client_policies, default='drop-oldest')
+    parser.add_argument('--keepalive', dest='keepalive_interval', help='Send a keepalive after this many seconds without messages', type=float, default=15.0)
+    args = parser.parse_args()
+
+    app = AsyncEventServer(redis_server=args.redis_server, server_channel=args.redis_channel, decode_control_channel=args.redis_control_channel,
+                           client_queue_size=args.client_queue_size, slow_client_policy=args.slow_client_policy,
+                           keepalive_interval=args.keepalive_interval)
+    print(' * Starting async event server with base path:', base_path)
+    lazy_import('uvicorn').run(app, host=args.host, port=args.port, log_level='warning')
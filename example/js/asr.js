@@ -43,11 +43,33 @@ let source = new EventSource('/stream');
 let utts = [];
 
 let startNewUtt = true;
+// words of the current partial utterance per speaker (the session name with the session server), partialUtteranceDelta
+// messages (--partial-deltas) are applied to the words of their speaker
+let partialWords = {};
+
+function splitWords(text) {
+    return text.length > 0 ? text.split(" ") : [];
+}
+
+// Replace all words after the unchanged prefix of the previous partial with the words of the delta
+function applyPartialDelta(jsonEvent) {
+    let words = partialWords[jsonEvent.speaker] || [];
+    words = words.slice(0, jsonEvent.prefix_words).concat(splitWords(jsonEvent.utterance));
+    partialWords[jsonEvent.speaker] = words;
+    jsonEvent.handle = 'partialUtterance';
+    jsonEvent.utterance = words.join(" ");
+}
 
 source.onmessage = function (event) {
     console.log(event.data);
     let jsonEvent = JSON.parse(event.data);
 
+    if (jsonEvent.handle === 'partialUtteranceDelta') {
+        applyPartialDelta(jsonEvent);
+    } else if (jsonEvent.handle === 'partialUtterance') {
+        partialWords[jsonEvent.speaker] = splitWords(jsonEvent.utterance);
+    }
+
     if (jsonEvent.handle === 'partialUtterance') {
         if (startNewUtt) {
             utts.push(jsonEvent.utterance);
@@ -59,6 +81,7 @@ source.onmessage = function (event) {
             replaceLastUtterance(jsonEvent, false);
         }
     } else if (jsonEvent.handle === 'completeUtterance') {
+        delete partialWords[jsonEvent.speaker];
         utts.pop();
         utts.push(jsonEvent.utterance);
         replaceLastUtterance(jsonEvent, true);
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Optional (heavy) modules like pyaudio, samplerate or scipy are only imported on the code paths that need them,
+so that e.g. a decoder that reads its audio from redis neither pays for nor depends on PortAudio.
+All import times are recorded for the import report (--import-report).
+"""
+
+import importlib
+import sys
+import time
+
+import_times = []
+
+# Import a module on first use and record how long the import took
+def lazy_import(module_name):
+    module = sys.modules.get(module_name)
+    if module is None:
+        start = time.time()
+        module = importlib.import_module(module_name)
+        import_times.append((module_name, time.time() - start))
+    return module
+
+# Record the import time of eagerly imported modules, start is the time.time() before the import statements
+def record_import_time(name, start):
+    import_times.append((name, time.time() - start))
+
+def print_import_report():
+    print('Import times (total: %.3f s):' % sum(secs for name, secs in import_times))
+    for name, secs in import_times:
+        print('  %-28s %8.3f s' % (name, secs))
+    print('For a full report of all modules, run with: python -X importtime')
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load generator for the session server (session_server.py): replays N wav files concurrently as N sessions, each with its
+own audio channel <audio channel>:<session>, paced in real time (or --speed times faster) like publish_wav.py. It listens
+on the result channel and reports per stream:
+    the audio-to-transcript latency of the partial and final utterances, from publishing a packet of audio until an
+    utterance that includes it arrives (the decoder sends the amount of session audio it had received as audio_end)
+    the drop rate: packets that no decoder received, and audio that was never decoded (audio_end stays behind)
+    late packets, that the load generator itself could not publish in time (then the host running it is the bottleneck)
+    the time from closing the session until its final utterance arrives
+Increase -n until the latencies grow or streams drop audio, to find the number of streams a decoder host sustains.
+"""
+
+import argparse
+import bisect
+import json
+import threading
+import time
+
+import numpy as np
+import redis
+
+from message_codec import get_codec
+from publish_wav import publish_paced, read_wav
+from resampler import PolyphaseResampler
+
+partial_handles = ['partialUtterance', 'partialUtteranceDelta']
+
+
+# One session: publishes the audio of a wav file in its own thread and collects the results of the session
+class LoadStream(threading.Thread):
+
+    def __init__(self, red, session_id, filename, signal, samplerate, audio_data_channel, control_channel, packet_size=4096,
+                 speed=1.0, start_time=None):
+        super().__init__(daemon=True)
+        self.red = red
+        self.session_id = session_id
+        self.filename = filename
+        self.signal = signal
+        self.samplerate = samplerate
+        self.audio_data_channel = audio_data_channel
+        self.control_channel = control_channel
+        self.packet_size = packet_size
+        self.speed = speed
+        self.start_time = start_time
+
+        self.lock = threading.Lock()
+        # audio end (seconds) and publish time of every packet, in order
+        self.packet_ends = []
+        self.packet_times = []
+        self.unreceived = 0
+        self.late = 0
+        self.max_lag = 0.0
+        self.partial_latencies = []
+        self.final_latencies = []
+        self.max_audio_end = 0.0
+        self.closed_time = None
+        self.close_to_final = None
+
+    def on_publish(self, i, audio_end, now, receivers, lag):
+        with self.lock:
+            self.packet_ends.append(audio_end)
+            self.packet_times.append(now)
+        if receivers == 0:
+            self.unreceived += 1
+        # a packet is late if it could not be published before the next one was due
+        if lag > self.packet_size / self.samplerate / self.speed:
+            self.late += 1
+        self.max_lag = max(self.max_lag, lag)
+
+    def run(self):
+        publish_paced(self.red, self.audio_data_channel, self.signal, self.samplerate, packet_size=self.packet_size, speed=self.speed,
+                      start=self.start_time, on_publish=self.on_publish)
+        self.closed_time = time.monotonic()
+        self.red.publish(self.control_channel, 'close ' + self.session_id)
+
+    # Time since the packet with the audio at audio_end was published
+    def latency(self, audio_end, now):
+        with self.lock:
+            # audio_end is rounded to milliseconds by the decoder
+            i = bisect.bisect_left(self.packet_ends, audio_end - 0.001)
+            if i >= len(self.packet_times):
+                return None
+            return now - self.packet_times[i]
+
+    def on_result(self, data, now):
+        audio_end = data.get('audio_end')
+        if data['handle'] == 'completeUtterance' and self.closed_time is not None and self.close_to_final is None:
+            self.close_to_final = now - self.closed_time
+        if audio_end is None:
+            return
+        self.max_audio_end = max(self.max_audio_end, audio_end)
+        latency = self.latency(audio_end, now)
+        if latency is None:
+            return
+        if data['handle'] in partial_handles:
+            self.partial_latencies.append(latency)
+        elif data['handle'] == 'completeUtterance':
+            self.final_latencies.append(latency)
+
+    def audio_secs(self):
+        return len(self.signal) / self.samplerate
+
+    def report(self):
+        packets = len(self.packet_times)
+        report = {'session': self.session_id, 'file': self.filename, 'audio_secs': round(self.audio_secs(), 3), 'packets': packets,
+                  'unreceived': self.unreceived, 'late': self.late, 'max_lag_ms': round(self.max_lag * 1000.0, 2),
+                  'drop_rate': self.unreceived / packets if packets > 0 else 0.0,
+                  'undecoded_secs': round(max(0.0, self.audio_secs() - self.max_audio_end), 3),
+                  'partials': len(self.partial_latencies), 'finals': len(self.final_latencies),
+                  'close_to_final_secs': self.close_to_final}
+        for name, latencies in [('partial', self.partial_latencies), ('final', self.final_latencies)]:
+            for q in [50, 90, 99]:
+                report['%s_latency_p%d' % (name, q)] = float(np.percentile(latencies, q)) if latencies else None
+        return report
+
+
+# Dispatches the messages of the result channel to the streams (by speaker, which is the session name)
+def listen_results(red, result_channel, codec, streams, subscribed, stopped):
+    pubsub = red.pubsub()
+    pubsub.subscribe(result_channel)
+    while not stopped.is_set():
+        msg = pubsub.get_message(timeout=0.1)
+        if msg is None:
+            continue
+        if msg['type'] == 'subscribe':
+            subscribed.set()
+            continue
+        now = time.monotonic()
+        data = codec.decode(msg['data'])
+        stream = streams.get(data.get('speaker'))
+        if stream is not None:
+            stream.on_result(data, now)
+    pubsub.close()
+
+
+def format_ms(secs):
+    return '%.0f' % (secs * 1000.0) if secs is not None else '-'
+
+
+def print_load_report(reports, max_latency):
+    print('%-12s %8s %8s %6s %6s %10s %12s %12s %12s %12s %12s' % ('session', 'audio(s)', 'packets', 'lost', 'late', 'undecoded', 'part p50 ms',
+                                                                    'part p90 ms', 'final p50 ms', 'final p90 ms', 'close->final'))
+    for report in reports:
+        print('%-12s %8.1f %8d %6d %6d %10.2f %12s %12s %12s %12s %12s' % (report['session'], report['audio_secs'], report['packets'],
+                                                                           report['unreceived'], report['late'], report['undecoded_secs'],
+                                                                           format_ms(report['partial_latency_p50']), format_ms(report['partial_latency_p90']),
+                                                                           format_ms(report['final_latency_p50']), format_ms(report['final_latency_p90']),
+                                                                           format_ms(report['close_to_final_secs'])))
+
+    # A stream is sustained if no audio was lost, everything was decoded and the partials arrive within max_latency
+    overloaded = [report['session'] for report in reports if report['unreceived'] > 0 or report['undecoded_secs'] > 0.5
+                  or report['partial_latency_p90'] is None or report['partial_latency_p90'] > max_latency]
+    late = sum(report['late'] for report in reports)
+    print('%d of %d streams sustained (p90 partial latency <= %.2f s, no lost or undecoded audio)' % (len(reports) - len(overloaded), len(reports), max_latency))
+    if overloaded:
+        print('Overloaded streams:', ' '.join(overloaded))
+    if late > 0:
+        print('WARNING: %d packets were published late, the load generator itself can not keep up' % late)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays wav files concurrently as sessions of the session server and reports latency and drops')
+    parser.add_argument('wavs', help='Wav files, the streams replay them in turn', nargs='+')
+    parser.add_argument('-n', '--streams', dest='streams', help='Number of concurrent streams (sessions), defaults to the number of wav files', type=int, default=None)
+    parser.add_argument('-p', '--packet-size', dest='packet_size', help='Frames per published packet', type=int, default=4096)
+    parser.add_argument('-s', '--speed', dest='speed', help='Publish this many times faster than real time', type=float, default=1.0)
+    parser.add_argument('--stagger', dest='stagger', help='Seconds between the starts of the streams, so that their packets do not arrive in bursts',
+                        type=float, default=0.05)
+    parser.add_argument('-d', '--decode-samplerate', dest='decode_samplerate', help='Samplerate of the session audio streams of the server (its -d),'
+                                                                                    ' wav files with another samplerate are resampled', type=int, default=16000)
+    parser.add_argument('--session-prefix', dest='session_prefix', help='Session names are <prefix><n>', type=str, default='load')
+    parser.add_argument('--max-latency', dest='max_latency', help='p90 partial latency (seconds) up to which a stream counts as sustained', type=float, default=1.0)
+    parser.add_argument('--drain-timeout', dest='drain_timeout', help='Seconds to wait for the final utterances after the last stream was closed',
+                        type=float, default=30.0)
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the server (for redis-server)', type=str, default='localhost')
+    parser.add_argument('-red', '--redis-channel', dest='redis_channel', help='Name of the result channel (for redis-server)', type=str, default='asr')
+    parser.add_argument('--redis-audio', dest='redis_audio_channel', help='Prefix of the per session audio channels', type=str, default='asr_audio')
+    parser.add_argument('--redis-control', dest='redis_control_channel', help='Name of the control channel of the session server', type=str, default='asr_control')
+    parser.add_argument('--result-encoding', dest='result_encoding', help='Encoding of the messages in the result channel: json (default) or msgpack',
+                        choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--results', dest='results', help='Write the per stream reports to this json file', type=str, default=None)
+
+    args = parser.parse_args()
+
+    red = redis.StrictRedis(host=args.redis_server)
+    codec = get_codec(args.result_encoding)
+    num_streams = args.streams if args.streams is not None else len(args.wavs)
+
+    # The session server decodes the audio as it is, so it has to be mono at the decode samplerate of the server
+    wavs = []
+    for filename in args.wavs:
+        signal, samplerate, channels = read_wav(filename)
+        if channels > 1:
+            print('Using the first channel of', filename)
+            signal = np.ascontiguousarray(signal[::channels])
+        if samplerate != args.decode_samplerate:
+            print('Resampling', filename, 'from', samplerate, 'to', args.decode_samplerate, 'Hz')
+            # the output of the resampler is a reused buffer
+            signal = np.array(PolyphaseResampler(samplerate, args.decode_samplerate).process(signal), copy=True)
+            samplerate = args.decode_samplerate
+        wavs.append((filename, signal, samplerate))
+
+    streams = {}
+    for i in range(num_streams):
+        session_id = args.session_prefix + str(i)
+        filename, signal, samplerate = wavs[i % len(wavs)]
+        streams[session_id] = LoadStream(red, session_id, filename, signal, samplerate, args.redis_audio_channel + ':' + session_id,
+                                         args.redis_control_channel, packet_size=args.packet_size, speed=args.speed)
+
+    subscribed, stopped = threading.Event(), threading.Event()
+    listener = threading.Thread(target=listen_results, args=(red, args.redis_channel, codec, streams, subscribed, stopped), daemon=True)
+    listener.start()
+    subscribed.wait()
+
+    # Open all sessions and wait until the session server listens on their audio channels
+    for session_id in streams:
+        red.publish(args.redis_control_channel, 'open ' + session_id)
+    timeout = time.monotonic() + 30.0
+    for stream in streams.values():
+        while red.pubsub_numsub(stream.audio_data_channel)[0][1] == 0 and time.monotonic() < timeout:
+            time.sleep(0.05)
+
+    print('Publishing', num_streams, 'streams')
+    start_time = time.monotonic() + 0.1
+    for i, stream in enumerate(streams.values()):
+        stream.start_time = start_time + i * args.stagger
+        stream.start()
+    for stream in streams.values():
+        stream.join()
+
+    # The final utterance of a session is sent when it is closed
+    timeout = time.monotonic() + args.drain_timeout
+    while any(stream.close_to_final is None for stream in streams.values()) and time.monotonic() < timeout:
+        time.sleep(0.1)
+    stopped.set()
+    listener.join()
+
+    reports = [stream.report() for stream in streams.values()]
+    print_load_report(reports, args.max_latency)
+    if args.results is not None:
+        with open(args.results, 'w') as results_file:
+            json.dump({'streams': num_streams, 'speed': args.speed, 'packet_size': args.packet_size, 'reports': reports}, results_file, indent=2)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Encodings for the result messages of the decoder (partial and complete utterances, status events).
+
+json is the default and can be sent to the browser as is. msgpack is more compact and faster to encode, confidences are
+packed as a float32 array. The event server translates msgpack to json only at the browser edge, with to_json().
+A message can always be decoded without knowing its encoding: json messages start with '{', msgpack maps never do.
+"""
+
+import json
+import struct
+
+from lazy_imports import lazy_import
+
+# msgpack extension type of a little endian float32 array
+float32_array_ext_type = 1
+
+
+# json.dumps can not serialize numpy arrays and scalars (e.g. padded confidences), convert them to Python types
+def json_default(obj):
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError('Object of type %s is not JSON serializable' % type(obj).__name__)
+
+def pack_float32_array(values):
+    values = [float(value) for value in values]
+    return struct.pack('<%df' % len(values), *values)
+
+def unpack_float32_array(data):
+    return list(struct.unpack('<%df' % (len(data) // 4), data))
+
+
+class JSONCodec():
+    name = 'json'
+
+    def encode(self, data):
+        return json.dumps(data, default=json_default)
+
+    def decode(self, encoded):
+        return json.loads(encoded)
+
+
+class MsgpackCodec():
+    name = 'msgpack'
+
+    def __init__(self):
+        self.msgpack = lazy_import('msgpack')
+
+    def encode(self, data):
+        if 'confidences' in data:
+            data = dict(data, confidences=self.msgpack.ExtType(float32_array_ext_type, pack_float32_array(data['confidences'])))
+        return self.msgpack.packb(data, default=json_default, use_bin_type=True)
+
+    def decode(self, encoded):
+        return self.msgpack.unpackb(encoded, raw=False, ext_hook=msgpack_ext_hook)
+
+
+def msgpack_ext_hook(code, data):
+    if code == float32_array_ext_type:
+        return unpack_float32_array(data)
+    return lazy_import('msgpack').ExtType(code, data)
+
+
+codecs = {'json': JSONCodec, 'msgpack': MsgpackCodec}
+
+def get_codec(name):
+    if name not in codecs:
+        raise ValueError('Unknown message encoding: %s (available: %s)' % (name, ', '.join(sorted(codecs))))
+    return codecs[name]()
+
+
+json_codec = JSONCodec()
+msgpack_codec = None
+
+def is_json(encoded):
+    return encoded[:1] in (b'{', '{')
+
+# Decode a message in any of the encodings
+def decode_message(encoded):
+    global msgpack_codec
+    if is_json(encoded):
+        return json_codec.decode(encoded)
+    if msgpack_codec is None:
+        msgpack_codec = MsgpackCodec()
+    return msgpack_codec.decode(encoded)
+
+# Translate a message in any of the encodings to json (bytes), json messages are passed through without parsing them
+def to_json(encoded):
+    if is_json(encoded):
+        return encoded if isinstance(encoded, bytes) else encoded.encode('utf-8')
+    return json_codec.encode(decode_message(encoded)).encode('utf-8')
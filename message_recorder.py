@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming recorder for the message history of a decoder (-hist). Every published message is appended to disk as one
+json line {"ts": <unix time>, "data": <message>} as it happens, so memory use does not grow with the session length.
+The files are rotated when they get larger than max_bytes: <prefix>.0000.jsonl, <prefix>.0001.jsonl, ...
+Recordings can be replayed into redis with replay_messages.py.
+"""
+
+import glob
+import os
+import threading
+import time
+
+
+# Appends messages to the current recording file and rotates files. Writes are buffered and a flusher thread flushes
+# them every flush_interval seconds, also while no messages arrive, so that a crashed decoder loses at most that much
+# history. Messages can be recorded from several threads (e.g. the decode and the status thread of the asyncio loop).
+class MessageRecorder():
+
+    def __init__(self, prefix='message_history', max_bytes=64*1024*1024, flush_interval=1.0):
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+
+        self.file_index = 0
+        self.file_out = None
+        self.file_bytes = 0
+        self.unflushed = False
+        self.records_written = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+        prefix_dir = os.path.dirname(prefix)
+        if prefix_dir:
+            os.makedirs(prefix_dir, exist_ok=True)
+
+        # Never overwrite an older recording with the same prefix, continue after its last file
+        existing = rotated_files(prefix)
+        if existing:
+            self.file_index = int(existing[-1][len(prefix) + 1:-len('.jsonl')]) + 1
+
+        self.open_next_file()
+        self.flusher = threading.Thread(target=self.flush_periodically, daemon=True, name='message recorder flush')
+        self.flusher.start()
+
+    def file_name(self, index):
+        return '%s.%04d.jsonl' % (self.prefix, index)
+
+    def open_next_file(self):
+        if self.file_out is not None:
+            self.file_out.close()
+        file_name = self.file_name(self.file_index)
+        print('Recording message history to', file_name)
+        self.file_out = open(file_name, 'w')
+        self.file_bytes = 0
+        self.file_index += 1
+
+    # encoded_json is the message already encoded as json, it is written as is
+    def record(self, encoded_json, ts=None):
+        if ts is None:
+            ts = time.time()
+        line = '{"ts": %.6f, "data": %s}\n' % (ts, encoded_json)
+        with self.lock:
+            if self.file_out is None:
+                return
+            if self.file_bytes > 0 and self.file_bytes + len(line) > self.max_bytes:
+                self.open_next_file()
+            self.file_out.write(line)
+            self.file_bytes += len(line)
+            self.records_written += 1
+            self.unflushed = True
+
+    def flush(self):
+        with self.lock:
+            if self.file_out is not None and self.unflushed:
+                self.file_out.flush()
+                self.unflushed = False
+
+    def flush_periodically(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher.is_alive():
+            self.flusher.join()
+        with self.lock:
+            if self.file_out is not None:
+                self.file_out.close()
+                self.file_out = None
+                print('Recorded', self.records_written, 'messages to', self.prefix + '.*.jsonl')
+
+
+def rotated_files(prefix):
+    return sorted(glob.glob(glob.escape(prefix) + '.[0-9][0-9][0-9][0-9].jsonl'))
+
+# All files of a recording in order, or the file itself if a single (.jsonl) file is given
+def recording_files(prefix):
+    if os.path.isfile(prefix):
+        return [prefix]
+    return rotated_files(prefix)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Latency and real-time factor metrics of the decoders. Every decoder process collects its metrics in the process wide
+registry metrics (histograms of the hot path phases, audio-to-partial and endpoint-to-final latency, audio and processing
+time, queue depths).
+A MetricsReporter thread writes a snapshot of the registry to the redis hash asr_metrics every few seconds (one field per
+decoder process), the event server renders all snapshots in the Prometheus text format on /metrics.
+"""
+
+import bisect
+import collections
+import json
+import os
+import socket
+import threading
+import time
+
+# Upper bounds of the histogram buckets in seconds
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Hot path phases that are timed: per chunk (accept_waveform, silence_weighting, advance_decoding, get_partial_output)
+# and per utterance (finalize, mbr)
+decoder_phases = ['accept_waveform', 'silence_weighting', 'advance_decoding', 'get_partial_output', 'finalize', 'mbr']
+
+metrics_key = 'asr_metrics'
+
+
+# With keep_recent > 0, the last keep_recent observations are kept as well, for exact percentiles (see quantiles)
+class Histogram():
+
+    def __init__(self, buckets=latency_buckets, keep_recent=0):
+        self.buckets = buckets
+        # the last count is for observations larger than the largest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = collections.deque(maxlen=keep_recent) if keep_recent > 0 else None
+        self.lock = threading.Lock()
+
+    def observe(self, secs):
+        i = bisect.bisect_left(self.buckets, secs)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += secs
+            self.count += 1
+            if self.recent is not None:
+                self.recent.append(secs)
+
+    # Percentiles (qs between 0 and 1) of the recent observations, nearest rank. None if nothing was observed.
+    def quantiles(self, qs):
+        with self.lock:
+            values = sorted(self.recent or [])
+        if not values:
+            return [None for q in qs]
+        return [values[min(int(q * len(values)), len(values) - 1)] for q in qs]
+
+    # Cumulative counts per upper bound, as in the Prometheus format
+    def snapshot(self):
+        with self.lock:
+            counts = list(self.counts)
+            total, count = self.sum, self.count
+        cumulative, buckets = 0, []
+        for le, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets.append([le, cumulative])
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+
+# The metrics of one decoder process. The real-time factor is the processing time of the audio divided by its duration,
+# rtf_recent is a moving average over the last chunks, the totals give the long term real-time factor.
+class DecoderMetrics():
+
+    def __init__(self, rtf_smoothing=0.98, latency_samples=4096):
+        self.phases = {phase: Histogram() for phase in decoder_phases}
+        self.audio_to_partial = Histogram(keep_recent=latency_samples)
+        self.endpoint_to_final = Histogram(keep_recent=latency_samples)
+        self.rtf_smoothing = rtf_smoothing
+
+        self.lock = threading.Lock()
+        self.audio_secs = 0.0
+        self.busy_secs = 0.0
+        self.chunks = 0
+        self.rtf_recent = None
+        self.queue_depths = {}
+
+    def phase(self, name, secs):
+        self.phases[name].observe(secs)
+
+    # Time from receiving a block of audio until the partial utterance that includes it is published
+    def partial_latency(self, secs):
+        self.audio_to_partial.observe(secs)
+
+    # Time from detecting the end of an utterance (endpoint, VAD or stop) until the final utterance is published
+    def final_latency(self, secs):
+        self.endpoint_to_final.observe(secs)
+
+    # One chunk of audio_secs audio was processed in busy_secs
+    def chunk(self, audio_secs, busy_secs):
+        with self.lock:
+            self.audio_secs += audio_secs
+            self.busy_secs += busy_secs
+            self.chunks += 1
+            if audio_secs > 0:
+                rtf = busy_secs / audio_secs
+                self.rtf_recent = rtf if self.rtf_recent is None else self.rtf_smoothing * self.rtf_recent + (1.0 - self.rtf_smoothing) * rtf
+
+    def queue_depth(self, queue, depth):
+        self.queue_depths[queue] = depth
+
+    def snapshot(self):
+        with self.lock:
+            totals = {'audio_secs': self.audio_secs, 'busy_secs': self.busy_secs, 'chunks': self.chunks, 'rtf_recent': self.rtf_recent}
+        totals['time'] = time.time()
+        totals['phases'] = {phase: histogram.snapshot() for phase, histogram in self.phases.items()}
+        totals['audio_to_partial'] = self.audio_to_partial.snapshot()
+        totals['endpoint_to_final'] = self.endpoint_to_final.snapshot()
+        totals['queue_depths'] = dict(self.queue_depths)
+        return totals
+
+
+# Process wide registry, forked decoder workers continue with their own copy
+metrics = DecoderMetrics()
+
+
+def instance_name():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+# Writes a snapshot of the metrics registry to redis every interval seconds, until it is stopped.
+# The field of this process is removed again on stop, so that stopped decoders do not show up on /metrics.
+class MetricsReporter(threading.Thread):
+
+    def __init__(self, red, interval=10.0, key=metrics_key, instance=None):
+        super().__init__(daemon=True, name='metrics reporter')
+        self.red = red
+        self.interval = interval
+        self.key = key
+        self.instance = instance if instance is not None else instance_name()
+        self.stopped = threading.Event()
+
+    def publish(self):
+        snapshot = metrics.snapshot()
+        snapshot['interval'] = self.interval
+        self.red.hset(self.key, self.instance, json.dumps(snapshot))
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                print('Could not publish metrics:', e)
+
+    def stop(self):
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+        self.red.hdel(self.key, self.instance)
+
+
+def prometheus_labels(**labels):
+    return '{' + ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels.items()) + '}'
+
+
+def prometheus_histogram(lines, name, histogram, **labels):
+    for le, count in histogram['buckets']:
+        lines.append('%s_bucket%s %d' % (name, prometheus_labels(le=repr(float(le)), **labels), count))
+    lines.append('%s_bucket%s %d' % (name, prometheus_labels(le='+Inf', **labels), histogram['count']))
+    lines.append('%s_sum%s %r' % (name, prometheus_labels(**labels), float(histogram['sum'])))
+    lines.append('%s_count%s %d' % (name, prometheus_labels(**labels), histogram['count']))
+
+
+# Prometheus text format of the snapshots of all decoders (the redis hash, decoder -> json). Snapshots that were not
+# updated for max_missed_intervals reporting intervals are skipped (e.g. a decoder that crashed).
+def render_prometheus(snapshots, max_missed_intervals=3):
+    decoders = []
+    now = time.time()
+    for decoder, snapshot in sorted(snapshots.items()):
+        decoder = decoder.decode('utf-8') if isinstance(decoder, bytes) else decoder
+        snapshot = json.loads(snapshot)
+        if now - snapshot['time'] <= max_missed_intervals * snapshot.get('interval', 10.0):
+            decoders.append((decoder, snapshot))
+
+    lines = ['# HELP asr_phase_seconds Time of the decoder phases, per chunk or per utterance (finalize, mbr)',
+             '# TYPE asr_phase_seconds histogram']
+    for decoder, snapshot in decoders:
+        for phase, histogram in sorted(snapshot['phases'].items()):
+            prometheus_histogram(lines, 'asr_phase_seconds', histogram, decoder=decoder, phase=phase)
+
+    lines += ['# HELP asr_audio_to_partial_seconds Time from receiving audio until the partial utterance with it is published',
+              '# TYPE asr_audio_to_partial_seconds histogram']
+    for decoder, snapshot in decoders:
+        prometheus_histogram(lines, 'asr_audio_to_partial_seconds', snapshot['audio_to_partial'], decoder=decoder)
+
+    lines += ['# HELP asr_endpoint_to_final_seconds Time from the end of an utterance until the final utterance is published',
+              '# TYPE asr_endpoint_to_final_seconds histogram']
+    for decoder, snapshot in decoders:
+        # snapshots of decoders that were started before this metric existed do not have it
+        if 'endpoint_to_final' in snapshot:
+            prometheus_histogram(lines, 'asr_endpoint_to_final_seconds', snapshot['endpoint_to_final'], decoder=decoder)
+
+    for name, field, metric_type, help_text in [('asr_audio_seconds_total', 'audio_secs', 'counter', 'Duration of the received audio'),
+                                                ('asr_busy_seconds_total', 'busy_secs', 'counter', 'Processing time of the received audio'),
+                                                ('asr_chunks_total', 'chunks', 'counter', 'Number of processed chunks'),
+                                                ('asr_realtime_factor', 'rtf_recent', 'gauge', 'Processing time / audio duration over the last chunks')]:
+        lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+        for decoder, snapshot in decoders:
+            if snapshot[field] is not None:
+                lines.append('%s%s %r' % (name, prometheus_labels(decoder=decoder), float(snapshot[field])))
+
+    lines += ['# HELP asr_queue_depth Number of queued chunks (or frames for the audio ingest) in front of the decoder',
+              '# TYPE asr_queue_depth gauge']
+    for decoder, snapshot in decoders:
+        for queue, depth in sorted(snapshot['queue_depths'].items()):
+            lines.append('asr_queue_depth%s %d' % (prometheus_labels(decoder=decoder, queue=queue), depth))
+
+    return '\n'.join(lines) + '\n'
@@ -23,9 +23,18 @@ Created on Wed Aug  7 15:35:15 2019
 
 from __future__ import print_function
 
+import time
+from lazy_imports import lazy_import, print_import_report, record_import_time
+
+import_start = time.time()
+
 from kaldi.asr import NnetLatticeFasterOnlineRecognizer
-from kaldi.decoder import LatticeFasterDecoderOptions
-from kaldi.nnet3 import NnetSimpleLoopedComputationOptions
+from kaldi.decoder import LatticeFasterDecoderOptions, LatticeFasterOnlineDecoder
+from kaldi.nnet3 import (CollapseModelConfig,
+                         NnetSimpleLoopedComputationOptions,
+                         collapse_model,
+                         set_batchnorm_test_mode,
+                         set_dropout_test_mode)
 from kaldi.online2 import (OnlineEndpointConfig,
                            OnlineIvectorExtractorAdaptationState,
                            OnlineNnetFeaturePipelineConfig,
@@ -33,64 +42,125 @@ from kaldi.online2 import (OnlineEndpointConfig,
                            OnlineNnetFeaturePipeline,
                            OnlineSilenceWeighting)
 from kaldi.util.options import ParseOptions
-from kaldi.util.table import SequentialWaveReader
+from kaldi.util.io import xopen
 from kaldi.lat.sausages import MinimumBayesRisk
 
 from kaldi.matrix import Matrix, Vector
 
-from kaldi.fstext import utils as fst_utils
+from kaldi.fstext import StdConstFst, SymbolTable, read_fst_kaldi
+
+record_import_time('kaldi', import_start)
+import_start = time.time()
 
-import yaml
 import os
-import pyaudio
-import time
+import shutil
 
 import json
 import redis
-from timer import Timer
+from timer import PhaseTimer, Timer
+from message_codec import get_codec, json_codec
+from message_recorder import MessageRecorder
+from audio_ingest import AudioRingBuffer, RedisAudioIngest, RedisStreamAudioIngest
+from decode_pipeline import DecodePipeline, OrderedWorker
+from channel_selection import ChannelSelector
+from vad import EnergyVAD
+from resampler import make_resampler, resample_algorithms
+from waveform_buffer import WaveformBuffer
+from confidences import ConfidenceEstimator, confidence_modes
+from metrics import MetricsReporter, metrics
 
 import numpy as np
-import samplerate
 
 import argparse
-
-import scipy.io.wavfile as wavefile
+import asyncio
+import multiprocessing
+import tempfile
 
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
+record_import_time('numpy, redis, stdlib', import_start)
+
+# Not imported here, only on the code paths that need them (see lazy_imports.py):
+# pyaudio (local microphone), samplerate (libsamplerate resampling, see resampler.py), scipy.io.wavfile (debug wav output),
+# yaml (model config, not needed with a model bundle), kaldi.util.table (scp input)
+
 
 #Do most of the message passing with redis, now standard version
 class ASRRedisClient():
 
-    def __init__(self, red, server='localhost', channel='asr', record_message_history=False):
+    def __init__(self, red, server='localhost', channel='asr', message_recorder=None, result_stream=None, stream_maxlen=10000,
+                 encoding='json', dedup_partials=True, max_partial_rate=0.0,
+                 partial_deltas=False, full_partial_interval=20, async_finalize=False):
         self.channel = channel
+        # encoding of the published messages (json or msgpack), see message_codec.py
+        self.codec = get_codec(encoding)
+        # if result_stream is set, all results are also added to this redis stream (bounded to about stream_maxlen entries),
+        # so that consumers can catch up on results they missed
+        self.result_stream = result_stream
+        self.stream_maxlen = stream_maxlen
         self.timer_started = False
         self.timer = Timer()
-        self.record_message_history = record_message_history
-        self.last_message_time = 0.0
+        # if a MessageRecorder is set, all published messages are streamed to disk (see message_recorder.py),
+        # recordings can be replayed into the asr channel with replay_messages.py
+        self.message_recorder = message_recorder
         self.red = red
-
-        # if record_message_history= True, we store a program in self.message_trace that when
-        # executed replays all messages into the asr channel
-
-        self.message_trace = 'import time\n' \
-                             'import json\n' \
-                             'import redis\n\n' \
-                             'red = redis.StrictRedis(host=%s)\n' \
-                             'time_factor = 1.0\n' \
-                             'asr_channel = "%s"\n\n' % (server, channel)
+        # optional timing breakdown of model loading, that is send with asr_ready
+        self.load_timings = None
+        # A partial utterance with the same text as the last one is not sent again (dedup_partials) and at most max_partial_rate
+        # partials per second are sent (0 = no limit). Both reset with every complete utterance, except for the rate limit.
+        self.dedup_partials = dedup_partials
+        self.min_partial_interval = 1.0 / max_partial_rate if max_partial_rate > 0 else 0.0
+        self.last_partial = None
+        self.last_partial_time = None
+        self.partials_sent = 0
+        self.partials_duplicate = 0
+        self.partials_rate_limited = 0
+        # With partial_deltas, partials are sent as partialUtteranceDelta messages: the number of leading words that did not
+        # change since the previous partial (prefix_words) and only the words after them. The first partial of an utterance
+        # and every full_partial_interval-th partial are sent in full, so that clients that missed a message can catch up.
+        self.partial_deltas = partial_deltas
+        self.full_partial_interval = full_partial_interval
+        self.last_partial_words = None
+        self.partials_since_full = 0
+        self.partials_delta = 0
+        # With async_finalize, all messages are published by a worker thread. The sessions hand the MBR confidence computation
+        # of their final utterances to the same worker (see defer), so that the messages stay in order.
+        self.worker = OrderedWorker(name='publisher ' + channel) if async_finalize else None
 
     def publish(self, data):
+        if self.worker is not None and not self.worker.in_worker():
+            self.worker.submit(self.publish_now, data)
+        else:
+            self.publish_now(data)
+
+    def publish_now(self, data):
         red = self.red
-        json_dumps_data = json.dumps(data)
-        red.publish(self.channel, json_dumps_data)
-        cur_time = float(self.timer.current_secs())
-        delta = cur_time - self.last_message_time
-        self.last_message_time = cur_time
-        if self.record_message_history:
-            self.message_trace += 'time.sleep(%f*time_factor)\n' % delta
-            self.message_trace += 'red.publish(asr_channel, json.dumps('+json_dumps_data+'))\n'
-            self.message_trace += 'print(' + json_dumps_data + ')\n'
+        encoded_data = self.codec.encode(data)
+        red.publish(self.channel, encoded_data)
+        if self.result_stream is not None:
+            red.xadd(self.result_stream, {'data': encoded_data}, maxlen=self.stream_maxlen, approximate=True)
+        if self.message_recorder is not None:
+            # recordings are always json, so that they can be replayed with any encoding
+            self.message_recorder.record(encoded_data if self.codec.name == 'json' else json_codec.encode(data))
+
+    # Run fn(*args) in order with the published messages, on the worker with async_finalize, otherwise right away
+    def defer(self, fn, *args):
+        if self.worker is not None:
+            self.worker.submit(fn, *args)
+        else:
+            fn(*args)
+
+    # Wait until all messages are published
+    def flush(self):
+        if self.worker is not None:
+            self.worker.flush()
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.close()
+            print("Publisher stats:", self.worker.stats())
+        if self.message_recorder is not None:
+            self.message_recorder.close()
 
     def checkTimer(self):
         if not self.timer_started:
@@ -101,16 +171,72 @@ class ASRRedisClient():
         self.timer_started = False
         self.timer.start()
 
-    def partialUtterance(self, utterance, key='none', speaker='Speaker'):
+    # Returns False if the partial utterance was suppressed (same text as the last one, or over the rate limit).
+    # audio_end is the amount of audio (in seconds) the session had received when the utterance was decoded, optional.
+    def partialUtterance(self, utterance, key='none', speaker='Speaker', audio_end=None):
+        if self.dedup_partials and utterance == self.last_partial:
+            self.partials_duplicate += 1
+            return False
+        now = time.monotonic()
+        if self.last_partial_time is not None and now - self.last_partial_time < self.min_partial_interval:
+            self.partials_rate_limited += 1
+            return False
+        self.last_partial = utterance
+        self.last_partial_time = now
+        self.partials_sent += 1
+
         self.checkTimer()
-        data = {'handle': 'partialUtterance', 'utterance': utterance, 'key': key,
-                'speaker': speaker, 'time': float(self.timer.current_secs())}
+        if self.partial_deltas:
+            data = self.partial_delta(utterance, key, speaker)
+        else:
+            data = {'handle': 'partialUtterance', 'utterance': utterance, 'key': key,
+                    'speaker': speaker, 'time': float(self.timer.current_secs())}
+        if audio_end is not None:
+            data['audio_end'] = round(audio_end, 3)
         self.publish(data)
+        return True
+
+    # The message for a partial utterance with partial_deltas, a delta to the previous partial or a full partialUtterance
+    def partial_delta(self, utterance, key, speaker):
+        words = utterance.split()
+        previous_words = self.last_partial_words
+        self.last_partial_words = words
+
+        # partials_since_full counts the deltas after the last full partial, the full partial itself is the interval's first
+        if previous_words is None or self.partials_since_full >= self.full_partial_interval - 1:
+            self.partials_since_full = 0
+            return {'handle': 'partialUtterance', 'utterance': utterance, 'key': key,
+                    'speaker': speaker, 'time': float(self.timer.current_secs())}
+
+        prefix_words = 0
+        for previous_word, word in zip(previous_words, words):
+            if previous_word != word:
+                break
+            prefix_words += 1
+
+        self.partials_since_full += 1
+        self.partials_delta += 1
+        return {'handle': 'partialUtteranceDelta', 'prefix_words': prefix_words, 'utterance': ' '.join(words[prefix_words:]),
+                'key': key, 'speaker': speaker, 'time': float(self.timer.current_secs())}
 
-    def completeUtterance(self, utterance, confidences, key='none', speaker='Speaker'):
+    def partial_stats(self):
+        return {'sent': self.partials_sent, 'duplicate': self.partials_duplicate, 'rate_limited': self.partials_rate_limited,
+                'delta': self.partials_delta}
+
+    # The next partial starts a new utterance
+    def reset_partials(self):
+        self.last_partial = None
+        self.last_partial_words = None
+
+    def completeUtterance(self, utterance, confidences, key='none', speaker='Speaker', audio_end=None):
+        # deferred final utterances are published by the worker, their session already reset the partials when it finalized
+        if self.worker is None or not self.worker.in_worker():
+            self.reset_partials()
         self.checkTimer()
         data = {'handle': 'completeUtterance', 'utterance': utterance, 'confidences': confidences,
                 'key': key, 'speaker': speaker, 'time': float(self.timer.current_secs())}
+        if audio_end is not None:
+            data['audio_end'] = round(audio_end, 3)
         self.publish(data)
 
     def asr_loading(self, speaker):
@@ -121,24 +247,72 @@ class ASRRedisClient():
     def asr_ready(self, speaker):
         self.checkTimer()
         data = {'handle': 'asr_ready', 'time': float(self.timer.current_secs()), 'speaker': speaker}
+        if self.load_timings is not None:
+            data['load_timings'] = self.load_timings
         self.publish(data)
 
-    def sendstatus(self, isDecoding, shutdown=False):
+    def sendstatus(self, isDecoding, shutdown=False, pipeline=None):
         self.checkTimer()
-        data = {'handle': 'status', 'time': float(self.timer.current_secs()), 'isDecoding': isDecoding, 'shutdown': shutdown}
-        self.red.publish(self.channel, json.dumps(data))
+        data = {'handle': 'status', 'time': float(self.timer.current_secs()), 'isDecoding': isDecoding, 'shutdown': shutdown,
+                'partials': self.partial_stats()}
+        # queue depths of the decoding pipeline stages (with -t)
+        if pipeline is not None:
+            data['pipeline'] = pipeline
+        if self.worker is not None:
+            data['publisher'] = self.worker.stats()
+            self.worker.submit(self.red.publish, self.channel, self.codec.encode(data))
+        else:
+            self.red.publish(self.channel, self.codec.encode(data))
+
+# Read only model data that can be shared between many decoding sessions: acoustic model, decoding graph (HCLG),
+# word symbols and the online feature configuration (incl. the ivector extractor).
+class SharedModel():
+
+    def __init__(self, transition_model, acoustic_model, graph, symbols, feat_info, decoder_opts, decodable_opts, endpoint_opts, session_opts=None):
+        self.transition_model = transition_model
+        self.acoustic_model = acoustic_model
+        self.graph = graph
+        self.symbols = symbols
+        self.feat_info = feat_info
+        self.decoder_opts = decoder_opts
+        self.decodable_opts = decodable_opts
+        self.endpoint_opts = endpoint_opts
+        # per session options of the yaml model config (use-vad, silence-timeout), see read_session_opts
+        self.session_opts = session_opts if session_opts is not None else read_session_opts({})
+
+    # Construct a recognizer with its own decoder (and decoder state). The acoustic model and the graph are referenced, not copied.
+    def new_recognizer(self):
+        decoder = LatticeFasterOnlineDecoder(self.graph, self.decoder_opts)
+        return NnetLatticeFasterOnlineRecognizer(self.transition_model, self.acoustic_model, decoder, self.symbols,
+                                                 decodable_opts=self.decodable_opts,
+                                                 endpoint_opts=self.endpoint_opts)
+
+# Decoder options are not part of the model files, they are set from the command line
+def get_decoder_opts(beam_size=10, frames_per_chunk=50):
+    decoder_opts = LatticeFasterDecoderOptions()
+    decoder_opts.beam = beam_size
+    decoder_opts.max_active = 7000
+    decodable_opts = NnetSimpleLoopedComputationOptions()
+    decodable_opts.acoustic_scale = 1.0
+    decodable_opts.frame_subsampling_factor = 3
+    decodable_opts.frames_per_chunk = frames_per_chunk
+    return decoder_opts, decodable_opts
+
+# Options of the yaml model config that apply to every decoding session, with their defaults
+def read_session_opts(model_yaml):
+    return {'use-vad': bool(model_yaml.get('use-vad', False)), 'silence-timeout': float(model_yaml.get('silence-timeout', 0))}
 
-def load_model(config_file, online_config, models_path='models/', beam_size=10, frames_per_chunk=50):
+# Read the yaml model config and create the Kaldi online config from it, if it does not exist yet.
+# Returns the decoder options and the session options (see read_session_opts) of the yaml file.
+def prepare_online_config(config_file, online_config, models_path='models/'):
     # Read YAML file
     with open(config_file, 'r') as stream:
-        model_yaml = yaml.safe_load(stream)
+        model_yaml = lazy_import('yaml').safe_load(stream)
 
     decoder_yaml_opts = model_yaml['decoder']
 
     print(decoder_yaml_opts)
-
-    feat_opts = OnlineNnetFeaturePipelineConfig()
-    endpoint_opts = OnlineEndpointConfig()
+    session_opts = read_session_opts(model_yaml)
 
     if not os.path.isfile(online_config):
         print(online_config + ' does not exists. Trying to create it from yaml file settings.')
@@ -151,29 +325,167 @@ def load_model(config_file, online_config, models_path='models/', beam_size=10,
             online_config_file.write("--endpoint.silence-phones=" + decoder_yaml_opts['endpoint-silence-phones'] + '\n')
     else:
         print("Loading online conf from:", online_config)
-            
+
+    return decoder_yaml_opts, session_opts
+
+# Parse the Kaldi online config, this also loads the ivector extractor
+def read_online_config(online_config):
+    feat_opts = OnlineNnetFeaturePipelineConfig()
+    endpoint_opts = OnlineEndpointConfig()
     po = ParseOptions("")
     feat_opts.register(po)
     endpoint_opts.register(po)
     po.read_config_file(online_config)
+    return feat_opts, endpoint_opts
+
+def load_shared_model(config_file, online_config, models_path='models/', beam_size=10, frames_per_chunk=50, phase_timer=None):
+    if phase_timer is None:
+        phase_timer = PhaseTimer()
+
+    decoder_yaml_opts, session_opts = prepare_online_config(config_file, online_config, models_path)
+    phase_timer.phase('yaml and online config')
+
+    feat_opts, endpoint_opts = read_online_config(online_config)
+    phase_timer.phase('parse online config')
+
     feat_info = OnlineNnetFeaturePipelineInfo.from_config(feat_opts)
+    phase_timer.phase('feature pipeline / ivector')
+
+    decoder_opts, decodable_opts = get_decoder_opts(beam_size, frames_per_chunk)
+
+    # Read acoustic model, graph and word symbols (this is what NnetLatticeFasterOnlineRecognizer.from_files does,
+    # but we keep the objects around so that more recognizers can be constructed from them)
+    transition_model, acoustic_model = NnetLatticeFasterOnlineRecognizer.read_model(models_path + decoder_yaml_opts["model"])
+    phase_timer.phase('acoustic model')
+
+    graph = read_fst_kaldi(models_path + decoder_yaml_opts["fst"])
+    phase_timer.phase('decoding graph')
+
+    symbols = SymbolTable.read_text(models_path + decoder_yaml_opts["word-syms"])
+    phase_timer.phase('word symbols')
+
+    return SharedModel(transition_model, acoustic_model, graph, symbols, feat_info, decoder_opts, decodable_opts, endpoint_opts, session_opts)
+
+# Files of a precompiled model bundle (see prepare_model_bundle)
+bundle_manifest_file = 'bundle.json'
+bundle_online_config_file = 'online.conf'
+bundle_model_file = 'final.mdl'
+bundle_graph_file = 'HCLG.const.fst'
+bundle_symbols_file = 'words.bin'
+
+# Precompile a model into a bundle directory, so that restarts do not need to parse the yaml file, convert the online
+# config, collapse the nnet or parse the word symbols again. The graph is stored as ConstFst, which is read as a few
+# contiguous arrays instead of a state by state VectorFst.
+def prepare_model_bundle(config_file, online_config, bundle_dir, models_path='models/'):
+    decoder_yaml_opts, session_opts = prepare_online_config(config_file, online_config, models_path)
+    model_file = models_path + decoder_yaml_opts["model"]
+    graph_file = models_path + decoder_yaml_opts["fst"]
+    symbols_file = models_path + decoder_yaml_opts["word-syms"]
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    shutil.copyfile(online_config, os.path.join(bundle_dir, bundle_online_config_file))
+
+    print("Writing collapsed acoustic model...")
+    transition_model, acoustic_model = NnetLatticeFasterOnlineRecognizer.read_model(model_file)
+    set_batchnorm_test_mode(True, acoustic_model.nnet)
+    set_dropout_test_mode(True, acoustic_model.nnet)
+    collapse_model(CollapseModelConfig(), acoustic_model.nnet)
+    with xopen(os.path.join(bundle_dir, bundle_model_file), 'w') as ko:
+        transition_model.write(ko.stream(), True)
+        acoustic_model.write(ko.stream(), True)
+
+    print("Writing decoding graph as ConstFst...")
+    StdConstFst(read_fst_kaldi(graph_file)).write(os.path.join(bundle_dir, bundle_graph_file))
+
+    print("Writing word symbols...")
+    SymbolTable.read_text(symbols_file).write(os.path.join(bundle_dir, bundle_symbols_file))
+
+    # The source files are stored with their modification times, so that a stale bundle can be detected
+    sources = {path: os.path.getmtime(path) for path in [config_file, online_config, model_file, graph_file, symbols_file]}
+    with open(os.path.join(bundle_dir, bundle_manifest_file), 'w') as manifest_out:
+        json.dump({'version': 1, 'sources': sources, 'session_opts': session_opts}, manifest_out, indent=2)
+
+    print("Model bundle written to:", bundle_dir)
+
+# Returns True if the bundle exists and none of the source files (if still available) changed after it was prepared
+def is_model_bundle_valid(bundle_dir):
+    manifest_file = os.path.join(bundle_dir, bundle_manifest_file)
+    if not os.path.isfile(manifest_file):
+        return False
+
+    with open(manifest_file) as manifest_in:
+        manifest = json.load(manifest_in)
+
+    for path, mtime in manifest['sources'].items():
+        if os.path.exists(path) and os.path.getmtime(path) != mtime:
+            print("Model bundle is stale,", path, "changed after the bundle was prepared.")
+            return False
+
+    return True
+
+# Ask the kernel to start reading the bundle files into the page cache, while we are still busy with other loading phases
+def prefetch_files(paths):
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+def load_model_bundle(bundle_dir, beam_size=10, frames_per_chunk=50, phase_timer=None):
+    if phase_timer is None:
+        phase_timer = PhaseTimer()
+
+    print("Loading model bundle from:", bundle_dir)
+    prefetch_files([os.path.join(bundle_dir, bundle_graph_file), os.path.join(bundle_dir, bundle_model_file)])
+    phase_timer.phase('prefetch bundle')
+
+    feat_opts, endpoint_opts = read_online_config(os.path.join(bundle_dir, bundle_online_config_file))
+    phase_timer.phase('parse online config')
+
+    feat_info = OnlineNnetFeaturePipelineInfo.from_config(feat_opts)
+    phase_timer.phase('feature pipeline / ivector')
+
+    decoder_opts, decodable_opts = get_decoder_opts(beam_size, frames_per_chunk)
+
+    transition_model, acoustic_model = NnetLatticeFasterOnlineRecognizer.read_model(os.path.join(bundle_dir, bundle_model_file))
+    phase_timer.phase('acoustic model')
+
+    graph = StdConstFst.read(os.path.join(bundle_dir, bundle_graph_file))
+    phase_timer.phase('decoding graph')
+
+    symbols = SymbolTable.read(os.path.join(bundle_dir, bundle_symbols_file))
+    phase_timer.phase('word symbols')
+
+    with open(os.path.join(bundle_dir, bundle_manifest_file)) as manifest_in:
+        session_opts = read_session_opts(json.load(manifest_in).get('session_opts', {}))
+
+    return SharedModel(transition_model, acoustic_model, graph, symbols, feat_info, decoder_opts, decodable_opts, endpoint_opts, session_opts)
+
+# Load the model from a prepared bundle if there is a valid one, otherwise from the yaml config and the model files
+def load_shared_model_cached(config_file, online_config, bundle_dir=None, models_path='models/', beam_size=10, frames_per_chunk=50, phase_timer=None):
+    if bundle_dir is not None:
+        if is_model_bundle_valid(bundle_dir):
+            return load_model_bundle(bundle_dir, beam_size=beam_size, frames_per_chunk=frames_per_chunk, phase_timer=phase_timer)
+        print("No valid model bundle in", bundle_dir, "- loading from yaml config. Use --prepare-bundle to create one.")
+
+    return load_shared_model(config_file, online_config, models_path=models_path, beam_size=beam_size,
+                             frames_per_chunk=frames_per_chunk, phase_timer=phase_timer)
+
+def load_model(config_file, online_config, models_path='models/', beam_size=10, frames_per_chunk=50, bundle_dir=None, phase_timer=None):
+    if phase_timer is None:
+        phase_timer = PhaseTimer()
+
+    model = load_shared_model_cached(config_file, online_config, bundle_dir=bundle_dir, models_path=models_path, beam_size=beam_size,
+                                     frames_per_chunk=frames_per_chunk, phase_timer=phase_timer)
 
     # Construct recognizer
-    decoder_opts = LatticeFasterDecoderOptions()
-    decoder_opts.beam = beam_size
-    decoder_opts.max_active = 7000
-    decodable_opts = NnetSimpleLoopedComputationOptions()
-    decodable_opts.acoustic_scale = 1.0
-    decodable_opts.frame_subsampling_factor = 3
-    decodable_opts.frames_per_chunk = frames_per_chunk
-    asr = NnetLatticeFasterOnlineRecognizer.from_files(
-        models_path + decoder_yaml_opts["model"], models_path + decoder_yaml_opts["fst"],
-        models_path + decoder_yaml_opts["word-syms"],
-        decoder_opts=decoder_opts,
-        decodable_opts=decodable_opts,
-        endpoint_opts=endpoint_opts)
+    asr = model.new_recognizer()
+    phase_timer.phase('recognizer')
 
-    return asr, feat_info, decodable_opts
+    return asr, model.feat_info, model.decodable_opts, model.session_opts
 
 def decode_chunked_partial(scp):
     ## Decode (whole utterance)
@@ -186,6 +498,7 @@ def decode_chunked_partial(scp):
     #    print(key, out["text"], flush=True)
 
     # Decode (chunked + partial output)
+    SequentialWaveReader = lazy_import('kaldi.util.table').SequentialWaveReader
     for key, wav in SequentialWaveReader("scp:wav.scp"):
         feat_pipeline = OnlineNnetFeaturePipeline(feat_info)
         asr.set_input_pipeline(feat_pipeline)
@@ -213,9 +526,15 @@ def decode_chunked_partial(scp):
         print(key + "-final", out["text"], flush=True)
 
 def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chunk_size=1024,
-                                       compute_confidences=True, asr_client=None, speaker="Speaker", pad_confidences=True):
+                                       compute_confidences=True, asr_client=None, speaker="Speaker", pad_confidences=True,
+                                       partial_output=True, results=None, confidence_opts=None):
     # Decode (chunked + partial output + endpointing
     #         + ivector adaptation + silence weighting)
+    # If partial_output is False, no partial utterances are computed and nothing is printed per utterance (batch mode).
+    # If results is a list, all final utterances are appended to it.
+    # confidence_opts are the options of the ConfidenceEstimator (see confidences.py), by default MBR on the full lattice.
+    confidence_estimator = ConfidenceEstimator(**(confidence_opts or {}))
+    SequentialWaveReader = lazy_import('kaldi.util.table').SequentialWaveReader
     adaptation_state = OnlineIvectorExtractorAdaptationState.from_info(
         feat_info.ivector_extractor_info)
     for key, wav in SequentialWaveReader(scp):
@@ -227,7 +546,8 @@ def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chun
             asr.transition_model, feat_info.silence_weighting_config,
             decodable_opts.frame_subsampling_factor)
         data = wav.data()[0]
-        print("type(data):", type(data))
+        if partial_output:
+            print("type(data):", type(data))
         last_chunk = False
         utt, part = 1, 1
         prev_num_frames_decoded, offset = 0, 0
@@ -248,8 +568,7 @@ def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chun
                 if asr.endpoint_detected():
                     asr.finalize_decoding()
                     out = asr.get_output()
-                    mbr = MinimumBayesRisk(out["lattice"])
-                    confd = mbr.get_one_best_confidences()
+                    confd = confidence_estimator.estimate(out)
                     if pad_confidences:
                         token_length = len(out["text"].split())
 
@@ -261,11 +580,14 @@ def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chun
                             print("WARNING: more computeted confidences than token length! Fixing this with slicing!")
                             confd = confd[:token_length]
 
-                    print(confd)
-                    print(key + "-utt%d-final" % utt, out["text"], flush=True)
+                    if partial_output:
+                        print(confd)
+                        print(key + "-utt%d-final" % utt, out["text"], flush=True)
                     if asr_client is not None:
                         asr_client.completeUtterance(utterance=out["text"], key=key +
                                                         "-utt%d-part%d" % (utt, part), confidences=confd)
+                    if results is not None:
+                        results.append({'key': key, 'utt': utt, 'utterance': out["text"], 'confidences': [float(c) for c in confd]})
                     offset += int(num_frames_decoded
                                   * decodable_opts.frame_subsampling_factor
                                   * feat_pipeline.frame_shift_in_seconds()
@@ -283,7 +605,7 @@ def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chun
                     utt += 1
                     part = 1
                     prev_num_frames_decoded = 0
-                elif num_frames_decoded > prev_num_frames_decoded:
+                elif partial_output and num_frames_decoded > prev_num_frames_decoded:
                     prev_num_frames_decoded = num_frames_decoded
                     out = asr.get_partial_output()
                     print(key + "-utt%d-part%d" % (utt, part),
@@ -293,15 +615,80 @@ def decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, scp, chun
                     part += 1
         asr.finalize_decoding()
         out = asr.get_output()
-        mbr = MinimumBayesRisk(out["lattice"])
-        confd = mbr.get_one_best_confidences()
-        print(out)
-        print(key + "-utt%d-final" % utt, out["text"], flush=True)
+        confd = confidence_estimator.estimate(out)
+        if partial_output:
+            print(out)
+            print(key + "-utt%d-final" % utt, out["text"], flush=True)
         if asr_client is not None:
             asr_client.completeUtterance(utterance=out["text"],key=key +"-utt%d-part%d" % (utt, part),confidences=confd)
+        if results is not None:
+            results.append({'key': key, 'utt': utt, 'utterance': out["text"], 'confidences': [float(c) for c in confd]})
 
         feat_pipeline.get_adaptation_state(adaptation_state)
 
+# Batch worker state, set once per worker process by init_batch_worker
+batch_worker_model = None
+
+def init_batch_worker(asr, feat_info, decodable_opts):
+    global batch_worker_model
+    batch_worker_model = (asr, feat_info, decodable_opts)
+
+# Decode one part of a split scp (one file) in a batch worker, only final utterances are computed
+def decode_scp_part(part_scp, chunk_size):
+    asr, feat_info, decodable_opts = batch_worker_model
+    results = []
+    decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, 'scp:' + part_scp, chunk_size=chunk_size,
+                                       partial_output=False, results=results)
+    return results
+
+# Estimated decoding cost of an scp line: the size of the wav file, or 0 if the line is not a plain path (e.g. a pipe)
+def scp_line_cost(line):
+    path = line.strip().partition(' ')[2].strip()
+    return os.path.getsize(path) if os.path.isfile(path) else 0
+
+# Offline batch decoding: every file of the scp is decoded on its own by forked worker processes that share the loaded
+# model copy-on-write. The workers take the next file when they are done, the longest files first, so that files of
+# different lengths do not leave workers idle at the end. Every file starts with a fresh ivector adaptation state, so the
+# results do not depend on the number of jobs. The results are written in input order, as one json object per utterance.
+def decode_scp_parallel(asr, feat_info, decodable_opts, scp, results_file, jobs=1, chunk_size=1024):
+    scp_file = scp.partition(':')[2]
+    with open(scp_file) as scp_in:
+        scp_lines = [line for line in scp_in if line.strip()]
+
+    jobs = max(1, min(jobs, len(scp_lines)))
+    print("Decoding", len(scp_lines), "files from", scp_file, "with", jobs, "jobs")
+    order = sorted(range(len(scp_lines)), key=lambda i: scp_line_cost(scp_lines[i]), reverse=True)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        part_scps = []
+        for i in order:
+            part_scp = os.path.join(tmp_dir, 'part%d.scp' % i)
+            with open(part_scp, 'w') as part_out:
+                part_out.write(scp_lines[i])
+            part_scps.append(part_scp)
+
+        if jobs == 1:
+            init_batch_worker(asr, feat_info, decodable_opts)
+            ordered_results = [decode_scp_part(part_scp, chunk_size) for part_scp in part_scps]
+        else:
+            # With fork, the workers inherit the loaded model (the initargs are not pickled)
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'),
+                                     initializer=init_batch_worker, initargs=(asr, feat_info, decodable_opts)) as executor:
+                ordered_results = list(executor.map(decode_scp_part, part_scps, [chunk_size] * len(part_scps)))
+
+    part_results = [None] * len(scp_lines)
+    for i, results in zip(order, ordered_results):
+        part_results[i] = results
+
+    num_utts = 0
+    with open(results_file, 'w') as results_out:
+        for results in part_results:
+            for result in results:
+                results_out.write(json.dumps(result) + '\n')
+                num_utts += 1
+
+    print("Wrote", num_utts, "utterances to", results_file)
+
 def print_devices(paudio):
     info = paudio.get_host_api_info_by_index(0)
     numdevices = info.get('deviceCount')
@@ -315,39 +702,44 @@ def print_devices(paudio):
 
 # Realtime decoding loop, uses blocking calls and interfaces a microphone directly (with pyaudio)
 def decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts, paudio, input_microphone_id, channels=1,
-                                           samp_freq=16000, record_samplerate=16000, chunk_size=1024, wait_for_start_command=False, record_message_history=False, compute_confidences=True, asr_client=None, speaker_str="Speaker",
+                                           samp_freq=16000, record_samplerate=16000, chunk_size=1024, wait_for_start_command=False, compute_confidences=True, asr_client=None, speaker_str="Speaker",
                                            resample_algorithm="sinc_best", save_debug_wav=False, use_threads=False, minimum_num_frames_decoded_per_speaker=5, mic_vol_cutoff=0.5, use_local_mic=True, decode_control_channel='asr_control',
-                                           audio_data_channel='asr_audio'):
+                                           audio_data_channel='asr_audio', jitter_ms=100, use_audio_stream=False, consumer_name='decoder', pipeline_queue_size=8,
+                                           channel_smoothing=0.0, channel_hysteresis_db=0.0, vad_opts=None, silence_timeout=0.0,
+                                           confidence_opts=None):
     
     # Subscribe to command and control redis channel
     p = red.pubsub()
     p.subscribe(decode_control_channel)
 
-    if not use_local_mic:
-        pa = red.pubsub()
-        pa.subscribe(audio_data_channel)
-
-    # Figure out if we need to resample (Todo: channles does not seem to work)
-    need_resample = False
+    # Audio from redis is received by its own thread, that re-chunks it to chunk_size (see audio_ingest.py)
+    if not use_local_mic and use_audio_stream:
+        ingest = RedisStreamAudioIngest(red, audio_data_channel, chunk_size, channels=channels, samp_freq=record_samplerate, jitter_ms=jitter_ms,
+                                        consumer=consumer_name)
+        ingest.start()
+    elif not use_local_mic:
+        ingest = RedisAudioIngest(red, audio_data_channel, chunk_size, channels=channels, samp_freq=record_samplerate, jitter_ms=jitter_ms)
+        ingest.start()
+
+    # Figure out if we need to resample. Only the selected channel is resampled. With -t, the resampled blocks are queued
+    # in front of the decode stage, so the resampler needs enough output buffers for all of them (see resampler.py).
+    resampler = None
     if record_samplerate != samp_freq:
         print("Activating resampler since record and decode samplerate are different:", record_samplerate, "->", samp_freq)
-        resampler = samplerate.Resampler(resample_algorithm, channels=channels)
-        need_resample = True
-        ratio = samp_freq / record_samplerate
-        print("Resample ratio:", ratio)
+        resampler = make_resampler(resample_algorithm, record_samplerate, samp_freq,
+                                   num_buffers=pipeline_queue_size + 2 if use_threads else 1)
+        print("Resample ratio:", samp_freq / record_samplerate)
 
     # Initialize Python/Kaldi bridge
     print("Constructing decoding pipeline")
-    adaptation_state = OnlineIvectorExtractorAdaptationState.from_info(feat_info.ivector_extractor_info)
-    key = 'mic' + str(input_microphone_id)
-    feat_pipeline, sil_weighting = initNnetFeatPipeline(adaptation_state, asr, decodable_opts, feat_info)
+    session = ASRSession(asr, feat_info, decodable_opts, asr_client=asr_client, key='mic' + str(input_microphone_id),
+                         speaker=speaker_str.replace("#c#", "0"), samp_freq=samp_freq, vad_opts=vad_opts,
+                         silence_timeout=silence_timeout, confidence_opts=confidence_opts)
+    channel_selector = ChannelSelector(channels, mic_vol_cutoff=mic_vol_cutoff, smoothing=channel_smoothing, hysteresis_db=channel_hysteresis_db,
+                                       volume_scale=(samp_freq / record_samplerate) ** 0.5)
     print("Done")
 
-    speaker = speaker_str.replace("#c#", "0")
     last_chunk = False
-    utt, part = 1, 1
-    prev_num_frames_decoded, offset_complete = 0, 0
-    chunks_decoded = 0
     num_chunks = 0
     blocks = []
     rawblocks = []
@@ -355,188 +747,155 @@ def decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts,
     if use_local_mic:
         # Open microphone channel 
         print("Open microphone stream with id" + str(input_microphone_id) + "...")
-        stream = paudio.open(format=pyaudio.paInt16, channels=channels, rate=record_samplerate, input=True,
+        stream = paudio.open(format=lazy_import('pyaudio').paInt16, channels=channels, rate=record_samplerate, input=True,
                             frames_per_buffer=chunk_size, input_device_index=input_microphone_id)
         print("Done!")
 
     do_decode = not wait_for_start_command
     need_finalize = False
-    block, previous_block = None, None
-    decode_future = None
 
     # Send event (with redis) to the front that ASR session is ready
-    asr_client.asr_ready(speaker=speaker)
-
-    # Initialize a ThreadPoolExecutor. 
-    # Note that we initialize the thread executer independently of whether we actually use it later (the -t option).
-    # At the end of this loop we have two code paths, one that uses a computation future (with -t) and one without it.
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        while not last_chunk:
-            # Check if there is a message from the redis server first (non-blocking!), if there is no new message msh is simply None.
-            msg = p.get_message()
-
-            # We check if there are externally send control commands
-            if msg is not None:
-                print('msg:', msg)
-                if msg['data'] == b"start":
-                    print('Start command received!')
-                    do_decode = True
-                    asr_client.sendstatus(isDecoding=do_decode)
-
-                elif msg['data'] == b"stop":
-                    print('Stop command received!')
-                    if do_decode and prev_num_frames_decoded > 0:
-                        need_finalize = True
-                    do_decode = False
-                    asr_client.sendstatus(isDecoding=do_decode)
-
-                elif msg['data'] == b"shutdown":
-                    print('Shutdown command received!')
-                    last_chunk = True
-
-                elif msg['data'] == b"status":
-                    print('Status command received!')
-                    asr_client.sendstatus(isDecoding=do_decode)
-
-                elif msg['data'] == b"reset_timer":
-                    print('Reset time command received!')
-                    asr_client.resetTimer()
-            
-            if use_local_mic:
-                # We always consume from the microphone stream, even if we do not decode
-                block_raw = stream.read(chunk_size, exception_on_overflow=False)
-                npblock = np.frombuffer(block_raw, dtype=np.int16)
-            else:
-                block_audio_redis_msg = next(pa.listen())
-                if block_audio_redis_msg['type'] == "subscribe" and block_audio_redis_msg["data"] == 1:
-                    print('audio msg:', block_audio_redis_msg)
-                    print("Successfully connected to redis audio stream!")
-                    continue
-                else:
-                    npblock = np.frombuffer(block_audio_redis_msg['data'], dtype=np.int16)
-                    print("audio data: ", npblock)
-
-            # Resample the block if necessary, e.g. 48kHz -> 16kHz
-            if need_resample:
-                block = resampler.process(np.array(npblock, copy=True), ratio)
-                block = np.array(block, dtype=np.int16)
-            else:
-                block = npblock
-
-            # Only save the wav, if the save_debug flag is enabled (TODO: investigate: does not seem to work with multiple channels)
-            if save_debug_wav:
-                blocks.append(block)
-                rawblocks.append(npblock)
-
-            # Block on the result of the decode if one is pending
-            if use_threads and do_decode and block is not None and decode_future is not None:
-
-                # This call blocks until the result is ready
-                need_endpoint_finalize, prev_num_frames_decoded, part, utt = decode_future.result()
+    asr_client.asr_ready(speaker=session.speaker)
+
+    # Channel selection, resampling and (optionally) saving the debug wav, for one raw block from the microphone or redis.
+    # Returns the (mono) block to decode, the selected channel (None for a single channel) and if the channel has volume.
+    def preprocess_block(npblock):
+        block, max_channel, has_volume = npblock, None, False
+        # If we operate on multichannel data, select the channel here that has the highest volume
+        if channels > 1:
+            block, max_channel, has_volume = channel_selector.select(npblock)
+
+        # Resample the block if necessary, e.g. 48kHz -> 16kHz
+        if resampler is not None:
+            block = resampler.process(block)
+
+        # Only save the wav, if the save_debug flag is enabled. The resampled block is a reused buffer, so it is copied.
+        if save_debug_wav:
+            blocks.append(np.array(block, copy=True))
+            rawblocks.append(npblock)
+
+        return block, max_channel, has_volume
+
+    # With -t, the audio is processed in a pipeline of threads connected by bounded queues (see decode_pipeline.py):
+    # this loop captures the audio, the 'preprocess' stage selects the channel and resamples, the 'decode' stage
+    # does feature extraction and decoding. Feature extraction and decoding share the (not thread safe) feature
+    # pipeline of the session, therefore they have to run in the same stage.
+    # Items are ('audio', raw block, do_decode, time received) or ('finalize', None), so that finalization stays in order with the audio.
+    def preprocess_stage(item):
+        if item[0] != 'audio':
+            return item
+        _, npblock, decode, received = item
+        block, max_channel, has_volume = preprocess_block(npblock)
+        if not decode:
+            return None
+        return ('audio', block, max_channel, has_volume, received)
+
+    def decode_stage(item):
+        if item[0] == 'finalize':
+            session.finalize()
+            return None
+        _, block, max_channel, has_volume, received = item
+        if max_channel is not None:
+            update_speaker(session, speaker_str.replace("#c#", str(max_channel)), has_volume, minimum_num_frames_decoded_per_speaker)
+        session.decode_block(block, received=received)
+        return None
+
+    pipeline = None
+    if use_threads:
+        pipeline = DecodePipeline([('preprocess', preprocess_stage), ('decode', decode_stage)], max_queue_size=pipeline_queue_size)
+
+    while not last_chunk:
+        # Check if there is a message from the redis server first (non-blocking!), if there is no new message msh is simply None.
+        msg = p.get_message()
+
+        # We check if there are externally send control commands
+        if msg is not None:
+            print('msg:', msg)
+            if msg['data'] == b"start":
+                print('Start command received!')
+                do_decode = True
+                asr_client.sendstatus(isDecoding=do_decode)
 
-                # Check if we need to finalize, disallow endpoint without a single decoded frame
-                if need_endpoint_finalize and prev_num_frames_decoded > 0:
+            elif msg['data'] == b"stop":
+                print('Stop command received!')
+                if do_decode:
                     need_finalize = True
-                    resend_previous_waveform = True
-                    print("prev_num_frames_decoded:", prev_num_frames_decoded)
-
-                if need_endpoint_finalize and prev_num_frames_decoded == 0:
-                    print("WARN need_endpoint_finalize and prev_num_frames_decoded == 0")
-
-            # Finalize the decoding here, if endpointing signalized that we should start a new utterance. 
-            # We might also need to finalize if we switch from do_decode=True to do_decode=False (user starts/stops decoding from frontend).
-            if need_finalize and block is not None and prev_num_frames_decoded > 0:
-                print("prev_num_frames_decoded:",prev_num_frames_decoded)
-                out, confd = finalize_decode(asr, asr_client, key,
-                                             part, speaker, utt)
-                feat_pipeline, sil_weighting = reinitialize_asr(adaptation_state, asr, feat_info, feat_pipeline)
-                utt += 1
-                part = 1
-
-                if resend_previous_waveform and previous_block is not None:
-                    # We always resend the last block for the new utterance (we only know that the endpoint is inside of a chunk, but not where exactly)
-                    feat_pipeline.accept_waveform(samp_freq, Vector(previous_block))
-                    resend_previous_waveform = False
-
-                need_finalize = False
-
-                prev_num_frames_decoded = 0
-
-            # If we operate on multichannel data, select the channel here that has the highest volume 
-            # (with some added heuristic, only change the speaker if the previous speaker was active for minimum_num_frames_decoded_per_speaker many frames)
-            if channels > 1:
-                block = np.reshape(block, (-1, channels))
-
-                # Select loudest channel
-                volume_norms = []
-                for i in range(channels):
-                    # We have a simplyfied concept of loudness, it is simply the L2 of the chunk interpreted as a vector (sqrt of the sum of squares): 
-                    # This has nothing to do with the physical loudness.
-
-                    volume_norms.append(np.linalg.norm(block[:, i] / 65536.0) * 10.0)
-                    #print("|" * int(volume_norm))
-
-                #print('vols:', volume_norms)
-
-                volume_norms = [0.0 if elem < mic_vol_cutoff else elem for elem in volume_norms]
-
-                volume_norm = max(volume_norms)
-                max_channel = volume_norms.index(volume_norm)
-                block = block[:, max_channel]
-
-                new_speaker = speaker_str.replace("#c#", str(max_channel))
-
-                #print('vols:',volume_norms, 'max:',max_channel, 'value:',volume_norm)
+                do_decode = False
+                asr_client.sendstatus(isDecoding=do_decode)
 
-                if sum(volume_norms) > 1e-10 and new_speaker != speaker \
-                        and prev_num_frames_decoded >= minimum_num_frames_decoded_per_speaker:
-                    print("Speaker change! Number of frames decoded for previous speaker:", str(prev_num_frames_decoded))
+            elif msg['data'] == b"shutdown":
+                print('Shutdown command received!')
+                last_chunk = True
 
-                    speaker = new_speaker
+            elif msg['data'] == b"status":
+                print('Status command received!')
+                asr_client.sendstatus(isDecoding=do_decode)
 
-                    need_finalize = True
-                    resend_previous_waveform = True
+            elif msg['data'] == b"reset_timer":
+                print('Reset time command received!')
+                asr_client.resetTimer()
 
-                    #prev_num_frames_decoded = 0
+        # Finalize the decoding here, if we switch from do_decode=True to do_decode=False (user starts/stops decoding from frontend).
+        # Endpoints detected by Kaldi are already finalized by the session itself.
+        if need_finalize:
+            if pipeline is not None:
+                pipeline.put(('finalize', None))
             else:
-                volume_norm = np.linalg.norm(block / 65536.0) * 10.0
-
-            num_chunks += 1
+                session.finalize()
+            need_finalize = False
 
-            # Send status beacon periodically (to frontend, so its knows we are alive)
-            if num_chunks % 50 == 0:
-                asr_client.sendstatus(isDecoding=do_decode)
+        if pipeline is not None and pipeline.failed():
+            print('Decoding pipeline failed, shutting down.')
+            break
 
-            if do_decode:
-                # If we use the unthreaded mode, we block until the computation here in this loop
-                if not use_threads:
-                    need_endpoint_finalize, prev_num_frames_decoded, part, utt = advance_mic_decoding(adaptation_state, asr, asr_client, block, chunks_decoded, feat_info, feat_pipeline, key, last_chunk,
-                                                                part, prev_num_frames_decoded, samp_freq, sil_weighting, speaker, utt)
-                    # Check if we need to finalize, disallow endpoint without a single decoded frame
-                    if need_endpoint_finalize and prev_num_frames_decoded > 0:
-                        need_finalize = True
-                        resend_previous_waveform = True
-                        print("prev_num_frames_decoded:", prev_num_frames_decoded)
-
-                else:
-                    # In threaded mode, we submit a non blocking computation request to the thread executor
-                    decode_future = executor.submit(advance_mic_decoding, adaptation_state, asr, asr_client, block, chunks_decoded, feat_info, feat_pipeline, key, last_chunk,
-                                                                part, prev_num_frames_decoded, samp_freq, sil_weighting, speaker, utt)
-            else:
-                time.sleep(0.001)
+        if use_local_mic:
+            # We always consume from the microphone stream, even if we do not decode
+            block_raw = stream.read(chunk_size, exception_on_overflow=False)
+            npblock = np.frombuffer(block_raw, dtype=np.int16)
+        else:
+            # Wait for the next chunk with a timeout, so that control messages are still handled if no audio arrives
+            npblock = ingest.read_chunk(timeout=0.1)
+            if npblock is None:
+                continue
+        received = time.monotonic()
+
+        num_chunks += 1
+
+        # Send status beacon periodically (to frontend, so its knows we are alive)
+        if num_chunks % 50 == 0:
+            depths = pipeline.depths() if pipeline is not None else None
+            asr_client.sendstatus(isDecoding=do_decode, pipeline=depths)
+            for stage, depth in (depths or {}).items():
+                metrics.queue_depth(stage, depth)
+            if not use_local_mic:
+                metrics.queue_depth('ingest_frames', ingest.ring_buffer.depth())
+
+        # In threaded mode, the block is handed to the pipeline. This blocks only if the pipeline is full (backpressure).
+        if pipeline is not None:
+            pipeline.put(('audio', npblock, do_decode, received))
+            continue
+
+        block, max_channel, has_volume = preprocess_block(npblock)
+
+        if do_decode:
+            if max_channel is not None:
+                update_speaker(session, speaker_str.replace("#c#", str(max_channel)), has_volume, minimum_num_frames_decoded_per_speaker)
+            session.decode_block(block, received=received)
+        else:
+            time.sleep(0.001)
 
-            previous_block = block
+    if pipeline is not None:
+        pipeline.close()
+        print("Decoding pipeline stats:", pipeline.stats())
 
-    # Record message history as an integrated Python file, that can be used as a standalone replay
-    if record_message_history:
-        with open('message_history_replay.py', 'w') as message_history_out:
-            message_history_out.write(asr_client.message_trace)
-    else:
-        print("Not writing record message history since --record_message_history is not set.")
+    if not use_local_mic:
+        print("Audio ingest stats:", ingest.stats())
+        ingest.stop()
 
     # Write debug wav as output file (will only be executed after shutdown)
     if save_debug_wav:
         print("Saving debug output...")
+        wavefile = lazy_import('scipy.io.wavfile')
         wavefile.write("debug.wav", samp_freq, np.concatenate(blocks, axis=None))
         wavefile.write("debugraw.wav", record_samplerate, np.concatenate(rawblocks, axis=None))
     else:
@@ -544,41 +903,258 @@ def decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts,
 
     # Now shuting down pipeline, compute MBR for the final utterance and complete it.
     print("Shutdown: finalizing ASR output...")
-    asr.finalize_decoding()
-    out = asr.get_output()
-    mbr = MinimumBayesRisk(out["lattice"])
-    confd = mbr.get_one_best_confidences()
-    print(out)
-    print(key + "-utt%d-final" % utt, out["text"], flush=True)
+    session.close()
     if asr_client is not None:
-        asr_client.completeUtterance(utterance=out["text"], key=key + "-utt%d-part%d" % (utt, part), confidences=confd, speaker=speaker)
         asr_client.sendstatus(isDecoding=False,shutdown=True)
     print("Done, will exit now.")
 
+# Event driven realtime decoding loop (asyncio). Control messages, audio blocks and decode results are awaited events,
+# so a decoder that waits for a start command or for audio from redis does not use any CPU, and start/stop/shutdown are
+# handled immediately. The local microphone is read with a pyaudio callback and is only running while we decode.
+# Decoding itself runs in a worker thread and the (blocking) redis calls of asr_client run in another one, so that the
+# event loop stays responsive. If one of the tasks fails, the loop shuts down and the error is raised after the
+# final utterance was completed.
+async def decode_chunked_partial_endpointing_async(asr, feat_info, decodable_opts, paudio, input_microphone_id, channels=1,
+                                                   samp_freq=16000, record_samplerate=16000, chunk_size=1024, wait_for_start_command=False, asr_client=None,
+                                                   speaker_str="Speaker", resample_algorithm="sinc_best", minimum_num_frames_decoded_per_speaker=5,
+                                                   mic_vol_cutoff=0.5, use_local_mic=True, redis_server='localhost', decode_control_channel='asr_control',
+                                                   audio_data_channel='asr_audio', status_interval=3.0, max_queued_blocks=100,
+                                                   channel_smoothing=0.0, channel_hysteresis_db=0.0, vad_opts=None, silence_timeout=0.0,
+                                                   confidence_opts=None, save_debug_wav=False):
+    aioredis = lazy_import('redis.asyncio')
+    red = aioredis.StrictRedis(host=redis_server)
+    loop = asyncio.get_running_loop()
+
+    # Audio blocks and finalize requests, in the order in which they have to be processed. Blocks are queued as
+    # (block, do_decode, time received): whether a block is decoded is decided when it is received, so that on stop the
+    # blocks queued before the finalize request are still decoded.
+    audio_queue = asyncio.Queue(maxsize=max_queued_blocks)
+    finalize_request = object()
+    shutdown = asyncio.Event()
+    do_decode = not wait_for_start_command
+    num_dropped = 0
+    blocks = []
+    rawblocks = []
+
+    # Figure out if we need to resample (only the selected channel is resampled)
+    resampler = None
+    if record_samplerate != samp_freq:
+        print("Activating resampler since record and decode samplerate are different:", record_samplerate, "->", samp_freq)
+        resampler = make_resampler(resample_algorithm, record_samplerate, samp_freq)
+        print("Resample ratio:", samp_freq / record_samplerate)
+
+    print("Constructing decoding pipeline")
+    session = ASRSession(asr, feat_info, decodable_opts, asr_client=asr_client, key='mic' + str(input_microphone_id),
+                         speaker=speaker_str.replace("#c#", "0"), samp_freq=samp_freq, vad_opts=vad_opts,
+                         silence_timeout=silence_timeout, confidence_opts=confidence_opts)
+    channel_selector = ChannelSelector(channels, mic_vol_cutoff=mic_vol_cutoff, smoothing=channel_smoothing, hysteresis_db=channel_hysteresis_db,
+                                       volume_scale=(samp_freq / record_samplerate) ** 0.5)
+    print("Done")
+
+    # Called by PortAudio in its own thread, hands the block over to the event loop
+    def put_mic_block(data):
+        nonlocal num_dropped
+        if audio_queue.full():
+            num_dropped += 1
+            print("WARNING: decoder can not keep up, dropped audio block. Dropped so far:", num_dropped)
+            return
+        audio_queue.put_nowait((data, do_decode, time.monotonic()))
+
+    def mic_callback(in_data, frame_count, time_info, status):
+        loop.call_soon_threadsafe(put_mic_block, in_data)
+        return None, lazy_import('pyaudio').paContinue
+
+    stream = None
+    if use_local_mic:
+        print("Open microphone stream with id" + str(input_microphone_id) + "...")
+        stream = paudio.open(format=lazy_import('pyaudio').paInt16, channels=channels, rate=record_samplerate, input=True,
+                             frames_per_buffer=chunk_size, input_device_index=input_microphone_id,
+                             stream_callback=mic_callback, start=do_decode)
+        print("Done!")
+
+    # Select the speaker channel, resample and decode one block (bytes or int16 array). Runs in the decode thread.
+    def process_block(data, received):
+        npblock = np.frombuffer(data, dtype=np.int16)
+        block = npblock
+        if channels > 1:
+            block = select_speaker_channel(session, block, channel_selector, speaker_str, minimum_num_frames_decoded_per_speaker)
+        if resampler is not None:
+            block = resampler.process(block)
+        # The resampled block is a reused buffer, so it is copied
+        if save_debug_wav:
+            blocks.append(np.array(block, copy=True))
+            rawblocks.append(npblock)
+        session.decode_block(block, received=received)
+
+    # Calls fn of asr_client (or another blocking redis call) in the client thread, in order with the other calls
+    async def client_call(fn, *args, **kwargs):
+        await loop.run_in_executor(client_executor, lambda: fn(*args, **kwargs))
+
+    async def read_control():
+        nonlocal do_decode
+        pubsub = red.pubsub()
+        await pubsub.subscribe(decode_control_channel)
+        async for msg in pubsub.listen():
+            if msg['type'] != 'message':
+                continue
+            print('msg:', msg)
+
+            if msg['data'] == b"start":
+                print('Start command received!')
+                do_decode = True
+                if stream is not None and not stream.is_active():
+                    stream.start_stream()
+                await client_call(asr_client.sendstatus, isDecoding=do_decode)
+
+            elif msg['data'] == b"stop":
+                print('Stop command received!')
+                was_decoding = do_decode
+                do_decode = False
+                if was_decoding:
+                    await audio_queue.put(finalize_request)
+                if stream is not None and stream.is_active():
+                    stream.stop_stream()
+                await client_call(asr_client.sendstatus, isDecoding=do_decode)
+
+            elif msg['data'] == b"shutdown":
+                print('Shutdown command received!')
+                shutdown.set()
+
+            elif msg['data'] == b"status":
+                print('Status command received!')
+                await client_call(asr_client.sendstatus, isDecoding=do_decode)
+
+            elif msg['data'] == b"reset_timer":
+                print('Reset time command received!')
+                await client_call(asr_client.resetTimer)
+
+    # Re-chunks the redis audio packets to blocks of chunk_size, no matter how the publisher packetizes the audio
+    async def read_redis_audio():
+        ring_buffer = AudioRingBuffer(capacity=max_queued_blocks * chunk_size, channels=channels)
+        pubsub = red.pubsub()
+        await pubsub.subscribe(audio_data_channel)
+        print("Successfully connected to redis audio stream!")
+        async for msg in pubsub.listen():
+            if msg['type'] == 'message' and do_decode:
+                ring_buffer.write(np.frombuffer(msg['data'], dtype=np.int16))
+                block = ring_buffer.read_available(chunk_size)
+                while block is not None:
+                    await audio_queue.put((block, True, time.monotonic()))
+                    block = ring_buffer.read_available(chunk_size)
+
+    async def decode_audio():
+        while True:
+            item = await audio_queue.get()
+            if item is finalize_request:
+                await loop.run_in_executor(executor, session.finalize)
+                continue
+            data, decode, received = item
+            if decode:
+                await loop.run_in_executor(executor, process_block, data, received)
+
+    # Send status beacon periodically (to frontend, so its knows we are alive)
+    async def send_status():
+        while True:
+            await asyncio.sleep(status_interval)
+            await client_call(asr_client.sendstatus, isDecoding=do_decode)
+            metrics.queue_depth('audio_queue', audio_queue.qsize())
+
+    error = None
+    with ThreadPoolExecutor(max_workers=1) as executor, ThreadPoolExecutor(max_workers=1) as client_executor:
+        await client_call(asr_client.asr_ready, speaker=session.speaker)
+
+        tasks = [asyncio.create_task(read_control()), asyncio.create_task(decode_audio()), asyncio.create_task(send_status())]
+        if not use_local_mic:
+            tasks.append(asyncio.create_task(read_redis_audio()))
+        shutdown_task = asyncio.create_task(shutdown.wait())
+
+        # All tasks run until shutdown, a task that ends before has failed (e.g. lost its redis connection)
+        done, _ = await asyncio.wait(tasks + [shutdown_task], return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task is not shutdown_task:
+                error = task.exception() or RuntimeError('Task %s of the decoding loop stopped unexpectedly' % task.get_coro().__name__)
+                print('Decoding loop failed, shutting down:', repr(error))
+                break
+
+        if stream is not None:
+            stream.stop_stream()
+            stream.close()
+        for task in tasks + [shutdown_task]:
+            task.cancel()
+        await asyncio.gather(*tasks, shutdown_task, return_exceptions=True)
+
+        # Write debug wav as output file (will only be executed after shutdown, the decode thread is idle now)
+        if save_debug_wav and blocks:
+            print("Saving debug output...")
+            wavefile = lazy_import('scipy.io.wavfile')
+            wavefile.write("debug.wav", samp_freq, np.concatenate(blocks, axis=None))
+            wavefile.write("debugraw.wav", record_samplerate, np.concatenate(rawblocks, axis=None))
+
+        # Now shuting down pipeline, compute MBR for the final utterance and complete it (after a possibly still running decode).
+        print("Shutdown: finalizing ASR output...")
+        await loop.run_in_executor(executor, session.close)
+        await client_call(asr_client.sendstatus, isDecoding=False, shutdown=True)
+
+    await red.close()
+    if error is not None:
+        raise error
+    print("Done, will exit now.")
+
+# Select the channel of a multichannel block that has the highest volume and change the speaker of the session accordingly
+# (with some added heuristic, only change the speaker if the previous speaker was active for minimum_num_frames_decoded_per_speaker many frames).
+# Returns the (mono) block of the selected channel.
+def select_speaker_channel(session, block, channel_selector, speaker_str, minimum_num_frames_decoded_per_speaker=5):
+    block, max_channel, has_volume = channel_selector.select(block)
+    update_speaker(session, speaker_str.replace("#c#", str(max_channel)), has_volume, minimum_num_frames_decoded_per_speaker)
+    return block
+
+# Switch the session to a new speaker (channel), the utterance so far is finalized for the previous speaker
+def update_speaker(session, new_speaker, has_volume, minimum_num_frames_decoded_per_speaker=5):
+    if has_volume and new_speaker != session.speaker \
+            and session.prev_num_frames_decoded >= minimum_num_frames_decoded_per_speaker:
+        print("Speaker change! Number of frames decoded for previous speaker:", str(session.prev_num_frames_decoded))
+
+        # The utterance so far belongs to the previous speaker, the current block already to the new one
+        session.finalize()
+        session.speaker = new_speaker
+
 # Advance decoding with one chunk of data
 def advance_mic_decoding(adaptation_state, asr, asr_client, block, chunks_decoded, feat_info, feat_pipeline, key, last_chunk, part, prev_num_frames_decoded,
-                         samp_freq, sil_weighting, speaker, utt):
+                         samp_freq, sil_weighting, speaker, utt, waveform_buffer=None, received=None, audio_end=None):
     need_endpoint_finalize = False
     chunks_decoded += 1
+    # The phases are timed for the latency histograms (see metrics.py). received is the time.monotonic() when the block was
+    # received, for the audio-to-partial latency. audio_end (seconds of audio received so far) is sent with the partial utterance.
+    phase_start = time.perf_counter()
 
     # Let the feature pipeline accept the wavform, take block (numpy array) and convert into Kaldi Vector.
+    # With a waveform_buffer, the block is converted into a reused Kaldi vector instead of a new one (see waveform_buffer.py).
     # This is blocking and Kaldi computes all features updates necessary for the input chunk.
-    feat_pipeline.accept_waveform(samp_freq, Vector(block))
+    waveform = waveform_buffer.to_vector(block) if waveform_buffer is not None else Vector(block)
+    feat_pipeline.accept_waveform(samp_freq, waveform)
 
     # If this is the last chunk of an utterance, inform feature the pipeline to flush all buffers and finialize all features
     if last_chunk:
         feat_pipeline.input_finished()
+    phase_end = time.perf_counter()
+    metrics.phase('accept_waveform', phase_end - phase_start)
+
     if sil_weighting.active():
+        phase_start = phase_end
         sil_weighting.compute_current_traceback(asr.decoder)
 
         # inform ivector feature computation about current silence weighting
         feat_pipeline.ivector_feature().update_frame_weights(
             sil_weighting.get_delta_weights(
                 feat_pipeline.num_frames_ready()))
+        phase_end = time.perf_counter()
+        metrics.phase('silence_weighting', phase_end - phase_start)
 
     # This is where we inform Kaldi to advance the decoding pipeline by one step until the input chunk is completely processed.
+    phase_start = phase_end
     asr.advance_decoding()
     num_frames_decoded = asr.decoder.num_frames_decoded()
+    metrics.phase('advance_decoding', time.perf_counter() - phase_start)
 
     # If the endpointing did not indicate that we are in the last chunk:
     if not last_chunk:
@@ -590,15 +1166,20 @@ def advance_mic_decoding(adaptation_state, asr, asr_client, block, chunks_decode
         # If we do not have decteted an endpoint, check if a new full frame (actually a block of frames) has been decoded and something changed:
         elif num_frames_decoded > prev_num_frames_decoded:
             # Get the partial output from the decoder (best path)
+            phase_start = time.perf_counter()
             out = asr.get_partial_output()
-
-            # Debug output (partial utterance) 
-            print(key + "-utt%d-part%d" % (utt, part),
-                  out["text"], flush=True)
-            # Now send the partial Utterance to the frontend (that then displays it to the user)
-            if asr_client is not None:
-                asr_client.partialUtterance(utterance=out["text"], key=key + "-utt%d-part%d" % (utt, part), speaker=speaker)
-            part += 1
+            metrics.phase('get_partial_output', time.perf_counter() - phase_start)
+
+            # Now send the partial Utterance to the frontend (that then displays it to the user). The client does not send it
+            # if the text did not change or if it is over the rate limit, then the part number is not used up.
+            if asr_client is None or asr_client.partialUtterance(utterance=out["text"], key=key + "-utt%d-part%d" % (utt, part), speaker=speaker,
+                                                                 audio_end=audio_end):
+                if received is not None:
+                    metrics.partial_latency(time.monotonic() - received)
+                # Debug output (partial utterance)
+                print(key + "-utt%d-part%d" % (utt, part),
+                      out["text"], flush=True)
+                part += 1
     return need_endpoint_finalize, num_frames_decoded, part, utt
 
 # Initialize all needed Kaldi object for online feature computation (feat_pipeline) and online decoding (asr object)
@@ -614,26 +1195,56 @@ def initNnetFeatPipeline(adaptation_state, asr, decodable_opts, feat_info):
 
 # This finalizes an utterance and computes confidences.
 # We only compute the confidences (with MBR) on the finalized utterance, not on the partial ones.
-def finalize_decode(asr, asr_client, key, part, speaker, utt):
+def finalize_decode(asr, asr_client, key, part, speaker, utt, confidence_estimator=None, audio_end=None):
+    phase_start = time.perf_counter()
     # Tell Kaldi to finalize decoding
     asr.finalize_decoding()
     # Get final best path and lattice (out is a dict object with out["text"] = best path and out["lattice"] = Kaldi lattice object)
     out = asr.get_output()
-    # Use the lattice to compute MBR confidences
-    mbr = MinimumBayesRisk(out["lattice"])
+    metrics.phase('finalize', time.perf_counter() - phase_start)
+    confd = publish_final_utterance(out, asr_client, key, part, speaker, utt, confidence_estimator, finalize_start=phase_start, audio_end=audio_end)
+    return out, confd
+
+# Like finalize_decode, but only the decoding is finalized here. The MBR confidences are computed and the final utterance is
+# published later by the worker of the asr_client (--async-finalize), while the next utterance is already decoded.
+def finalize_decode_deferred(asr, asr_client, key, part, speaker, utt, confidence_estimator=None, audio_end=None):
+    phase_start = time.perf_counter()
+    asr.finalize_decoding()
+    # The lattice in out is a copy, the decoder does not touch it anymore when the next utterance starts
+    out = asr.get_output()
+    metrics.phase('finalize', time.perf_counter() - phase_start)
+    asr_client.reset_partials()
+    asr_client.defer(publish_final_utterance, out, asr_client, key, part, speaker, utt, confidence_estimator, phase_start, audio_end)
+    return out
+
+# Computes the MBR confidences of a finalized utterance and sends the final utterance to the frontend, returns the confidences.
+# With a confidence_estimator, its --confidence-mode decides how the confidences are computed (see confidences.py).
+# finalize_start is the time.perf_counter() when the finalization started, for the endpoint-to-final latency.
+# audio_end (seconds of audio received by the session) is sent with the final utterance.
+def publish_final_utterance(out, asr_client, key, part, speaker, utt, confidence_estimator=None, finalize_start=None, audio_end=None):
     # confd is a vector with a confidence for each word of the best path
-    confd = mbr.get_one_best_confidences()
+    phase_start = time.perf_counter()
+    if confidence_estimator is not None:
+        confd = confidence_estimator.estimate(out)
+    else:
+        # Use the lattice to compute MBR confidences
+        mbr = MinimumBayesRisk(out["lattice"])
+        confd = mbr.get_one_best_confidences()
+    metrics.phase('mbr', time.perf_counter() - phase_start)
     print(confd)
     print(key + "-utt%d-final" % utt, out["text"], flush=True)
 
     # Now send the final utterance to the frontend (this will also indicate that this is a final utterance and the front displays it differently)
     if asr_client is not None:
-        asr_client.completeUtterance(utterance=out["text"], key=key + "-utt%d-part%d" % (utt, part), confidences=confd, speaker=speaker)
+        asr_client.completeUtterance(utterance=out["text"], key=key + "-utt%d-part%d" % (utt, part), confidences=confd, speaker=speaker,
+                                     audio_end=audio_end)
+    if finalize_start is not None:
+        metrics.final_latency(time.perf_counter() - finalize_start)
 
-    return out, confd
+    return confd
 
 # Reinitialize an already initialized Kaldi pipeline, reset the adaptation state
-def reinitialize_asr(adaptation_state, asr, feat_info, feat_pipeline):
+def reinitialize_asr(adaptation_state, asr, feat_info, feat_pipeline, decodable_opts):
     feat_pipeline.get_adaptation_state(adaptation_state)
     feat_pipeline = OnlineNnetFeaturePipeline(feat_info)
     feat_pipeline.set_adaptation_state(adaptation_state)
@@ -644,10 +1255,217 @@ def reinitialize_asr(adaptation_state, asr, feat_info, feat_pipeline):
         decodable_opts.frame_subsampling_factor)
     return feat_pipeline, sil_weighting
 
+# VAD options for the sessions from the command line, None if the VAD is disabled (neither use-vad in the yaml nor --vad)
+def get_vad_opts(args, session_opts):
+    if not (args.vad or session_opts['use-vad']):
+        return None
+    return {'threshold_db': args.vad_threshold_db, 'preroll_ms': args.vad_preroll_ms, 'hangover_ms': args.vad_hangover_ms}
+
+# Silence timeout of the sessions, from the command line or silence-timeout in the yaml model config
+def get_silence_timeout(args, session_opts):
+    return args.silence_timeout if args.silence_timeout is not None else session_opts['silence-timeout']
+
+# Options of the ConfidenceEstimator of the sessions from the command line (see confidences.py)
+def get_confidence_opts(args):
+    return {'mode': args.confidence_mode, 'beam': args.confidence_beam, 'max_states': args.confidence_max_states}
+
+# Options of the ASRRedisClient (partial utterances, async finalization) from the command line
+def get_client_opts(args):
+    return {'dedup_partials': args.dedup_partials, 'max_partial_rate': args.max_partial_rate, 'partial_deltas': args.partial_deltas,
+            'async_finalize': args.async_finalize}
+
+# Command line options of the decoding sessions (VAD, silence timeout, partial utterances, async finalization, confidences, metrics),
+# shared by nnet3_model.py and session_server.py
+def add_session_arguments(parser):
+    parser.add_argument('--vad', dest='vad', help='Do not decode audio without speech (also enabled by use-vad: True in the yaml model config)',
+                        action='store_true', default=False)
+    parser.add_argument('--vad-threshold-db', dest='vad_threshold_db', help='Minimum energy of speech in dBFS for the VAD', type=float, default=-50.0)
+    parser.add_argument('--vad-preroll-ms', dest='vad_preroll_ms', help='Audio before the start of speech that is decoded as well, so that'
+                                                                        ' word onsets are not clipped', type=int, default=300)
+    parser.add_argument('--vad-hangover-ms', dest='vad_hangover_ms', help='Audio after the end of speech that is still decoded', type=int, default=300)
+    parser.add_argument('--silence-timeout', dest='silence_timeout', help='Suspend a session after this many seconds without speech, it releases'
+                                                                          ' its decoder state until speech returns. 0 disables it. Defaults to'
+                                                                          ' silence-timeout in the yaml model config.', type=float, default=None)
+    parser.add_argument('--max-partial-rate', dest='max_partial_rate', help='Maximum number of partial utterances per second and session,'
+                                                                            ' 0 for no limit', type=float, default=0.0)
+    parser.add_argument('--no-partial-dedup', dest='dedup_partials', help='Also send partial utterances if the text did not change',
+                        action='store_false', default=True)
+    parser.add_argument('--partial-deltas', dest='partial_deltas', help='Send partial utterances as deltas to the previous partial (the unchanged'
+                                                                        ' prefix and the changed words), see example/js/asr.js', action='store_true', default=False)
+    parser.add_argument('--async-finalize', dest='async_finalize', help='Compute the MBR confidences of final utterances and publish all results'
+                                                                        ' in a background thread, so that decoding of the next utterance starts'
+                                                                        ' right away at an endpoint', action='store_true', default=False)
+    parser.add_argument('--confidence-mode', dest='confidence_mode', help='How the word confidences of final utterances are computed: full (MBR on the'
+                                                                          ' full lattice), pruned (MBR on the lattice pruned to --confidence-beam),'
+                                                                          ' capped (prune only lattices with more than --confidence-max-states states)'
+                                                                          ' or none (all 1.0). See confidences.py.', choices=confidence_modes, default='full')
+    parser.add_argument('--confidence-beam', dest='confidence_beam', help='Lattice beam of the pruned and capped confidence modes', type=float, default=6.0)
+    parser.add_argument('--confidence-max-states', dest='confidence_max_states', help='Maximum lattice size (states) of the capped confidence mode',
+                        type=int, default=5000)
+    parser.add_argument('--metrics-interval', dest='metrics_interval', help='Write the latency and real-time factor metrics to redis every this many'
+                                                                            ' seconds, for /metrics of the event server (0 disables it)', type=float, default=10.0)
+
+# A decoding session for one audio stream. Each session has its own feature pipeline, decoder state, silence weighting and
+# ivector adaptation state, while the acoustic model and the decoding graph can be shared with other sessions (see SharedModel).
+# With a silence timeout, the session suspends itself after silence_timeout seconds without speech: it finalizes the utterance
+# and releases its feature pipeline, only the ivector adaptation state is kept. The recognizer is kept as well, it is reset with
+# init_decoding when the session resumes with the first speech block, so that its looped nnet3 computation (compiled when the
+# recognizer is constructed) does not have to be compiled again.
+class ASRSession():
+
+    def __init__(self, asr, feat_info, decodable_opts, asr_client=None, key='mic', speaker='Speaker', samp_freq=16000, vad_opts=None,
+                 silence_timeout=0.0, confidence_opts=None):
+        self.asr = asr
+        self.feat_info = feat_info
+        self.decodable_opts = decodable_opts
+        self.asr_client = asr_client
+        self.key = key
+        self.speaker = speaker
+        self.samp_freq = samp_freq
+
+        self.adaptation_state = OnlineIvectorExtractorAdaptationState.from_info(feat_info.ivector_extractor_info)
+        self.feat_pipeline, self.sil_weighting = initNnetFeatPipeline(self.adaptation_state, asr, decodable_opts, feat_info)
+
+        self.utt, self.part = 1, 1
+        self.prev_num_frames_decoded = 0
+        self.chunks_decoded = 0
+        self.block_received = None
+        # seconds of audio received by the session (including blocks without speech), sent with the utterances (audio_end)
+        self.audio_end = 0.0
+        # the blocks are converted into this reused Kaldi vector, instead of allocating a new one per chunk
+        self.waveform_buffer = WaveformBuffer()
+        # computes the confidences of the final utterances (--confidence-mode, see confidences.py)
+        self.confidence_estimator = ConfidenceEstimator(**(confidence_opts or {}))
+
+        self.silence_timeout = silence_timeout
+        self.suspended = False
+        self.silence_samples = 0
+        self.suspend_count = 0
+
+        # With a VAD, blocks without speech are not decoded at all and the utterance is finalized when the speech ends.
+        # The silence timeout needs a VAD too, without vad_opts it only detects speech but does not gate the audio.
+        self.vad_gating = vad_opts is not None
+        if vad_opts is None and silence_timeout > 0:
+            vad_opts = {}
+        self.vad = EnergyVAD(samp_freq=samp_freq, **vad_opts) if vad_opts is not None else None
+
+    # Decode one block of audio, gated by the VAD if there is one. Returns True if an endpoint was detected.
+    # received is the time.monotonic() when the block was received (defaults to now), for the latency metrics.
+    def decode_block(self, block, last_chunk=False, received=None):
+        start = time.perf_counter()
+        self.block_received = received if received is not None else time.monotonic()
+        audio_secs = len(block) / self.samp_freq
+        self.audio_end += audio_secs
+        need_endpoint_finalize = self.decode_gated_block(block, last_chunk)
+        metrics.chunk(audio_secs, time.perf_counter() - start)
+        return need_endpoint_finalize
+
+    def decode_gated_block(self, block, last_chunk=False):
+        if self.vad is None or last_chunk:
+            if self.suspended:
+                self.resume()
+            return self.decode_speech_block(block, last_chunk)
+
+        speech_blocks, speech_ended = self.vad.process(block)
+        if not self.vad_gating and not self.suspended:
+            speech_blocks = [block]
+
+        if speech_blocks and self.suspended:
+            self.resume()
+
+        need_endpoint_finalize = False
+        for speech_block in speech_blocks:
+            need_endpoint_finalize = self.decode_speech_block(speech_block) or need_endpoint_finalize
+        if speech_ended and self.vad_gating:
+            self.finalize()
+
+        if self.vad.in_speech:
+            self.silence_samples = 0
+        else:
+            self.silence_samples += len(block)
+            if self.silence_timeout > 0 and not self.suspended and self.silence_samples >= self.silence_timeout * self.samp_freq:
+                self.suspend()
+
+        return need_endpoint_finalize
+
+    # Finalize the utterance and release the feature pipeline, only the ivector adaptation state (and the recognizer) is kept
+    def suspend(self):
+        print("Suspending session", self.key, "after", self.silence_timeout, "seconds without speech")
+        self.finalize()
+        self.feat_pipeline.get_adaptation_state(self.adaptation_state)
+        self.feat_pipeline, self.sil_weighting = None, None
+        self.suspended = True
+        self.suspend_count += 1
+
+    def resume(self):
+        print("Resuming session", self.key)
+        self.feat_pipeline, self.sil_weighting = initNnetFeatPipeline(self.adaptation_state, self.asr, self.decodable_opts, self.feat_info)
+        self.suspended = False
+        self.silence_samples = 0
+
+    # Decode one block of audio. If the endpointing detects the end of an utterance, the utterance is finalized and the block
+    # is resend to the new utterance (we only know that the endpoint is inside of the block, but not where exactly).
+    def decode_speech_block(self, block, last_chunk=False):
+        need_endpoint_finalize, self.prev_num_frames_decoded, self.part, self.utt = advance_mic_decoding(self.adaptation_state, self.asr, self.asr_client, block,
+                                                                                                       self.chunks_decoded, self.feat_info, self.feat_pipeline, self.key,
+                                                                                                       last_chunk, self.part, self.prev_num_frames_decoded, self.samp_freq,
+                                                                                                       self.sil_weighting, self.speaker, self.utt,
+                                                                                                       waveform_buffer=self.waveform_buffer, received=self.block_received,
+                                                                                                       audio_end=self.audio_end)
+        self.chunks_decoded += 1
+
+        # Disallow endpoint without a single decoded frame
+        if need_endpoint_finalize and self.prev_num_frames_decoded > 0:
+            print("prev_num_frames_decoded:", self.prev_num_frames_decoded)
+            self.finalize(resend_block=block)
+
+        return need_endpoint_finalize
+
+    # Finalize the current utterance (if something has been decoded) and start a new one.
+    def finalize(self, resend_block=None):
+        if self.prev_num_frames_decoded == 0:
+            return None, None
+
+        # With async finalization (a worker in the asr_client), the confidences are not known yet when the next utterance starts
+        if self.asr_client is not None and self.asr_client.worker is not None:
+            out, confd = finalize_decode_deferred(self.asr, self.asr_client, self.key, self.part, self.speaker, self.utt,
+                                                  self.confidence_estimator, audio_end=self.audio_end), None
+        else:
+            out, confd = finalize_decode(self.asr, self.asr_client, self.key, self.part, self.speaker, self.utt, self.confidence_estimator,
+                                         audio_end=self.audio_end)
+        self.feat_pipeline, self.sil_weighting = reinitialize_asr(self.adaptation_state, self.asr, self.feat_info, self.feat_pipeline, self.decodable_opts)
+        self.utt += 1
+        self.part = 1
+        self.prev_num_frames_decoded = 0
+
+        if resend_block is not None:
+            self.feat_pipeline.accept_waveform(self.samp_freq, self.waveform_buffer.to_vector(resend_block))
+
+        return out, confd
+
+    # Finalize the last utterance of the session, e.g. on shutdown. The session can not be used afterwards.
+    def close(self):
+        print("Waveform buffer stats for", self.key + ":", self.waveform_buffer.stats())
+        if self.vad_gating:
+            print("VAD stats for", self.key + ":", self.vad.stats())
+        if self.silence_timeout > 0:
+            print("Session", self.key, "was suspended", self.suspend_count, "times")
+        # a suspended session has nothing left to finalize
+        if self.suspended:
+            return None, None
+        out, confd = finalize_decode(self.asr, self.asr_client, self.key, self.part, self.speaker, self.utt, self.confidence_estimator,
+                                     audio_end=self.audio_end)
+        print("Confidence stats for", self.key + ":", self.confidence_estimator.stats())
+        return out, confd
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Starts a Kaldi nnet3 decoder')
     parser.add_argument('-i', '--input', dest='input', help='Input scp, simulate online decoding from wav files', type=str, default='scp:wav.scp')
+    parser.add_argument('-j', '--jobs', dest='jobs', help='Number of worker processes for batch decoding of the input scp. '
+                                                          'In batch mode only final utterances are computed and written to --results-file.', type=int, default=1)
+    parser.add_argument('--results-file', dest='results_file', help='Write the final utterances and confidences of batch decoding to this file'
+                                                                    ' (one json object per line, in input order)', type=str, default=None)
     parser.add_argument('-l', '--list-audio-interfaces', dest='list_audio_interfaces', help='List all available audio interfaces on this system', action='store_true', default=False)
 
     parser.add_argument('-m', '--mic-id', dest='micid', help='Microphone ID, if not set to -1, do online decoding directly from the microphone.', type=int, default='-1')
@@ -659,8 +1477,12 @@ if __name__ == '__main__':
     parser.add_argument('-wait', '--wait-for-start-command', dest='wait_for_start_command', help='Do not start decoding directly, wait for a start command from the redis control channel.',
                         action='store_true', default=False)
 
-    parser.add_argument('-hist', '--record-message-history', dest='record_message_history', help='Record message history as a new Python program, useful for debugging and message replay.',
-                        action='store_true', default=False)
+    parser.add_argument('-hist', '--record-message-history', dest='record_message_history', help='Stream the message history to disk, useful for debugging and message replay'
+                                                                                                ' with replay_messages.py.', action='store_true', default=False)
+    parser.add_argument('--history-prefix', dest='history_prefix', help='File prefix of the message history recording (-hist), files are rotated as'
+                                                                        ' <prefix>.0000.jsonl, <prefix>.0001.jsonl, ... Defaults to message_history_<date>_<time>.',
+                        type=str, default=None)
+    parser.add_argument('--history-max-mb', dest='history_max_mb', help='Rotate the message history file when it gets larger than this (in MB)', type=int, default=64)
 
     parser.add_argument('-s', '--speaker-name', dest='speaker_name', help='Name of the speaker, use #c# for channel', type=str, default='speaker#c#')
     parser.add_argument('-cs', '--chunk_size', dest='chunk_size', help='Default buffer size for the microphone buffer.', type=int, default=1024)
@@ -674,57 +1496,140 @@ if __name__ == '__main__':
     parser.add_argument('-red', '--redis-channel', dest='redis_channel', help='Name of the channel (for redis-server)', type=str, default='asr')
 
     parser.add_argument('--redis-audio', dest='redis_audio_channel', help='Name of the channel (for redis-server)', type=str, default='asr_audio')
+    parser.add_argument('--redis-transport', dest='redis_transport', help='pubsub (default) or streams: with streams, audio is read with a consumer group'
+                                                                          ' from the redis stream --redis-audio and results are also added to the stream <redis-channel>:stream',
+                        choices=['pubsub', 'streams'], default='pubsub')
+    parser.add_argument('--consumer-name', dest='consumer_name', help='Consumer name in the redis stream consumer group. Keep it stable across restarts'
+                                                                      ' to resume from the last acknowledged audio.', type=str, default='decoder')
+    parser.add_argument('--result-encoding', dest='result_encoding', help='Encoding of the messages in the redis channel: json (default) or msgpack,'
+                                                                          ' which is more compact. The event server translates msgpack to json for the browser.',
+                        choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--jitter-ms', dest='jitter_ms', help='Size of the jitter buffer for audio from redis (-e) in milliseconds', type=int, default=100)
     parser.add_argument('--redis-control', dest='redis_control_channel', help='Name of the channel (for redis-server)', type=str, default='asr_control')
 
     parser.add_argument('-y', '--yaml-config', dest='yaml_config', help='Path to the yaml model config', type=str, default='models/kaldi_tuda_de_nnet3_chain2.yaml')
     parser.add_argument('-o', '--online-config', dest='online_config', help='Path to the Kaldi online config. If not available, will try to read the parameters from the yaml'
                                                                             ' file and convert it to the Kaldi online config format (See online_config_options.info.txt for details)',
                                                                             type=str, default='models/kaldi_tuda_de_nnet3_chain2.online.conf')
+    parser.add_argument('-b', '--bundle', dest='bundle', help='Load the model from this precompiled model bundle directory if it is valid'
+                                                              ' (falls back to the yaml config otherwise)', type=str, default=None)
+    parser.add_argument('--prepare-bundle', dest='prepare_bundle', help='Precompile the model given by the yaml config into this bundle directory and exit',
+                        type=str, default=None)
     parser.add_argument('-r', '--record-samplerate', dest='record_samplerate', help='The recording samplingrate if a microphone is used', type=int, default=16000)
     parser.add_argument('-d', '--decode-samplerate', dest='decode_samplerate', help='Decode samplerate, if not the same as the microphone samplerate '
                                                                                     'then the signal is automatically resampled', type=int, default=16000)
 
-    parser.add_argument('-a', '--resample_algorithm', dest='resample_algorithm', help="One of the following: linear, sinc_best, sinc_fastest,"
-                                                                                      " sinc_medium, zero_order_hold (default: sinc_best)",
-                                                                                      type=str, default="sinc_fastest")
+    parser.add_argument('-a', '--resample_algorithm', dest='resample_algorithm', help="One of the following: polyphase (precomputed polyphase"
+                                                                                      " filters, no extra dependency), linear, sinc_best, sinc_fastest,"
+                                                                                      " sinc_medium, zero_order_hold (libsamplerate) (default: sinc_fastest)",
+                                                                                      type=str, default="sinc_fastest", choices=resample_algorithms)
+
+    parser.add_argument('-t', '--use-threads', dest='use_threads', help='Use a pipeline of threads for realtime decoding: capture, resampling/channel'
+                                                                        ' selection and decoding run in parallel', action='store_true', default=False)
+    parser.add_argument('--pipeline-queue-size', dest='pipeline_queue_size', help='Maximum number of chunks queued in front of every pipeline stage (-t),'
+                                                                                  ' a full queue blocks the previous stage', type=int, default=8)
 
-    parser.add_argument('-t', '--use-threads', dest='use_threads', help='Use a thread worker for realtime decoding',
+    parser.add_argument('--asyncio', dest='use_asyncio', help='Use the event driven (asyncio) decoding loop, that does not use any CPU while idle',
                         action='store_true', default=False)
 
     parser.add_argument('-mf', '--minimum-num-frames-decoded-per-speaker', dest='minimum_num_frames_decoded_per_speaker',
                         help='Minimum number of frames that need to be decoded per speaker until a speaker change can happen',
                         type=int, default=5)
 
+    parser.add_argument('--channel-smoothing', dest='channel_smoothing', help='Smooth the channel volumes over time for the speaker channel selection'
+                                                                              ' (weight of the previous chunks, 0 = no smoothing)', type=float, default=0.0)
+    parser.add_argument('--channel-hysteresis-db', dest='channel_hysteresis_db', help='Another channel must be louder than the current one by this'
+                                                                                      ' many dB to be selected. Can be used instead of -mf.', type=float, default=0.0)
+
+    add_session_arguments(parser)
+
     parser.add_argument('-w', '--save_debug_wav', dest='save_debug_wav', help='This will write out a debug.wav (resampled)'
                                                                               ' and debugraw.wav (original) after decoding,'
                                                                               ' so that the recording quality can be analysed', action='store_true', default=False)
 
+    parser.add_argument('--import-report', dest='import_report', help='Print how long the imports of all (lazily imported) modules took',
+                        action='store_true', default=False)
+
     args = parser.parse_args()
+
+    # The asyncio loop reads plain pubsub audio and has no thread pipeline, do not silently ignore the options
+    if args.use_asyncio and args.use_threads:
+        parser.error('--asyncio can not be combined with -t/--use-threads')
+    if args.use_asyncio and args.redis_transport == 'streams':
+        parser.error('--asyncio only supports --redis-transport pubsub')
     
     # Start redis
     red = redis.StrictRedis(host=args.redis_server)
     
     if args.list_audio_interfaces:
         print("Listing audio interfaces...")
-        paudio = pyaudio.PyAudio()
+        paudio = lazy_import('pyaudio').PyAudio()
         print_devices(paudio)
+    elif args.prepare_bundle is not None:
+        prepare_model_bundle(args.yaml_config, args.online_config, args.prepare_bundle)
     else:
-        asr_client = ASRRedisClient(red=red, server=args.redis_server, channel=args.redis_channel, record_message_history=args.record_message_history)
+        message_recorder = None
+        if args.record_message_history:
+            message_recorder = MessageRecorder(prefix=args.history_prefix or time.strftime('message_history_%Y%m%d_%H%M%S'),
+                                               max_bytes=args.history_max_mb*1024*1024)
+        asr_client = ASRRedisClient(red=red, server=args.redis_server, channel=args.redis_channel, message_recorder=message_recorder,
+                                    result_stream=args.redis_channel + ':stream' if args.redis_transport == 'streams' else None,
+                                    encoding=args.result_encoding, **get_client_opts(args))
         asr_client.asr_loading(speaker=args.speaker_name)
-        asr, feat_info, decodable_opts = load_model(args.yaml_config, args.online_config, beam_size=args.beam_size, frames_per_chunk=args.frames_per_chunk)
-        if args.micid == -1:
+        phase_timer = PhaseTimer()
+        asr, feat_info, decodable_opts, session_opts = load_model(args.yaml_config, args.online_config, beam_size=args.beam_size, frames_per_chunk=args.frames_per_chunk,
+                                                    bundle_dir=args.bundle, phase_timer=phase_timer)
+        phase_timer.report('Model loading')
+        asr_client.load_timings = phase_timer.as_dict()
+        if args.import_report:
+            print_import_report()
+        if args.micid == -1 and (args.jobs > 1 or args.results_file is not None):
+            print("Batch decoding wav scp:", args.input)
+            decode_scp_parallel(asr, feat_info, decodable_opts, args.input, args.results_file or 'results.jsonl',
+                                jobs=args.jobs, chunk_size=args.chunk_size)
+        elif args.micid == -1:
             print("Reading from wav scp:", args.input)
             asr_client.asr_ready(speaker=args.speaker_name)
             decode_chunked_partial_endpointing(asr, feat_info, decodable_opts, args.input,
                                                asr_client=asr_client, speaker=args.speaker_name,
-                                               chunk_size=args.chunk_size)
+                                               chunk_size=args.chunk_size, confidence_opts=get_confidence_opts(args))
         else:
-            paudio = pyaudio.PyAudio()
-            decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts, paudio, asr_client=asr_client,
-                                                   input_microphone_id=args.micid, speaker_str=args.speaker_name,
-                                                   samp_freq=args.decode_samplerate, record_samplerate=args.record_samplerate,
-                                                   chunk_size=args.chunk_size, wait_for_start_command=args.wait_for_start_command,
-                                                   record_message_history=args.record_message_history, channels=args.channels,
-                                                   resample_algorithm=args.resample_algorithm, save_debug_wav=args.save_debug_wav, use_threads=args.use_threads,
-                                                   minimum_num_frames_decoded_per_speaker=args.minimum_num_frames_decoded_per_speaker, use_local_mic=not args.enable_server_mic,
-                                                   decode_control_channel=args.redis_control_channel, audio_data_channel=args.redis_audio_channel)
+            # PortAudio is only needed for a local microphone, not for audio from redis (-e)
+            paudio = None if args.enable_server_mic else lazy_import('pyaudio').PyAudio()
+            # Latency and real-time factor metrics for /metrics of the event server (see metrics.py)
+            metrics_reporter = None
+            if args.metrics_interval > 0:
+                metrics_reporter = MetricsReporter(red, interval=args.metrics_interval)
+                metrics_reporter.start()
+            if args.use_asyncio:
+                asyncio.run(decode_chunked_partial_endpointing_async(asr, feat_info, decodable_opts, paudio, asr_client=asr_client,
+                                                                     input_microphone_id=args.micid, speaker_str=args.speaker_name,
+                                                                     samp_freq=args.decode_samplerate, record_samplerate=args.record_samplerate,
+                                                                     chunk_size=args.chunk_size, wait_for_start_command=args.wait_for_start_command,
+                                                                     channels=args.channels, resample_algorithm=args.resample_algorithm,
+                                                                     minimum_num_frames_decoded_per_speaker=args.minimum_num_frames_decoded_per_speaker,
+                                                                     use_local_mic=not args.enable_server_mic, redis_server=args.redis_server,
+                                                                     decode_control_channel=args.redis_control_channel, audio_data_channel=args.redis_audio_channel,
+                                                                     channel_smoothing=args.channel_smoothing, channel_hysteresis_db=args.channel_hysteresis_db,
+                                                                     vad_opts=get_vad_opts(args, session_opts),
+                                                                     silence_timeout=get_silence_timeout(args, session_opts),
+                                                                     confidence_opts=get_confidence_opts(args), save_debug_wav=args.save_debug_wav))
+            else:
+                decode_chunked_partial_endpointing_mic(asr, red, feat_info, decodable_opts, paudio, asr_client=asr_client,
+                                                       input_microphone_id=args.micid, speaker_str=args.speaker_name,
+                                                       samp_freq=args.decode_samplerate, record_samplerate=args.record_samplerate,
+                                                       chunk_size=args.chunk_size, wait_for_start_command=args.wait_for_start_command,
+                                                       channels=args.channels,
+                                                       resample_algorithm=args.resample_algorithm, save_debug_wav=args.save_debug_wav, use_threads=args.use_threads,
+                                                       minimum_num_frames_decoded_per_speaker=args.minimum_num_frames_decoded_per_speaker, use_local_mic=not args.enable_server_mic,
+                                                       decode_control_channel=args.redis_control_channel, audio_data_channel=args.redis_audio_channel,
+                                                       jitter_ms=args.jitter_ms, use_audio_stream=args.redis_transport == 'streams',
+                                                       consumer_name=args.consumer_name, pipeline_queue_size=args.pipeline_queue_size,
+                                                       channel_smoothing=args.channel_smoothing, channel_hysteresis_db=args.channel_hysteresis_db,
+                                                       vad_opts=get_vad_opts(args, session_opts),
+                                                       silence_timeout=get_silence_timeout(args, session_opts),
+                                                       confidence_opts=get_confidence_opts(args))
+            if metrics_reporter is not None:
+                metrics_reporter.stop()
+        print("Partial utterances:", asr_client.partial_stats())
+        asr_client.close()
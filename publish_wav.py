@@ -1,26 +1,67 @@
+import argparse
+import sys
+import time
+
+import numpy as np
 import redis
-from time import sleep
 import soundfile as sf
-import numpy as np
-import time
 
-red = redis.StrictRedis()
 
-print(sys.argv)
-signal, samplerate = sf.read(sys.argv[1])
+# Read a wav file as int16 samples (interleaved, if it has more than one channel)
+def read_wav(filename):
+    signal, samplerate = sf.read(filename)
+    signal = (signal * (2**15)).clip(-32768, 32767).astype(np.int16)
+    return signal.reshape(-1), samplerate, signal.shape[1] if signal.ndim > 1 else 1
+
+
+# Publish the signal in packets of packet_size frames to the audio channel, speed times faster than real time.
+# Every packet is sent at its own deadline (start + audio time of the packet), so that the time spent publishing does
+# not accumulate into drift. on_publish(packet index, audio end in seconds, publish time, number of receivers, lag) is
+# called after every packet, lag is how much later than its deadline the packet was published.
+# With stream_maxlen, audio_data_channel is a redis stream: every packet is added as an entry with the field 'audio' and the
+# stream is trimmed to about stream_maxlen entries (the number of receivers is then None).
+def publish_paced(red, audio_data_channel, signal, samplerate, channels=1, packet_size=4096, speed=1.0, start=None, on_publish=None,
+                  stream_maxlen=None):
+    start = time.monotonic() if start is None else start
+    samples_per_packet = packet_size * channels
+    for i, offset in enumerate(range(0, len(signal), samples_per_packet)):
+        deadline = start + offset / channels / samplerate / speed
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        packet = signal[offset:offset + samples_per_packet].tobytes()
+        if stream_maxlen is not None:
+            red.xadd(audio_data_channel, {'audio': packet}, maxlen=stream_maxlen, approximate=True)
+            receivers = None
+        else:
+            receivers = red.publish(audio_data_channel, packet)
+        now = time.monotonic()
+        if on_publish is not None:
+            on_publish(i, min(offset + samples_per_packet, len(signal)) / channels / samplerate, now, receivers, now - deadline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Publish a wav file to the redis audio channel in real time, as if it was recorded')
+    parser.add_argument('wav', help='The wav file', type=str)
+    parser.add_argument('--redis-audio', dest='redis_audio_channel', help='Name of the audio channel', type=str, default='asr_audio')
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the redis server', type=str, default='localhost')
+    parser.add_argument('-p', '--packet-size', dest='packet_size', help='Frames per published packet', type=int, default=4096)
+    parser.add_argument('-s', '--speed', dest='speed', help='Publish this many times faster than real time', type=float, default=1.0)
+    parser.add_argument('--redis-transport', dest='redis_transport', help='pubsub (default) or streams: add the audio to the redis stream --redis-audio',
+                        choices=['pubsub', 'streams'], default='pubsub')
+    parser.add_argument('--stream-maxlen', dest='stream_maxlen', help='Trim the audio stream to about this many entries (streams transport)',
+                        type=int, default=10000)
+    args = parser.parse_args()
 
-signal = (signal * (2**15)).astype(np.int16)
-# signal = signal[:, 0]
-print(samplerate)
-print(signal.shape)
+    red = redis.StrictRedis(host=args.redis_server)
 
-audio_data_channel = 'asr_audio'
+    print(sys.argv)
+    signal, samplerate, channels = read_wav(args.wav)
+    print(samplerate)
+    print(signal.shape, channels)
 
-chunks = [signal[x:x+4096] for x in range(0, len(signal), 4096)]
+    def print_publish(i, audio_end, now, receivers, lag):
+        print("publish", i, "%.2fs" % audio_end, "lag: %.1fms" % (lag * 1000.0))
 
-for chunk in chunks:
-    t1 = time.time()
-    red.publish(audio_data_channel, np.array(chunk.reshape(-1)).tobytes())
-    print("publish")
-    t2 = time.time()
-    sleep((4096.0 / 16000.0) - (t2 - t1))
+    publish_paced(red, args.redis_audio_channel, signal, samplerate, channels=channels, packet_size=args.packet_size, speed=args.speed,
+                  on_publish=print_publish, stream_maxlen=args.stream_maxlen if args.redis_transport == 'streams' else None)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Replays message history recordings (nnet3_model.py -hist, see message_recorder.py) into the asr channel, with the
+original timing scaled by --time-factor. Many recordings (and copies of them) are replayed in parallel, which makes this
+a load generator for the event server and the frontend. A pacing report compares the achieved with the target timing.
+"""
+
+import argparse
+import json
+import threading
+import time
+
+import redis
+
+from message_codec import get_codec
+from message_recorder import recording_files
+
+
+# Messages of a recording in order as (ts, message json), the files are read lazily line by line
+def read_recording(prefix):
+    for file_name in recording_files(prefix):
+        with open(file_name) as recording_in:
+            for line in recording_in:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                yield record['ts'], record['data']
+
+
+# Replays one recording into a redis channel in its own thread. Messages are sent at deadlines relative to the start
+# of the replay (not with relative sleeps), so that the timing errors do not add up over a long recording.
+class Replay(threading.Thread):
+
+    def __init__(self, red, prefix, channel, codec, time_factor=1.0, start_time=None, verbose=False):
+        super().__init__(daemon=True)
+        self.red = red
+        self.prefix = prefix
+        self.channel = channel
+        self.codec = codec
+        self.time_factor = time_factor
+        self.start_time = start_time
+        self.verbose = verbose
+
+        self.num_messages = 0
+        self.target_secs = 0.0
+        self.achieved_secs = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def run(self):
+        start_time = self.start_time if self.start_time is not None else time.time()
+        first_ts = None
+        for ts, data in read_recording(self.prefix):
+            if first_ts is None:
+                first_ts = ts
+            deadline = start_time + (ts - first_ts) * self.time_factor
+            wait = deadline - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+            self.red.publish(self.channel, self.codec.encode(data))
+            if self.verbose:
+                print(self.channel, data)
+
+            lag = max(0.0, time.time() - deadline)
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            self.num_messages += 1
+            self.target_secs = deadline - start_time
+        self.achieved_secs = time.time() - start_time
+
+    def mean_lag(self):
+        return self.total_lag / self.num_messages if self.num_messages > 0 else 0.0
+
+
+def print_pacing_report(replays, time_factor):
+    print('Replay pacing report (time factor %.3f):' % time_factor)
+    print('%-40s %10s %12s %12s %14s %13s' % ('recording', 'messages', 'target (s)', 'achieved (s)', 'mean lag (ms)', 'max lag (ms)'))
+    for replay in replays:
+        print('%-40s %10d %12.3f %12.3f %14.2f %13.2f' % (replay.prefix + ' -> ' + replay.channel, replay.num_messages, replay.target_secs,
+                                                          replay.achieved_secs, replay.mean_lag() * 1000.0, replay.max_lag * 1000.0))
+    num_messages = sum(replay.num_messages for replay in replays)
+    achieved_secs = max([replay.achieved_secs for replay in replays] + [0.0])
+    print('Total: %d messages in %.3f seconds (%.1f messages/s), max lag %.2f ms' % (num_messages, achieved_secs,
+          num_messages / achieved_secs if achieved_secs > 0 else 0.0, max([replay.max_lag for replay in replays] + [0.0]) * 1000.0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay message history recordings into redis')
+    parser.add_argument('recordings', help='Recording prefixes (or single .jsonl files) to replay in parallel', nargs='+')
+    parser.add_argument('-tf', '--time-factor', dest='time_factor', help='Scale the original timing, e.g. 0.5 replays twice as fast,'
+                                                                         ' 0 as fast as possible', type=float, default=1.0)
+    parser.add_argument('-n', '--copies', dest='copies', help='Number of parallel replays of every recording', type=int, default=1)
+    parser.add_argument('--separate-channels', dest='separate_channels', help='Replay every copy into its own channel <redis-channel>:<n>'
+                                                                              ' instead of the same channel', action='store_true', default=False)
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the server (for redis-server)', type=str, default='localhost')
+    parser.add_argument('-red', '--redis-channel', dest='redis_channel', help='Name of the channel (for redis-server)', type=str, default='asr')
+    parser.add_argument('--result-encoding', dest='result_encoding', help='Encoding of the replayed messages: json (default) or msgpack',
+                        choices=['json', 'msgpack'], default='json')
+    parser.add_argument('-v', '--verbose', dest='verbose', help='Print every replayed message', action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    red = redis.StrictRedis(host=args.redis_server)
+    codec = get_codec(args.result_encoding)
+
+    for prefix in args.recordings:
+        if not recording_files(prefix):
+            parser.error('No recording found for ' + prefix)
+
+    # All replays start at the same time, after all threads were created
+    start_time = time.time() + 0.1
+    replays = []
+    for prefix in args.recordings:
+        for copy in range(args.copies):
+            channel = args.redis_channel + ':' + str(len(replays)) if args.separate_channels else args.redis_channel
+            replays.append(Replay(red, prefix, channel, codec, time_factor=args.time_factor, start_time=start_time, verbose=args.verbose))
+
+    print('Replaying', len(replays), 'recordings')
+    for replay in replays:
+        replay.start()
+    for replay in replays:
+        replay.join()
+
+    print_pacing_report(replays, args.time_factor)
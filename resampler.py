@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Streaming resamplers for mono int16 blocks, from the recording samplerate to the decoding samplerate.
+PolyphaseResampler (-a polyphase) is a rational ratio resampler (e.g. 48k -> 16k is 1/3, 44.1k -> 16k is 160/441) with
+precomputed polyphase filters, it writes into preallocated output buffers. The other algorithms use libsamplerate.
+"""
+
+import math
+
+import numpy as np
+
+from lazy_imports import lazy_import
+
+libsamplerate_algorithms = ['linear', 'sinc_best', 'sinc_fastest', 'sinc_medium', 'zero_order_hold']
+resample_algorithms = ['polyphase'] + libsamplerate_algorithms
+
+
+# Resampling by up/down with a Kaiser windowed sinc lowpass. The lowpass of length up * taps_per_phase is split into
+# up phases, every output sample is the dot product of one phase with the last taps_per_phase input samples.
+# The output blocks are views into num_buffers preallocated buffers that are used in turn, so an output block is only
+# valid until num_buffers more blocks were processed (e.g. use the queue size + 2 if blocks are queued).
+class PolyphaseResampler():
+
+    def __init__(self, in_rate, out_rate, taps_per_phase=64, beta=7.0, rolloff=0.92, num_buffers=1):
+        divisor = math.gcd(in_rate, out_rate)
+        self.up = out_rate // divisor
+        self.down = in_rate // divisor
+        self.taps = taps_per_phase
+
+        # Lowpass at the upsampled rate, cut off at rolloff times the lower of the two Nyquist frequencies. The gain of up
+        # compensates for the zeros that upsampling inserts.
+        num_taps = self.up * taps_per_phase
+        cutoff = rolloff / max(self.up, self.down)
+        m = np.arange(num_taps) - (num_taps - 1) / 2.0
+        h = self.up * cutoff * np.sinc(cutoff * m) * np.kaiser(num_taps, beta)
+
+        # filters[p] is phase p, reversed so that it can be applied to a window of the input in ascending order
+        self.filters = np.ascontiguousarray(h.reshape(taps_per_phase, self.up).T[:, ::-1], dtype=np.float32)
+
+        # The input is appended to the last taps - 1 samples of the previous block
+        self.history = np.zeros(self.taps - 1, dtype=np.float32)
+        self.input_buffer = np.zeros(0, dtype=np.float32)
+        # position of the next output sample at the upsampled rate, relative to the first sample of the next block
+        self.t = 0
+
+        self.num_buffers = num_buffers
+        self.out_buffers = []
+        self.next_buffer = 0
+
+    def output_buffer(self, num_samples):
+        if len(self.out_buffers) < self.num_buffers:
+            self.out_buffers.append(np.empty(num_samples, dtype=np.int16))
+        buffer = self.out_buffers[self.next_buffer]
+        if len(buffer) < num_samples:
+            buffer = self.out_buffers[self.next_buffer] = np.empty(num_samples, dtype=np.int16)
+        self.next_buffer = (self.next_buffer + 1) % self.num_buffers
+        return buffer[:num_samples]
+
+    def process(self, block):
+        n = len(block)
+        size = self.taps - 1 + n
+        if len(self.input_buffer) < size:
+            self.input_buffer = np.empty(size, dtype=np.float32)
+        x = self.input_buffer[:size]
+        x[:self.taps - 1] = self.history
+        x[self.taps - 1:] = block
+
+        # All output samples whose newest input sample is in this block
+        num_out = max(0, -(-(n * self.up - self.t) // self.down))
+        t = self.t + self.down * np.arange(num_out)
+        newest = t // self.up
+        phases = t % self.up
+
+        windows = np.lib.stride_tricks.sliding_window_view(x, self.taps)
+        if self.up == 1:
+            # Integer decimation (e.g. 48k -> 16k): one filter, the windows are a strided view of the input
+            y = windows[newest[0]:newest[0] + self.down * num_out:self.down] @ self.filters[0] if num_out > 0 else np.zeros(0, dtype=np.float32)
+        else:
+            y = np.einsum('ij,ij->i', windows[newest], self.filters[phases])
+
+        self.t += self.down * num_out - n * self.up
+        self.history[:] = x[n:]
+
+        out = self.output_buffer(num_out)
+        np.rint(y, out=y)
+        np.clip(y, -32768, 32767, out=y)
+        out[:] = y
+        return out
+
+
+# libsamplerate (the samplerate package) with one of its converters
+class LibsamplerateResampler():
+
+    def __init__(self, in_rate, out_rate, algorithm='sinc_fastest'):
+        self.resampler = lazy_import('samplerate').Resampler(algorithm, channels=1)
+        self.ratio = out_rate / in_rate
+
+    def process(self, block):
+        return np.array(self.resampler.process(block, self.ratio), dtype=np.int16)
+
+
+def make_resampler(algorithm, in_rate, out_rate, num_buffers=1):
+    if algorithm == 'polyphase':
+        return PolyphaseResampler(in_rate, out_rate, num_buffers=num_buffers)
+    if algorithm in libsamplerate_algorithms:
+        return LibsamplerateResampler(in_rate, out_rate, algorithm)
+    raise ValueError('Unknown resample algorithm: %s (available: %s)' % (algorithm, ', '.join(resample_algorithms)))
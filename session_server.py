@@ -0,0 +1,463 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Multi-session decoding server. The acoustic model and the decoding graph are loaded once per process,
+every session (audio stream) only adds its own feature pipeline and decoder state.
+
+This is a decoder-only entry point: audio only comes from redis, so neither PortAudio (pyaudio) nor scipy or samplerate
+are imported. With a model bundle (-b), not even yaml is needed.
+
+Sessions are opened and closed on the control channel ("open <session>", "close <session>"), the audio of a session
+is expected as raw int16 samples on <audio channel>:<session>. Results of all sessions are published to the
+result channel, with the session name as speaker.
+
+With --workers N the model is loaded once in a parent process, which then forks N decoder workers. The workers share the
+pages of the model and the graph copy-on-write, so decoding scales over multiple cores without loading the model N times.
+The parent dispatches new sessions to the worker with the fewest open sessions.
+
+With --redis-transport streams, sessions are opened with entries ("command": "open <session>") in the control stream and the
+audio is read from the stream <audio channel>:<session>, both with a consumer group. Every open command is delivered to exactly
+one worker, which then owns the session. The open entry stays pending (unacknowledged) until the session is closed with a
+"close" entry in its audio stream, so a restarted worker (same consumer name) re-reads the open entries of its sessions,
+reopens them and resumes their audio from the last acknowledged entry. The producers bound the audio streams (XADD with MAXLEN ~).
+"""
+
+import argparse
+import gc
+import multiprocessing
+
+import numpy as np
+import redis
+
+from audio_ingest import ensure_consumer_group
+from nnet3_model import (ASRRedisClient, ASRSession, add_session_arguments, get_client_opts, get_confidence_opts, get_silence_timeout,
+                         get_vad_opts, load_shared_model_cached)
+from metrics import MetricsReporter
+from lazy_imports import print_import_report
+from timer import PhaseTimer
+
+
+class SessionManager():
+
+    def __init__(self, model, red, redis_server='localhost', redis_channel='asr', audio_data_channel='asr_audio',
+                 samp_freq=16000, result_stream=None, result_encoding='json', session_kwargs=None, client_kwargs=None):
+        self.model = model
+        self.red = red
+        self.redis_server = redis_server
+        self.redis_channel = redis_channel
+        self.audio_data_channel = audio_data_channel
+        self.samp_freq = samp_freq
+        self.result_stream = result_stream
+        self.result_encoding = result_encoding
+        # keyword arguments of the sessions (vad_opts, silence_timeout, confidence_opts), see ASRSession
+        self.session_kwargs = session_kwargs if session_kwargs is not None else {}
+        # keyword arguments of the redis clients of the sessions (partial utterances, async finalization), see ASRRedisClient
+        self.client_kwargs = client_kwargs if client_kwargs is not None else {}
+
+        self.sessions = {}
+        self.pubsub = red.pubsub()
+
+    def session_audio_channel(self, session_id):
+        return self.audio_data_channel + ':' + session_id
+
+    def open_session(self, session_id):
+        if session_id in self.sessions:
+            print('Session already open:', session_id)
+            return self.sessions[session_id]
+
+        print('Opening session:', session_id)
+        asr_client = ASRRedisClient(red=self.red, server=self.redis_server, channel=self.redis_channel, result_stream=self.result_stream,
+                                    encoding=self.result_encoding, **self.client_kwargs)
+        session = ASRSession(self.model.new_recognizer(), self.model.feat_info, self.model.decodable_opts,
+                             asr_client=asr_client, key=session_id, speaker=session_id, samp_freq=self.samp_freq,
+                             **self.session_kwargs)
+        self.sessions[session_id] = session
+        self.pubsub.subscribe(self.session_audio_channel(session_id))
+
+        asr_client.asr_ready(speaker=session_id)
+        return session
+
+    def close_session(self, session_id):
+        session = self.sessions.pop(session_id, None)
+        if session is None:
+            print('Can not close unknown session:', session_id)
+            return
+
+        print('Closing session:', session_id)
+        self.pubsub.unsubscribe(self.session_audio_channel(session_id))
+        session.close()
+        print('Partial utterances of session', session_id + ':', session.asr_client.partial_stats())
+        session.asr_client.sendstatus(isDecoding=False, shutdown=True)
+        session.asr_client.close()
+
+    def close_all(self):
+        for session_id in list(self.sessions):
+            self.close_session(session_id)
+
+    def handle_audio(self, session_id, data):
+        session = self.sessions.get(session_id)
+        if session is None:
+            return
+        session.decode_block(np.frombuffer(data, dtype=np.int16))
+
+    # Handles a control message, returns False if the server should shut down
+    def handle_control(self, data):
+        command, _, session_id = data.decode('utf-8').strip().partition(' ')
+
+        if command == 'open' and session_id:
+            self.open_session(session_id)
+        elif command == 'close' and session_id:
+            self.close_session(session_id)
+        elif command == 'status':
+            for session in self.sessions.values():
+                session.asr_client.sendstatus(isDecoding=True)
+        elif command == 'shutdown':
+            print('Shutdown command received!')
+            return False
+        else:
+            print('Unknown control message:', data)
+
+        return True
+
+    # Main loop, blocks on redis until there is a control message or audio data for one of the open sessions.
+    # If ready is set (a multiprocessing.Event), it is signaled as soon as the control channel subscription is active.
+    def serve(self, control_channel, ready=None):
+        self.pubsub.subscribe(control_channel)
+        audio_prefix = self.audio_data_channel + ':'
+        print('Session server is ready, listening on control channel:', control_channel)
+
+        for msg in self.pubsub.listen():
+            if msg['type'] == 'subscribe' and ready is not None and msg['channel'].decode('utf-8') == control_channel:
+                ready.set()
+            if msg['type'] != 'message':
+                continue
+
+            channel = msg['channel'].decode('utf-8')
+            if channel == control_channel:
+                if not self.handle_control(msg['data']):
+                    break
+            elif channel.startswith(audio_prefix):
+                self.handle_audio(channel[len(audio_prefix):], msg['data'])
+
+        self.close_all()
+        self.pubsub.close()
+
+    # Main loop for the redis streams transport. Blocks in XREADGROUP on the control stream and the audio streams of all
+    # sessions of this worker. Audio entries are acknowledged after they were processed, the open entry of a session only
+    # when the session is closed, so that its sessions are recovered after a restart. Shutdown is still signaled with pub/sub.
+    def serve_streams(self, control_stream, group, consumer, shutdown_channel, ready=None):
+        ensure_consumer_group(self.red, control_stream, group)
+        self.pubsub.subscribe(shutdown_channel)
+        audio_prefix = self.audio_data_channel + ':'
+        print('Session server is ready, reading control stream:', control_stream, 'as', group + '/' + consumer)
+        if ready is not None:
+            ready.set()
+
+        # Per stream, we first re-read our pending (delivered but unacknowledged) entries from '0', then only new ones ('>')
+        read_ids = {control_stream: '0'}
+        # The pending open entry in the control stream of every session of this worker
+        open_entries = {}
+        while True:
+            msg = self.pubsub.get_message()
+            if msg is not None and msg['type'] == 'message' and msg['data'] == b'shutdown':
+                print('Shutdown command received!')
+                break
+
+            requested = dict(read_ids)
+            response = self.red.xreadgroup(group, consumer, requested, count=100, block=500)
+            returned = set()
+            for stream, entries in response or []:
+                stream = stream.decode('utf-8')
+                returned.add(stream)
+                for entry_id, fields in entries:
+                    if stream == control_stream:
+                        command = fields.get(b'command', b'')
+                        session_id = command[5:].decode('utf-8').strip() if command.startswith(b'open ') else None
+                        if session_id and session_id not in open_entries:
+                            self.open_session(session_id)
+                            open_entries[session_id] = entry_id
+                            ensure_consumer_group(self.red, self.session_audio_channel(session_id), group, start_id='0')
+                            read_ids[self.session_audio_channel(session_id)] = '0'
+                            continue
+                    else:
+                        session_id = stream[len(audio_prefix):]
+                        if b'close' in fields:
+                            self.close_session(session_id)
+                            read_ids.pop(stream, None)
+                            if session_id in open_entries:
+                                self.red.xack(control_stream, group, open_entries.pop(session_id))
+                        elif b'audio' in fields:
+                            self.handle_audio(session_id, fields[b'audio'])
+                    self.red.xack(stream, group, entry_id)
+                if read_ids.get(stream) not in (None, '>'):
+                    read_ids[stream] = entries[-1][0] if entries else '>'
+
+            # Pending entries of a stream are exhausted if the stream was not returned at all
+            for stream in requested:
+                if stream in read_ids and read_ids[stream] != '>' and stream not in returned:
+                    read_ids[stream] = '>'
+
+        self.close_all()
+        self.pubsub.close()
+
+
+# Entry point of a forked decoder worker. The model was loaded by the parent, only the redis connection must be new.
+# With a consumer name, the worker reads the control stream with its consumer group (streams transport).
+def worker_main(worker_id, model, redis_server, redis_channel, audio_data_channel, samp_freq, control_channel, ready,
+                control_stream=None, consumer=None, result_encoding='json', session_kwargs=None, client_kwargs=None, metrics_interval=0.0):
+    red = redis.StrictRedis(host=redis_server)
+    print('Worker', worker_id, 'started')
+    # every worker reports its own metrics, the reporter thread of the parent does not exist after the fork
+    metrics_reporter = None
+    if metrics_interval > 0:
+        metrics_reporter = MetricsReporter(red, interval=metrics_interval)
+        metrics_reporter.start()
+    if consumer is not None:
+        manager = SessionManager(model, red, redis_server=redis_server, redis_channel=redis_channel, audio_data_channel=audio_data_channel,
+                                 samp_freq=samp_freq, result_stream=redis_channel + ':stream', result_encoding=result_encoding, session_kwargs=session_kwargs,
+                                 client_kwargs=client_kwargs)
+        manager.serve_streams(control_stream, stream_consumer_group, consumer, control_channel, ready=ready)
+    else:
+        manager = SessionManager(model, red, redis_server=redis_server, redis_channel=redis_channel,
+                                 audio_data_channel=audio_data_channel, samp_freq=samp_freq, result_encoding=result_encoding, session_kwargs=session_kwargs,
+                                 client_kwargs=client_kwargs)
+        manager.serve(control_channel, ready=ready)
+    if metrics_reporter is not None:
+        metrics_reporter.stop()
+    print('Worker', worker_id, 'stopped')
+
+# Pre-forked decoder workers that share one loaded model. The parent only dispatches control messages:
+# every session is assigned to the least loaded worker and stays there until it is closed.
+# A worker that dies is forked again from the parent. Its sessions are reopened on the new worker (pubsub transport, the
+# decoder state of the sessions is lost), with the streams transport the new worker recovers them itself (same consumer name).
+class WorkerPool():
+
+    def __init__(self, model, red, num_workers, redis_server='localhost', redis_channel='asr', audio_data_channel='asr_audio',
+                 samp_freq=16000, control_channel='asr_control', control_stream=None, consumer_name=None, result_encoding='json',
+                 session_kwargs=None, client_kwargs=None, metrics_interval=0.0):
+        self.red = red
+        # with the streams transport, the workers take new sessions from the control stream themselves
+        self.use_streams = consumer_name is not None
+        self.control_channel = control_channel
+        self.worker_channels = [control_channel + ':worker' + str(i) for i in range(num_workers)]
+        self.sessions = {}
+        self.num_sessions = [0] * num_workers
+
+        # Kaldi collapses the nnet when a recognizer is constructed, do this once here so that the workers
+        # do not write to (and thereby copy) the shared model pages.
+        model.new_recognizer()
+
+        # Move all objects allocated so far out of the reach of the garbage collector, otherwise the gc
+        # would touch their pages in the children and trigger copy-on-write.
+        gc.collect()
+        gc.freeze()
+
+        self.ctx = multiprocessing.get_context('fork')
+        self.worker_args = (model, redis_server, redis_channel, audio_data_channel, samp_freq)
+        self.worker_kwargs = {'control_stream': control_stream, 'result_encoding': result_encoding, 'session_kwargs': session_kwargs,
+                              'client_kwargs': client_kwargs, 'metrics_interval': metrics_interval}
+        self.consumer_name = consumer_name
+        self.workers = [self.start_worker(i) for i in range(num_workers)]
+
+        for process, ready in self.workers:
+            ready.wait()
+        print('Started', num_workers, 'decoder workers')
+
+    def start_worker(self, i):
+        ready = self.ctx.Event()
+        consumer = self.consumer_name + '-worker' + str(i) if self.use_streams else None
+        process = self.ctx.Process(target=worker_main, args=(i,) + self.worker_args + (self.worker_channels[i], ready),
+                                   kwargs=dict(self.worker_kwargs, consumer=consumer), daemon=True)
+        process.start()
+        return process, ready
+
+    # Fork a new worker for every worker that died, returns the number of restarted workers
+    def restart_dead_workers(self):
+        restarted = 0
+        for i, (process, ready) in enumerate(self.workers):
+            if process.is_alive():
+                continue
+            print('Decoder worker', i, 'died (exit code %s), restarting it' % process.exitcode)
+            process.join()
+            self.workers[i] = self.start_worker(i)
+            self.workers[i][1].wait(timeout=60.0)
+            restarted += 1
+            if not self.use_streams:
+                for session_id, worker in self.sessions.items():
+                    if worker == i:
+                        print('Reopening session', session_id, 'on the restarted worker', i)
+                        self.red.publish(self.worker_channels[i], 'open ' + session_id)
+        return restarted
+
+    def least_loaded_worker(self):
+        alive = [i for i, (process, ready) in enumerate(self.workers) if process.is_alive()]
+        if not alive:
+            return None
+        return min(alive, key=lambda i: self.num_sessions[i])
+
+    def open_session(self, session_id):
+        if session_id in self.sessions:
+            print('Session already open:', session_id)
+            return
+
+        self.restart_dead_workers()
+        worker = self.least_loaded_worker()
+        if worker is None:
+            print('No decoder worker alive, can not open session:', session_id)
+            return
+
+        print('Dispatching session', session_id, 'to worker', worker, '(open sessions:', self.num_sessions, ')')
+        self.sessions[session_id] = worker
+        self.num_sessions[worker] += 1
+        self.red.publish(self.worker_channels[worker], 'open ' + session_id)
+
+    def close_session(self, session_id):
+        worker = self.sessions.pop(session_id, None)
+        if worker is None:
+            print('Can not close unknown session:', session_id)
+            return
+
+        self.num_sessions[worker] -= 1
+        self.red.publish(self.worker_channels[worker], 'close ' + session_id)
+
+    def broadcast(self, command):
+        for worker_channel in self.worker_channels:
+            self.red.publish(worker_channel, command)
+
+    def serve(self):
+        pubsub = self.red.pubsub()
+        pubsub.subscribe(self.control_channel)
+        print('Dispatcher is ready, listening on control channel:', self.control_channel)
+
+        while True:
+            # wake up regularly without control messages, so that dead workers are restarted
+            msg = pubsub.get_message(timeout=worker_check_interval)
+            self.restart_dead_workers()
+            if msg is None or msg['type'] != 'message':
+                continue
+
+            command, _, session_id = msg['data'].decode('utf-8').strip().partition(' ')
+            if command in ('open', 'close') and self.use_streams:
+                print('Ignoring', command, 'on the control channel, sessions are opened in the control stream with the streams transport')
+            elif command == 'open' and session_id:
+                self.open_session(session_id)
+            elif command == 'close' and session_id:
+                self.close_session(session_id)
+            elif command == 'status':
+                self.broadcast('status')
+            elif command == 'shutdown':
+                print('Shutdown command received!')
+                break
+            else:
+                print('Unknown control message:', msg['data'])
+
+        self.broadcast('shutdown')
+        for process, ready in self.workers:
+            process.join()
+        pubsub.close()
+
+
+# Seconds between the checks of the dispatcher for dead workers
+worker_check_interval = 1.0
+
+# All decoder workers (also on different hosts) share this consumer group
+stream_consumer_group = 'asr_decoders'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Starts a Kaldi nnet3 decoder that serves many concurrent sessions with one loaded model')
+
+    parser.add_argument('-y', '--yaml-config', dest='yaml_config', help='Path to the yaml model config', type=str, default='models/kaldi_tuda_de_nnet3_chain2.yaml')
+    parser.add_argument('-o', '--online-config', dest='online_config', help='Path to the Kaldi online config. If not available, will try to read the parameters from the yaml'
+                                                                            ' file and convert it to the Kaldi online config format (See online_config_options.info.txt for details)',
+                                                                            type=str, default='models/kaldi_tuda_de_nnet3_chain2.online.conf')
+    parser.add_argument('-b', '--bundle', dest='bundle', help='Load the model from this precompiled model bundle directory if it is valid'
+                                                              ' (see nnet3_model.py --prepare-bundle)', type=str, default=None)
+
+    parser.add_argument('-bs', '--beam_size', dest='beam_size', help='Beam size of the decoding beam. Defaults to 10.', type=int, default=10)
+    parser.add_argument('-fpc', '--frames_per_chunk', dest='frames_per_chunk', help='Frames per (decoding) chunk. This will also have an effect on latency.', type=int, default=30)
+    parser.add_argument('-d', '--decode-samplerate', dest='decode_samplerate', help='Samplerate of the session audio streams', type=int, default=16000)
+
+    parser.add_argument('-rs', '--redis-server', dest='redis_server', help='Hostname or IP of the server (for redis-server)', type=str, default='localhost')
+    parser.add_argument('-red', '--redis-channel', dest='redis_channel', help='Name of the channel (for redis-server)', type=str, default='asr')
+    parser.add_argument('--redis-audio', dest='redis_audio_channel', help='Prefix of the per session audio channels, the session audio is read from <prefix>:<session>',
+                        type=str, default='asr_audio')
+    parser.add_argument('--redis-control', dest='redis_control_channel', help='Name of the channel (for redis-server)', type=str, default='asr_control')
+
+    parser.add_argument('--redis-transport', dest='redis_transport', help='pubsub (default) or streams: with streams, sessions are opened in the control stream'
+                                                                          ' --redis-control-stream and session audio is read from the streams <redis-audio>:<session>'
+                                                                          ' with a consumer group, results are also added to the stream <redis-channel>:stream',
+                        choices=['pubsub', 'streams'], default='pubsub')
+    parser.add_argument('--redis-control-stream', dest='redis_control_stream', help='Name of the control stream (streams transport)', type=str, default='asr_control:stream')
+    parser.add_argument('--consumer-name', dest='consumer_name', help='Consumer name in the redis stream consumer group. Keep it stable across restarts'
+                                                                      ' to resume from the last acknowledged entries.', type=str, default='decoder')
+
+    parser.add_argument('--result-encoding', dest='result_encoding', help='Encoding of the messages in the redis channel: json (default) or msgpack,'
+                                                                          ' which is more compact. The event server translates msgpack to json for the browser.',
+                        choices=['json', 'msgpack'], default='json')
+
+    add_session_arguments(parser)
+
+    parser.add_argument('-n', '--workers', dest='workers', help='Number of forked decoder worker processes that share the loaded model. '
+                                                                '0 decodes all sessions in this process.', type=int, default=0)
+
+    parser.add_argument('--import-report', dest='import_report', help='Print how long the imports of all (lazily imported) modules took',
+                        action='store_true', default=False)
+
+    args = parser.parse_args()
+
+    red = redis.StrictRedis(host=args.redis_server)
+
+    phase_timer = PhaseTimer()
+    model = load_shared_model_cached(args.yaml_config, args.online_config, bundle_dir=args.bundle, beam_size=args.beam_size,
+                                     frames_per_chunk=args.frames_per_chunk, phase_timer=phase_timer)
+    phase_timer.report('Model loading')
+    if args.import_report:
+        print_import_report()
+
+    use_streams = args.redis_transport == 'streams'
+    session_kwargs = {'vad_opts': get_vad_opts(args, model.session_opts), 'silence_timeout': get_silence_timeout(args, model.session_opts),
+                      'confidence_opts': get_confidence_opts(args)}
+    client_kwargs = get_client_opts(args)
+
+    # With workers, every worker reports its own metrics
+    metrics_reporter = None
+    if args.workers == 0 and args.metrics_interval > 0:
+        metrics_reporter = MetricsReporter(red, interval=args.metrics_interval)
+        metrics_reporter.start()
+
+    if args.workers > 0:
+        pool = WorkerPool(model, red, args.workers, redis_server=args.redis_server, redis_channel=args.redis_channel,
+                          audio_data_channel=args.redis_audio_channel, samp_freq=args.decode_samplerate,
+                          control_channel=args.redis_control_channel, control_stream=args.redis_control_stream,
+                          consumer_name=args.consumer_name if use_streams else None, result_encoding=args.result_encoding,
+                          session_kwargs=session_kwargs, client_kwargs=client_kwargs, metrics_interval=args.metrics_interval)
+        pool.serve()
+    elif use_streams:
+        manager = SessionManager(model, red, redis_server=args.redis_server, redis_channel=args.redis_channel,
+                                 audio_data_channel=args.redis_audio_channel, samp_freq=args.decode_samplerate,
+                                 result_stream=args.redis_channel + ':stream', result_encoding=args.result_encoding, session_kwargs=session_kwargs,
+                                 client_kwargs=client_kwargs)
+        manager.serve_streams(args.redis_control_stream, stream_consumer_group, args.consumer_name, args.redis_control_channel)
+    else:
+        manager = SessionManager(model, red, redis_server=args.redis_server, redis_channel=args.redis_channel,
+                                 audio_data_channel=args.redis_audio_channel, samp_freq=args.decode_samplerate,
+                                 result_encoding=args.result_encoding, session_kwargs=session_kwargs,
+                                 client_kwargs=client_kwargs)
+        manager.serve(args.redis_control_channel)
+
+    if metrics_reporter is not None:
+        metrics_reporter.stop()
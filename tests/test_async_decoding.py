@@ -0,0 +1,78 @@
+import asyncio
+import functools
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+
+pytest.importorskip('kaldi')
+fakeredis = pytest.importorskip('fakeredis')
+from fakeredis import aioredis as fake_aioredis
+
+import nnet3_model
+
+num_blocks = 20
+chunk_size = 1024
+
+
+# Stands in for the ASRSession of the decoding loop, with a decoder that is slower than the audio arrives
+class RecordingSession():
+
+    def __init__(self, *args, **kwargs):
+        self.speaker = kwargs.get('speaker')
+        self.decoded = 0
+        self.decoded_at_finalize = []
+
+    def decode_block(self, block, received=None):
+        time.sleep(0.02)
+        self.decoded += 1
+
+    def finalize(self):
+        self.decoded_at_finalize.append(self.decoded)
+
+    def close(self):
+        pass
+
+
+class SilentClient():
+
+    def sendstatus(self, **kwargs):
+        pass
+
+    def asr_ready(self, **kwargs):
+        pass
+
+    def resetTimer(self):
+        pass
+
+
+def test_blocks_queued_before_stop_are_decoded(monkeypatch):
+    server = fakeredis.FakeServer()
+    sessions = []
+    monkeypatch.setattr(nnet3_model, 'ASRSession', lambda *args, **kwargs: sessions.append(RecordingSession(*args, **kwargs)) or sessions[-1])
+    lazy_import = nnet3_model.lazy_import
+    monkeypatch.setattr(nnet3_model, 'lazy_import', lambda name: types.SimpleNamespace(
+        StrictRedis=functools.partial(fake_aioredis.FakeRedis, server=server)) if name == 'redis.asyncio' else lazy_import(name))
+
+    def publish():
+        red = fakeredis.FakeStrictRedis(server=server)
+        deadline = time.monotonic() + 5.0
+        while red.pubsub_numsub('asr_audio')[0][1] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for _ in range(num_blocks):
+            red.publish('asr_audio', np.zeros(chunk_size, dtype=np.int16).tobytes())
+        # stop while most of the blocks are still queued in front of the decoder
+        time.sleep(0.05)
+        red.publish('asr_control', 'stop')
+        time.sleep(num_blocks * 0.02 + 0.5)
+        red.publish('asr_control', 'shutdown')
+
+    publisher = threading.Thread(target=publish)
+    publisher.start()
+    asyncio.run(nnet3_model.decode_chunked_partial_endpointing_async(None, None, None, None, 1, chunk_size=chunk_size, asr_client=SilentClient(),
+                                                                     use_local_mic=False))
+    publisher.join()
+
+    assert sessions[0].decoded_at_finalize == [num_blocks]
@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+import pytest
+
+from audio_ingest import AudioRingBuffer, RedisStreamAudioIngest, ensure_consumer_group
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def add_block(red, stream, value, frames=256):
+    red.xadd(stream, {'audio': np.full(frames, value, dtype=np.int16).tobytes()})
+
+
+def pending_count(red, stream, group='asr_decoders'):
+    return red.xpending(stream, group)['pending']
+
+
+def test_ring_buffer_rechunks_and_wraps_around():
+    ring_buffer = AudioRingBuffer(capacity=10)
+    ring_buffer.write(np.arange(6, dtype=np.int16))
+    assert list(ring_buffer.read(4, timeout=0)) == [0, 1, 2, 3]
+    # the second write wraps around the end of the buffer
+    ring_buffer.write(np.arange(6, 13, dtype=np.int16))
+    assert list(ring_buffer.read(9, timeout=0)) == list(range(4, 13))
+    assert ring_buffer.read(1, timeout=0) is None
+    assert ring_buffer.frames_dropped == 0
+
+
+def test_ring_buffer_overwrites_the_oldest_frames_when_full():
+    ring_buffer = AudioRingBuffer(capacity=4, channels=2)
+    ring_buffer.write(np.arange(12, dtype=np.int16))
+    assert ring_buffer.frames_written == 6
+    assert ring_buffer.frames_dropped == 2
+    assert list(ring_buffer.read_available(4)) == list(range(4, 12))
+
+
+def test_ring_buffer_prebuffers_after_an_underrun():
+    ring_buffer = AudioRingBuffer(capacity=100, jitter_frames=8)
+    ring_buffer.write(np.zeros(4, dtype=np.int16))
+    # less than the jitter buffer, nothing is delivered yet
+    assert ring_buffer.read(4, timeout=0) is None
+    ring_buffer.write(np.zeros(4, dtype=np.int16))
+    assert ring_buffer.read(4, timeout=0) is not None
+    assert ring_buffer.read(4, timeout=0) is not None
+    assert ring_buffer.read(4, timeout=0) is None
+    assert ring_buffer.underruns == 1
+    ring_buffer.write(np.zeros(4, dtype=np.int16))
+    assert ring_buffer.read(4, timeout=0) is None
+
+
+def test_ring_buffer_read_into_out():
+    ring_buffer = AudioRingBuffer(capacity=8)
+    ring_buffer.write(np.arange(8, dtype=np.int16))
+    out = np.empty(4, dtype=np.int16)
+    assert ring_buffer.read(4, timeout=0, out=out) is out
+    assert list(out) == [0, 1, 2, 3]
+
+
+def test_stream_ingest_resumes_pending_entries_after_restart():
+    red = fakeredis.FakeStrictRedis()
+    # the decoder group only gets entries that are added after it was created
+    ensure_consumer_group(red, 'audio', 'asr_decoders')
+    for value in range(4):
+        add_block(red, 'audio', value)
+
+    ingest = RedisStreamAudioIngest(red, 'audio', 256, jitter_ms=0, consumer='decoder1')
+    ingest.start()
+    assert ingest.read_chunk(timeout=5.0)[0] == 0
+    # the first entry is acknowledged, the other three were delivered but not read by the decoder
+    assert wait_until(lambda: pending_count(red, 'audio') == 3)
+    ingest.stop()
+    ingest.join()
+
+    add_block(red, 'audio', 4)
+    restarted = RedisStreamAudioIngest(red, 'audio', 256, jitter_ms=0, consumer='decoder1')
+    restarted.start()
+    try:
+        # first the pending entries, then the new one
+        values = [restarted.read_chunk(timeout=5.0) for _ in range(4)]
+        assert [block[0] if block is not None else None for block in values] == [1, 2, 3, 4]
+        add_block(red, 'audio', 5)
+        assert restarted.read_chunk(timeout=5.0)[0] == 5
+        assert wait_until(lambda: pending_count(red, 'audio') == 0)
+    finally:
+        restarted.stop()
+        restarted.join()
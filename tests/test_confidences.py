@@ -0,0 +1,36 @@
+import pytest
+
+pytest.importorskip('kaldi')
+
+from kaldi.fstext import CompactLatticeArc, CompactLatticeVectorFst, CompactLatticeWeight, LatticeWeight
+
+from confidences import ConfidenceEstimator, confidence_modes
+
+
+# A compact lattice (as out["lattice"] of the recognizer) with the words 1 2 and a competing, more costly path 1 3
+def make_lattice():
+    lattice = CompactLatticeVectorFst()
+    states = [lattice.add_state() for _ in range(4)]
+    lattice.set_start(states[0])
+    lattice.add_arc(states[0], CompactLatticeArc(1, 1, CompactLatticeWeight(LatticeWeight(1.0, 2.0), [1, 1]), states[1]))
+    lattice.add_arc(states[1], CompactLatticeArc(2, 2, CompactLatticeWeight(LatticeWeight(1.0, 2.0), [2, 2]), states[2]))
+    lattice.add_arc(states[1], CompactLatticeArc(3, 3, CompactLatticeWeight(LatticeWeight(2.0, 3.0), [3, 3]), states[3]))
+    lattice.set_final(states[2], CompactLatticeWeight.one())
+    lattice.set_final(states[3], CompactLatticeWeight.one())
+    return lattice
+
+
+@pytest.mark.parametrize('mode', confidence_modes)
+def test_every_mode_on_a_compact_lattice(mode):
+    estimator = ConfidenceEstimator(mode=mode, beam=6.0, max_states=2)
+    confidences = estimator.estimate({'text': 'one two', 'lattice': make_lattice()})
+    assert len(confidences) == 2
+    assert all(0.0 <= confidence <= 1.0 for confidence in confidences)
+    assert estimator.stats()['utterances'] == 1
+
+
+def test_pruning_removes_the_competing_path():
+    lattice = make_lattice()
+    confidences = ConfidenceEstimator(mode='pruned', beam=0.5).estimate({'text': 'one two', 'lattice': lattice})
+    assert lattice.num_states() == 3
+    assert confidences == pytest.approx([1.0, 1.0])
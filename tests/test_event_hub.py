@@ -0,0 +1,119 @@
+import asyncio
+import time
+
+import pytest
+
+from event_hub import AsyncChannelHub, AsyncClientQueue, ChannelHub, ClientQueue
+
+fakeredis = pytest.importorskip('fakeredis')
+
+
+def test_client_queue_drops_the_oldest_frames():
+    queue = ClientQueue(max_size=2)
+    for frame in [b'1', b'2', b'3']:
+        assert queue.put(frame)
+    assert queue.dropped == 1
+    assert [queue.get(timeout=0), queue.get(timeout=0), queue.get(timeout=0)] == [b'2', b'3', None]
+
+
+def test_client_queue_disconnects_a_slow_client():
+    queue = ClientQueue(max_size=2, slow_client_policy='disconnect')
+    assert queue.put(b'1') and queue.put(b'2')
+    assert not queue.put(b'3')
+    assert queue.closed
+    # the queued frames are still delivered, then the stream ends
+    assert [queue.get(timeout=0), queue.get(timeout=0), queue.get(timeout=0)] == [b'1', b'2', None]
+
+
+def test_async_client_queue():
+    async def run():
+        queue = AsyncClientQueue(max_size=2)
+        assert await queue.get(timeout=0.01) is None
+        queue.put(b'1')
+        queue.put(b'2')
+        queue.put(b'3')
+        frames = [await queue.get(timeout=0.01), await queue.get(timeout=0.01)]
+        queue.close()
+        return frames, await queue.get(timeout=1.0), queue.dropped
+
+    assert asyncio.run(run()) == ([b'2', b'3'], None, 1)
+
+
+def test_hub_fans_out_one_subscription():
+    red = fakeredis.FakeStrictRedis()
+    hub = ChannelHub(red, 'asr', max_queue_size=1, slow_client_policy='disconnect')
+    with pytest.raises(ValueError):
+        ChannelHub(red, 'asr', slow_client_policy='unknown')
+
+    reader, slow = hub.connect(), hub.connect()
+    deadline = time.monotonic() + 5.0
+    while red.pubsub_numsub('asr')[0][1] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert red.pubsub_numsub('asr')[0][1] == 1
+
+    red.publish('asr', '{"handle": "status"}')
+    assert reader.get(timeout=5.0) == b'data: {"handle": "status"}\n\n'
+    red.publish('asr', '{"handle": "partialUtterance"}')
+    assert reader.get(timeout=5.0) == b'data: {"handle": "partialUtterance"}\n\n'
+
+    # the slow client did not read its first frame, so it is disconnected by the second one
+    deadline = time.monotonic() + 5.0
+    while hub.stats()['clients'] > 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stats = hub.stats()
+    assert stats['clients'] == 1 and stats['slow_disconnects'] == 1 and stats['messages'] == 2
+    assert slow.closed
+    hub.disconnect(reader)
+    assert hub.stats()['clients'] == 0
+
+
+# A redis client whose subscriptions fail right away, counts the subscriptions and the closed ones
+class FailingRedis():
+
+    def __init__(self):
+        self.subscriptions = 0
+        self.closed = 0
+
+    def pubsub(self, **kwargs):
+        self.subscriptions += 1
+        return FailingPubSub(self)
+
+
+class FailingPubSub():
+
+    def __init__(self, red):
+        self.red = red
+
+    def subscribe(self, channel):
+        raise ConnectionError('redis is gone')
+
+    def close(self):
+        self.red.closed += 1
+
+    async def aclose(self):
+        self.red.closed += 1
+
+
+def test_hub_closes_failed_subscriptions_before_reconnecting():
+    red = FailingRedis()
+    hub = ChannelHub(red, 'asr', reconnect_delay=0.01)
+    hub.connect()
+    deadline = time.monotonic() + 5.0
+    while red.subscriptions < 3 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the hub thread may be between subscribing and closing the latest subscription
+    assert red.subscriptions >= 3 and red.closed >= red.subscriptions - 1
+
+
+def test_async_hub_closes_failed_subscriptions_before_reconnecting():
+    async def run():
+        red = FailingRedis()
+        hub = AsyncChannelHub(red, 'asr', reconnect_delay=0.01)
+        hub.connect()
+        await asyncio.sleep(0.2)
+        hub.stop()
+        await asyncio.gather(hub.task, return_exceptions=True)
+        return red.subscriptions, red.closed
+
+    subscriptions, closed = asyncio.run(run())
+    assert subscriptions >= 3 and closed == subscriptions
@@ -0,0 +1,38 @@
+import json
+
+import numpy as np
+import pytest
+
+from message_codec import decode_message, get_codec, to_json
+
+message = {'handle': 'completeUtterance', 'utterance': 'hallo welt', 'key': 'mic1-utt1', 'speaker': 'speaker0',
+           'confidences': [1.0, 0.5], 'time': 1.25}
+
+
+def test_json_round_trip_with_numpy_values():
+    codec = get_codec('json')
+    encoded = codec.encode(dict(message, confidences=np.array([1.0, 0.5], dtype=np.float32)))
+    assert codec.decode(encoded) == message
+    assert decode_message(encoded) == message
+
+
+def test_json_is_passed_through_to_json():
+    encoded = get_codec('json').encode(message)
+    assert to_json(encoded) == encoded.encode('utf-8')
+    assert to_json(encoded.encode('utf-8')) == encoded.encode('utf-8')
+
+
+def test_msgpack_round_trip_and_translation_to_json():
+    pytest.importorskip('msgpack')
+    codec = get_codec('msgpack')
+    encoded = codec.encode(message)
+    assert isinstance(encoded, bytes) and encoded[:1] != b'{'
+    # the confidences are packed as float32, 0.5 and 1.0 are exact
+    assert codec.decode(encoded) == message
+    assert decode_message(encoded) == message
+    assert json.loads(to_json(encoded)) == message
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        get_codec('xml')
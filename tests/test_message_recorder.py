@@ -0,0 +1,32 @@
+import json
+import os
+import time
+
+from message_recorder import MessageRecorder, recording_files
+
+
+def test_recorder_flushes_while_idle(tmp_path):
+    recorder = MessageRecorder(prefix=str(tmp_path / 'history'), flush_interval=0.05)
+    try:
+        recorder.record('{"handle": "status"}', ts=1.0)
+        file_name = recorder.file_name(0)
+        deadline = time.monotonic() + 5.0
+        while os.path.getsize(file_name) == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # the message is on disk without another record() call and before close()
+        with open(file_name) as file_in:
+            assert json.loads(file_in.readline()) == {'ts': 1.0, 'data': {'handle': 'status'}}
+    finally:
+        recorder.close()
+
+
+def test_recorder_rotates_files(tmp_path):
+    prefix = str(tmp_path / 'history')
+    recorder = MessageRecorder(prefix=prefix, max_bytes=100)
+    for i in range(5):
+        recorder.record('{"i": %d}' % i, ts=float(i))
+    recorder.close()
+    files = recording_files(prefix)
+    assert len(files) > 1
+    lines = [json.loads(line) for file_name in files for line in open(file_name)]
+    assert [line['data']['i'] for line in lines] == list(range(5))
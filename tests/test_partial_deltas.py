@@ -0,0 +1,32 @@
+import json
+
+import pytest
+
+pytest.importorskip('kaldi')
+fakeredis = pytest.importorskip('fakeredis')
+
+from nnet3_model import ASRRedisClient
+
+
+def published_handles(red, pubsub):
+    handles = []
+    while True:
+        message = pubsub.get_message()
+        if message is None:
+            return handles
+        if message['type'] == 'message':
+            handles.append(json.loads(message['data'])['handle'])
+
+
+def test_every_interval_th_partial_is_full():
+    red = fakeredis.FakeStrictRedis()
+    pubsub = red.pubsub()
+    pubsub.subscribe('asr')
+    client = ASRRedisClient(red=red, partial_deltas=True, full_partial_interval=4)
+    words = []
+    for i in range(9):
+        words.append('w%d' % i)
+        client.partialUtterance(' '.join(words))
+    handles = published_handles(red, pubsub)
+    full = [i for i, handle in enumerate(handles) if handle == 'partialUtterance']
+    assert full == [0, 4, 8]
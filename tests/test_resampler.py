@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from resampler import PolyphaseResampler, make_resampler
+
+
+def tone(freq, rate, secs=1.0, amplitude=10000.0):
+    return (amplitude * np.sin(2.0 * np.pi * freq * np.arange(int(rate * secs)) / rate)).astype(np.int16)
+
+
+def resample_in_blocks(resampler, signal, block_sizes):
+    out, offset, i = [], 0, 0
+    while offset < len(signal):
+        block_size = block_sizes[i % len(block_sizes)]
+        # the output is a reused buffer
+        out.append(np.array(resampler.process(signal[offset:offset + block_size]), copy=True))
+        offset += block_size
+        i += 1
+    return np.concatenate(out)
+
+
+def rms(signal):
+    return float(np.sqrt(np.mean(np.asarray(signal, dtype=np.float64) ** 2)))
+
+
+@pytest.mark.parametrize('in_rate,out_rate', [(48000, 16000), (44100, 16000), (8000, 16000)])
+def test_output_length_and_block_size_independence(in_rate, out_rate):
+    signal = tone(440.0, in_rate)
+    whole = np.array(PolyphaseResampler(in_rate, out_rate).process(signal), copy=True)
+    blocks = resample_in_blocks(PolyphaseResampler(in_rate, out_rate), signal, [1024, 333, 4096, 1])
+    assert abs(len(whole) - len(signal) * out_rate / in_rate) <= 1
+    assert len(blocks) == len(whole)
+    assert np.abs(blocks.astype(np.int32) - whole).max() <= 1
+
+
+def test_tone_in_the_passband_is_kept():
+    out = PolyphaseResampler(48000, 16000).process(tone(1000.0, 48000))
+    # skip the start, where the filter is still filling up
+    steady = out[1000:]
+    assert rms(steady) == pytest.approx(10000.0 / np.sqrt(2.0), rel=0.02)
+    spectrum = np.abs(np.fft.rfft(steady))
+    assert np.argmax(spectrum) * 16000.0 / len(steady) == pytest.approx(1000.0, abs=2.0)
+
+
+def test_tone_above_the_new_nyquist_frequency_is_removed():
+    out = PolyphaseResampler(48000, 16000).process(tone(10000.0, 48000))
+    # at least 40 dB attenuation instead of aliasing to 6 kHz
+    assert rms(out[1000:]) < 10000.0 / np.sqrt(2.0) / 100.0
+
+
+def test_output_buffers_are_used_in_turn():
+    resampler = PolyphaseResampler(48000, 16000, num_buffers=2)
+    first = resampler.process(tone(440.0, 48000, secs=0.1))
+    first_copy = np.array(first, copy=True)
+    resampler.process(tone(440.0, 48000, secs=0.1))
+    assert np.array_equal(first, first_copy)
+    # the third block reuses the buffer of the first one
+    assert np.shares_memory(first, resampler.process(tone(440.0, 48000, secs=0.1)))
+
+
+def test_make_resampler():
+    assert isinstance(make_resampler('polyphase', 48000, 16000), PolyphaseResampler)
+    with pytest.raises(ValueError):
+        make_resampler('unknown', 48000, 16000)
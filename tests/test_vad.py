@@ -0,0 +1,58 @@
+import numpy as np
+
+from vad import EnergyVAD
+
+samp_freq = 16000
+block_size = 1024
+
+
+def noise_block(level_db, rng):
+    # white noise with an rms of level_db dBFS
+    return (rng.standard_normal(block_size) * 32768.0 * 10.0 ** (level_db / 20.0)).astype(np.int16)
+
+
+def test_threshold_decides_before_adaptation():
+    rng = np.random.default_rng(0)
+    vad = EnergyVAD(samp_freq=samp_freq, threshold_db=-50.0, margin_db=10.0)
+    # 5 dB above the threshold is speech from the first block on
+    blocks, ended = vad.process(noise_block(-45.0, rng))
+    assert len(blocks) == 1 and not ended
+    assert vad.in_speech
+
+
+def test_silence_is_skipped_and_preroll_is_passed_on():
+    rng = np.random.default_rng(1)
+    vad = EnergyVAD(samp_freq=samp_freq, preroll_ms=128, hangover_ms=0)
+    for _ in range(10):
+        assert vad.process(noise_block(-70.0, rng)) == ([], False)
+    speech = noise_block(-20.0, rng)
+    blocks, ended = vad.process(speech)
+    # 128ms of preroll are two blocks of 1024 samples, then the speech block itself
+    assert len(blocks) == 3 and blocks[-1] is speech and not ended
+    blocks, ended = vad.process(noise_block(-70.0, rng))
+    assert blocks == [] and ended
+    assert vad.stats()['speech_segments'] == 1
+    assert vad.samples_skipped == 9 * block_size
+
+
+def test_noise_starting_during_speech_ends_the_speech():
+    rng = np.random.default_rng(2)
+    vad = EnergyVAD(samp_freq=samp_freq)
+    for _ in range(20):
+        vad.process(noise_block(-20.0, rng))
+    assert vad.in_speech
+    # a constant noise above threshold_db: the floor has to adapt during "speech" to get out of it
+    ended = False
+    for _ in range(1000):
+        ended = vad.process(noise_block(-35.0, rng))[1] or ended
+    assert ended and not vad.in_speech
+
+
+def test_noise_floor_is_capped_during_speech():
+    rng = np.random.default_rng(3)
+    vad = EnergyVAD(samp_freq=samp_freq)
+    # loud speech without pauses can not raise the floor above max_noise_db and end itself
+    for _ in range(2000):
+        blocks, ended = vad.process(noise_block(-20.0, rng))
+        assert len(blocks) >= 1 and not ended
+    assert vad.noise_db <= vad.max_noise_db
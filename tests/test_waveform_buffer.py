@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('kaldi')
+
+from waveform_buffer import WaveformBuffer
+
+
+def test_block_is_converted_to_float():
+    buffer = WaveformBuffer()
+    block = np.array([0, 1, -1, 32767, -32768], dtype=np.int16)
+    vector = buffer.to_vector(block)
+    assert len(vector) == 5
+    assert list(vector.numpy()) == [0.0, 1.0, -1.0, 32767.0, -32768.0]
+
+
+def test_strided_channel_view_is_read_in_place():
+    interleaved = np.arange(12, dtype=np.int16)
+    # the second of three channels, as returned by the channel selection
+    channel = interleaved.reshape(-1, 3)[:, 1]
+    assert not channel.flags['C_CONTIGUOUS']
+    assert list(WaveformBuffer().to_vector(channel).numpy()) == [1.0, 4.0, 7.0, 10.0]
+
+
+def test_no_allocations_in_the_steady_state():
+    buffer = WaveformBuffer()
+    for _ in range(100):
+        buffer.to_vector(np.zeros(1024, dtype=np.int16))
+    stats = buffer.stats()
+    assert stats['vector_allocations'] == 1 and stats['view_allocations'] == 1
+    # a larger block grows the vector, a smaller one only needs a new view
+    assert len(buffer.to_vector(np.zeros(3000, dtype=np.int16))) == 3000
+    assert len(buffer.to_vector(np.zeros(512, dtype=np.int16))) == 512
+    assert buffer.stats()['vector_allocations'] == 2
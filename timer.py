@@ -29,3 +29,27 @@ class Timer(object):
     def current_secs(self):
         self.stop()
         return self.secs
+
+# Measures a sequence of named phases, e.g. the steps of model loading
+class PhaseTimer(object):
+    def __init__(self):
+        self.timings = []
+        self.timer = Timer()
+        self.timer.start()
+
+    # End the current phase and start the next one
+    def phase(self, name):
+        self.timings.append((name, self.timer.current_secs()))
+        self.timer.start()
+
+    def total_secs(self):
+        return sum(secs for name, secs in self.timings)
+
+    def as_dict(self):
+        return dict(self.timings)
+
+    def report(self, title='Timing breakdown'):
+        total = self.total_secs()
+        print('%s (total: %.3f s):' % (title, total))
+        for name, secs in self.timings:
+            print('  %-28s %8.3f s  %5.1f%%' % (name, secs, 100.0 * secs / total if total > 0 else 0.0))
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lightweight streaming voice activity detection, used to gate the audio in front of the decoder: blocks without speech
+are neither passed to the feature extraction nor to the decoder search. Enabled with use-vad in the model yaml or --vad.
+"""
+
+import collections
+
+import numpy as np
+
+
+# Energy based VAD with an adaptive noise floor. A 10ms frame is speech if its energy is above threshold_db (dBFS)
+# and margin_db above the noise floor. After speech, hangover_ms of audio are still passed on, so that the endpointing
+# and the last word are not cut off. When speech starts, the last preroll_ms of audio before it are passed on first,
+# so that word onsets are not clipped.
+# The noise floor starts at threshold_db - margin_db, so that threshold_db alone decides until it has adapted. During
+# speech it slowly follows the quietest frame of every block (the pauses between words), by speech_adaptation per block
+# and at most up to max_noise_db, so that a noise that starts during speech (e.g. a fan) does not keep the VAD in speech.
+class EnergyVAD():
+
+    def __init__(self, samp_freq=16000, threshold_db=-50.0, margin_db=10.0, preroll_ms=300, hangover_ms=300, frame_ms=10,
+                 speech_adaptation=0.01, max_noise_db=-40.0):
+        self.samp_freq = samp_freq
+        self.threshold_db = threshold_db
+        self.margin_db = margin_db
+        self.speech_adaptation = speech_adaptation
+        self.max_noise_db = max_noise_db
+        self.frame_len = int(samp_freq * frame_ms / 1000)
+        self.preroll_samples = int(samp_freq * preroll_ms / 1000)
+        self.hangover_samples = int(samp_freq * hangover_ms / 1000)
+
+        self.noise_db = threshold_db - margin_db
+        self.in_speech = False
+        self.hangover_left = 0
+        self.preroll = collections.deque()
+        self.preroll_len = 0
+
+        self.samples_total = 0
+        self.samples_skipped = 0
+        self.speech_segments = 0
+
+    # Energies of the 10ms frames of the block in dBFS (a trailing partial frame counts as a frame of its own)
+    def frame_energies_db(self, block):
+        samples = np.asarray(block, dtype=np.float32) / 32768.0
+        num_frames = -(-len(samples) // self.frame_len)
+        padded = np.zeros(num_frames * self.frame_len, dtype=np.float32)
+        padded[:len(samples)] = samples
+        frames = padded.reshape(num_frames, self.frame_len)
+        frame_lens = np.full(num_frames, self.frame_len)
+        frame_lens[-1] = len(samples) - (num_frames - 1) * self.frame_len
+        return 10.0 * np.log10(np.einsum('ij,ij->i', frames, frames) / frame_lens + 1e-10)
+
+    def is_speech(self, block):
+        energies_db = self.frame_energies_db(block)
+        speech_frames = energies_db > max(self.threshold_db, self.noise_db + self.margin_db)
+        if not speech_frames.any():
+            self.noise_db = 0.95 * self.noise_db + 0.05 * float(np.mean(energies_db))
+            return False
+        quietest_db = min(float(energies_db.min()), self.max_noise_db)
+        self.noise_db += self.speech_adaptation * (quietest_db - self.noise_db)
+        return True
+
+    # Feed one block. Returns the blocks that should be decoded (empty during silence, preroll + block at the
+    # start of speech) and True if a speech segment just ended.
+    def process(self, block):
+        self.samples_total += len(block)
+
+        if self.is_speech(block):
+            self.hangover_left = self.hangover_samples
+            if not self.in_speech:
+                self.in_speech = True
+                self.speech_segments += 1
+                blocks = list(self.preroll) + [block]
+                self.samples_skipped -= self.preroll_len
+                self.preroll.clear()
+                self.preroll_len = 0
+                return blocks, False
+            return [block], False
+
+        if self.in_speech:
+            if self.hangover_left > 0:
+                self.hangover_left -= len(block)
+                return [block], False
+            self.in_speech = False
+            self.add_preroll(block)
+            return [], True
+
+        self.add_preroll(block)
+        return [], False
+
+    # Remember the latest silence for the preroll of the next speech segment. Skipped samples are counted here
+    # and uncounted again if they are used as preroll.
+    def add_preroll(self, block):
+        self.samples_skipped += len(block)
+        # the block may be a view into a buffer that is reused by the caller
+        self.preroll.append(np.array(block, copy=True))
+        self.preroll_len += len(block)
+        while self.preroll and self.preroll_len - len(self.preroll[0]) >= self.preroll_samples:
+            self.preroll_len -= len(self.preroll.popleft())
+
+    def stats(self):
+        return {'secs_total': round(self.samples_total / self.samp_freq, 2),
+                'secs_skipped': round(self.samples_skipped / self.samp_freq, 2),
+                'speech_segments': self.speech_segments}
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Reusable Kaldi vector for handing int16 audio blocks to the online feature pipeline. Instead of allocating a new
+Vector(block) for every chunk, the block is converted into a preallocated Kaldi vector (through a numpy view of its memory)
+and a SubVector of the block length is passed on. The feature pipeline copies the waveform into its own buffers, so the
+vector can be reused for the next chunk. The allocation counters show how many vectors were allocated per chunk.
+"""
+
+from kaldi.matrix import Vector
+
+
+# One buffer per decoding session (it is not thread safe). The vector grows to the largest block seen so far, views of
+# the block lengths in use are cached, so in the steady state (constant chunk size) nothing is allocated per chunk.
+class WaveformBuffer():
+
+    def __init__(self, initial_size=0, max_cached_views=8):
+        self.vector = None
+        self.array = None
+        self.views = {}
+        self.max_cached_views = max_cached_views
+
+        self.chunks = 0
+        self.vector_allocations = 0
+        self.view_allocations = 0
+        if initial_size > 0:
+            self.allocate(initial_size)
+
+    def allocate(self, size):
+        self.vector = Vector(size)
+        # numpy view of the memory of the Kaldi vector (no copy)
+        self.array = self.vector.numpy()
+        self.views = {}
+        self.vector_allocations += 1
+
+    # Returns a Kaldi (Sub)Vector with the samples of the block as float. The vector is only valid until the next call.
+    # The block can be a strided view (e.g. the selected channel of an interleaved block), it is read in place by the
+    # int16 -> float conversion, which is the only copy of the samples.
+    def to_vector(self, block):
+        n = len(block)
+        if self.vector is None or len(self.array) < n:
+            self.allocate(max(n, 2 * len(self.array) if self.array is not None else n))
+
+        # int16 -> float conversion directly into the memory of the Kaldi vector
+        self.array[:n] = block
+
+        view = self.views.get(n)
+        if view is None:
+            if len(self.views) >= self.max_cached_views:
+                self.views = {}
+            view = self.views[n] = self.vector.range(0, n)
+            self.view_allocations += 1
+
+        self.chunks += 1
+        return view
+
+    def stats(self):
+        chunks = max(self.chunks, 1)
+        return {'chunks': self.chunks, 'vector_allocations': self.vector_allocations, 'view_allocations': self.view_allocations,
+                'allocations_per_chunk': round((self.vector_allocations + self.view_allocations) / chunks, 4),
+                'capacity': len(self.array) if self.array is not None else 0}